@@ -8,12 +8,18 @@ import {
   map,
   of,
   switchMap,
+  takeWhile,
   throwError,
 } from 'rxjs';
-import { DeliveryOrder } from 'src/app/model/models';
+import {
+  DeliveryOrder,
+  OrderFeedEventType,
+  UserRole,
+} from 'src/app/model/models';
 import { LocationPipe } from 'src/app/shared/pipes/location.pipe';
 import { DeliveryService } from 'src/app/shared/services/delivery.service';
-import { HttpError, ObservableUtils } from 'src/app/shared/utility';
+import { FeedService } from 'src/app/shared/services/feed.service';
+import { HttpError } from 'src/app/shared/utility';
 import { CustomOrder, OrderAction } from '../order-list/order-list.component';
 
 export type DeliveryOrdersType = 'HISTORY' | 'AVAILABLE';
@@ -54,6 +60,7 @@ export class DeliveryOrdersComponent {
 
   constructor(
     private deliveryService: DeliveryService,
+    private feedService: FeedService,
     private snackBar: MatSnackBar,
     private router: Router,
     route: ActivatedRoute
@@ -66,9 +73,13 @@ export class DeliveryOrdersComponent {
       switchMap((ordersType) => {
         switch (ordersType) {
           case DeliveryOrdersType.AVAILABLE:
-            return deliveryService
-              .getAvailableDeliveries()
-              .pipe(ObservableUtils.pollAfterData());
+            return this.feedService.refetchOnOrderEvents(
+              UserRole.DELIVERER,
+              deliveryService.getAvailableDeliveries(),
+              (event) =>
+                event.type == OrderFeedEventType.ORDER_AVAILABILITY ||
+                event.type == OrderFeedEventType.ORDER_OFFER
+            );
 
           case DeliveryOrdersType.HISTORY:
             return deliveryService.getHistoricalDeliveries();
@@ -133,17 +144,18 @@ export class DeliveryOrdersComponent {
   }
 
   goToOrderOnceSecured(orderId: string) {
-    this.deliveryService
-      .getDelivery(orderId)
-      .pipe(
-        map(() => true),
-        catchError(() => of(false)),
-        ObservableUtils.pollAfterData({
-          pollInterval: 1000,
-          takeWhilePredicate: (value, _index) => !value,
-          inclusiveTakeWhile: true,
-        })
+    const secured$ = this.deliveryService.getDelivery(orderId).pipe(
+      map(() => true),
+      catchError(() => of(false))
+    );
+
+    this.feedService
+      .refetchOnOrderEvents(
+        UserRole.DELIVERER,
+        secured$,
+        (event) => event.orderId == orderId
       )
+      .pipe(takeWhile((secured) => !secured, true))
       .subscribe({
         complete: () => this.goToOrder(orderId),
       });
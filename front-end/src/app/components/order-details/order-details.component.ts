@@ -13,18 +13,22 @@ import {
   map,
   of,
   switchMap,
+  takeWhile,
 } from 'rxjs';
 import {
   FavoriteOrder,
   Order,
+  OrderFeedEventType,
   OrderItem,
   OrderRating,
   OrderStatus,
   Product,
+  UserRole,
 } from 'src/app/model/models';
+import { FeedService } from 'src/app/shared/services/feed.service';
 import { OrderService } from 'src/app/shared/services/order.service';
 import { UserService } from 'src/app/shared/services/user.service';
-import { HttpError, ObservableUtils } from 'src/app/shared/utility';
+import { HttpError } from 'src/app/shared/utility';
 import {
   RateOrderItemDialog,
   RatingInput,
@@ -70,6 +74,7 @@ export class OrderDetailsComponent {
     private userService: UserService,
     private snackBar: MatSnackBar,
     private dialog: MatDialog,
+    feedService: FeedService,
     orderService: OrderService,
     router: Router,
     activatedRoute: ActivatedRoute
@@ -83,29 +88,33 @@ export class OrderDetailsComponent {
     this.orderId = orderId;
 
     this.routeState = this._getRouteState(router.getCurrentNavigation());
-    const orderPolling$ = orderService.getOrder(orderId).pipe(
-      ObservableUtils.pollAfterData({
-        takeWhilePredicate: (value) =>
-          value.orderStatus != OrderStatus.DELIVERED,
-        inclusiveTakeWhile: true,
-      }),
-      catchError((err: HttpError) => {
-        this.snackBar.open(
-          `Failed to load order: ${err.errorMessage}`,
-          'Dismiss'
-        );
-        return EMPTY;
-      })
-    );
+    const orderUpdates$ = feedService
+      .refetchOnOrderEvents(
+        UserRole.REGULAR_USER,
+        orderService.getOrder(orderId),
+        (event) =>
+          event.type == OrderFeedEventType.ORDER_STATUS_UPDATE &&
+          event.orderId == orderId
+      )
+      .pipe(
+        takeWhile((value) => value.orderStatus != OrderStatus.DELIVERED, true),
+        catchError((err: HttpError) => {
+          this.snackBar.open(
+            `Failed to load order: ${err.errorMessage}`,
+            'Dismiss'
+          );
+          return EMPTY;
+        })
+      );
 
     this.orderRatings$ = this.pullOrderRatings$.pipe(
       switchMap(() => orderService.getOrderRatings(orderId))
     );
 
     if (this.routeState.order) {
-      this.order$ = concat(of(this.routeState.order), orderPolling$);
+      this.order$ = concat(of(this.routeState.order), orderUpdates$);
     } else {
-      this.order$ = orderPolling$;
+      this.order$ = orderUpdates$;
     }
 
     this.orderDetails$ = combineLatest([this.order$, this.orderRatings$]).pipe(
@@ -1,8 +1,19 @@
 import { Component } from '@angular/core';
 import { MatSnackBar } from '@angular/material/snack-bar';
 import { Router } from '@angular/router';
-import { Observable, catchError, first, map, of, shareReplay } from 'rxjs';
-import { Order, OrderItem, Product } from 'src/app/model/models';
+import {
+  BehaviorSubject,
+  Observable,
+  catchError,
+  concatMap,
+  first,
+  map,
+  of,
+  scan,
+  shareReplay,
+  tap,
+} from 'rxjs';
+import { Order, OrderItem, OrderPage, Product } from 'src/app/model/models';
 import { CartService } from 'src/app/shared/services/cart.service';
 import { OrderService } from 'src/app/shared/services/order.service';
 import { ProductsService } from 'src/app/shared/services/products.service';
@@ -37,6 +48,9 @@ export class OrderHistoryComponent {
   orders$: Observable<CustomOrder<Order>[]>;
   products$: Observable<Product[] | null>;
   reordering = false;
+  nextCursor: string | null = null;
+  loadingMore = false;
+  private pullPage$ = new BehaviorSubject<string | undefined>(undefined);
 
   constructor(
     orderService: OrderService,
@@ -45,14 +59,23 @@ export class OrderHistoryComponent {
     private router: Router,
     private snackBar: MatSnackBar
   ) {
-    this.orders$ = orderService.getOrderHistory().pipe(
-      catchError((err: HttpError) => {
-        snackBar.open(
-          `Failed to load order history: ${err.errorMessage}`,
-          'Dismiss'
-        );
-        return of([] as Order[]);
+    this.orders$ = this.pullPage$.pipe(
+      concatMap((cursor) =>
+        orderService.getOrderHistory(cursor).pipe(
+          catchError((err: HttpError) => {
+            snackBar.open(
+              `Failed to load order history: ${err.errorMessage}`,
+              'Dismiss'
+            );
+            return of({ orders: [] as Order[] } as OrderPage);
+          })
+        )
+      ),
+      tap((page) => {
+        this.nextCursor = page.cursor ?? null;
+        this.loadingMore = false;
       }),
+      scan((orders, page) => orders.concat(page.orders), [] as Order[]),
       map((orders) => {
         const customOrders: CustomOrder<Order>[] = [];
         orders.forEach((order) =>
@@ -81,6 +104,13 @@ export class OrderHistoryComponent {
     });
   }
 
+  loadMore() {
+    if (this.nextCursor) {
+      this.loadingMore = true;
+      this.pullPage$.next(this.nextCursor);
+    }
+  }
+
   reorder(orderItems: OrderItem[]) {
     this.reordering = true;
 
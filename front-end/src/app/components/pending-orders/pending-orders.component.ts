@@ -8,11 +8,17 @@ import {
   map,
   of,
   switchMap,
+  takeWhile,
   throwError,
 } from 'rxjs';
-import { PendingOrder } from 'src/app/model/models';
+import {
+  PendingOrder,
+  OrderFeedEventType,
+  UserRole,
+} from 'src/app/model/models';
+import { FeedService } from 'src/app/shared/services/feed.service';
 import { ShopService } from 'src/app/shared/services/shop.service';
-import { HttpError, ObservableUtils } from 'src/app/shared/utility';
+import { HttpError } from 'src/app/shared/utility';
 import { CustomOrder, OrderAction } from '../order-list/order-list.component';
 
 export type PendingOrdersType = 'HISTORY' | 'AVAILABLE';
@@ -53,6 +59,7 @@ export class PendingOrdersComponent {
 
   constructor(
     private shopService: ShopService,
+    private feedService: FeedService,
     private snackBar: MatSnackBar,
     private router: Router,
     route: ActivatedRoute
@@ -65,9 +72,11 @@ export class PendingOrdersComponent {
       switchMap((ordersType) => {
         switch (ordersType) {
           case PendingOrdersType.AVAILABLE:
-            return shopService
-              .getAvailablePendingOrders()
-              .pipe(ObservableUtils.pollAfterData());
+            return this.feedService.refetchOnOrderEvents(
+              UserRole.SHOP_OWNER,
+              shopService.getAvailablePendingOrders(),
+              (event) => event.type == OrderFeedEventType.ORDER_AVAILABILITY
+            );
 
           case PendingOrdersType.HISTORY:
             return shopService.getHistoricalOrdersPrepared();
@@ -132,17 +141,18 @@ export class PendingOrdersComponent {
   }
 
   goToOrderOnceSecured(orderId: string) {
-    this.shopService
-      .getPendingOrder(orderId)
-      .pipe(
-        map(() => true),
-        catchError(() => of(false)),
-        ObservableUtils.pollAfterData({
-          pollInterval: 1000,
-          takeWhilePredicate: (value, _index) => !value,
-          inclusiveTakeWhile: true,
-        })
+    const secured$ = this.shopService.getPendingOrder(orderId).pipe(
+      map(() => true),
+      catchError(() => of(false))
+    );
+
+    this.feedService
+      .refetchOnOrderEvents(
+        UserRole.SHOP_OWNER,
+        secured$,
+        (event) => event.orderId == orderId
       )
+      .pipe(takeWhile((secured) => !secured, true))
       .subscribe({
         complete: () => this.goToOrder(orderId),
       });
@@ -101,6 +101,37 @@ export interface Location {
   zip: string;
 }
 
+/**
+ * Event pushed over the order feed
+ */
+export interface OrderFeedEvent {
+  type: OrderFeedEventType;
+  /**
+   * ID of the order the event is about, missing for FEED_CONNECTED
+   */
+  orderId?: string;
+  orderStatus?: OrderStatus;
+  /**
+   * Whether the order can be taken, for ORDER_AVAILABILITY
+   */
+  available?: boolean;
+  /**
+   * When the offer lapses in seconds since the epoch, for ORDER_OFFER
+   */
+  expiresAt?: number;
+}
+export type OrderFeedEventType =
+  | 'FEED_CONNECTED'
+  | 'ORDER_STATUS_UPDATE'
+  | 'ORDER_AVAILABILITY'
+  | 'ORDER_OFFER';
+export const OrderFeedEventType = {
+  FEED_CONNECTED: 'FEED_CONNECTED' as OrderFeedEventType,
+  ORDER_STATUS_UPDATE: 'ORDER_STATUS_UPDATE' as OrderFeedEventType,
+  ORDER_AVAILABILITY: 'ORDER_AVAILABILITY' as OrderFeedEventType,
+  ORDER_OFFER: 'ORDER_OFFER' as OrderFeedEventType,
+};
+
 /**
  * Order information
  */
@@ -129,6 +160,16 @@ export interface Order {
    */
   items: OrderItem[];
 }
+/**
+ * A page of orders
+ */
+export interface OrderPage {
+  orders: Order[];
+  /**
+   * Cursor for the next page, if more orders exist
+   */
+  cursor?: string | null;
+}
 export type OrderStatus =
   | 'RECEIVED'
   | 'BREWING'
@@ -0,0 +1,108 @@
+import { HttpClient } from '@angular/common/http';
+import { Injectable } from '@angular/core';
+import {
+  Observable,
+  catchError,
+  defer,
+  filter,
+  map,
+  retry,
+  startWith,
+  switchMap,
+} from 'rxjs';
+import {
+  OrderFeedEvent,
+  OrderFeedEventType,
+  UserRole,
+} from 'src/app/model/models';
+import { environment } from 'src/environments/environment';
+import { HttpUtils } from '../utility';
+
+interface OrderFeedToken {
+  token: string;
+  expiresAt: number;
+}
+
+@Injectable({
+  providedIn: 'root',
+})
+export class FeedService {
+  static RECONNECT_DELAY_MS = 5000;
+
+  constructor(private http: HttpClient) {}
+
+  /**
+   * Get a short-lived token for connecting to the order feed, since browsers
+   * can't send the API key header when opening a WebSocket
+   */
+  private getFeedToken(): Observable<string> {
+    const url = `${environment.backendUrl}/user/feed-token`;
+    const headers = HttpUtils.getBaseHeaders();
+
+    return this.http.get<OrderFeedToken>(url, { headers }).pipe(
+      map((feedToken) => feedToken.token),
+      retry(HttpUtils.RETRY_ATTEMPTS),
+      catchError((error) => HttpUtils.handleError(error))
+    );
+  }
+
+  private connect(role: UserRole, token: string): Observable<OrderFeedEvent> {
+    return new Observable<OrderFeedEvent>((subscriber) => {
+      const url = `${environment.orderFeedUrl}?role=${role}&token=${encodeURIComponent(token)}`;
+      const socket = new WebSocket(url);
+
+      socket.onopen = () =>
+        subscriber.next({ type: OrderFeedEventType.FEED_CONNECTED });
+      socket.onmessage = (message) => {
+        try {
+          subscriber.next(JSON.parse(message.data) as OrderFeedEvent);
+        } catch (error) {
+          console.log('Ignoring malformed order feed event', message.data);
+        }
+      };
+      // Erroring makes the caller reconnect with a new token
+      socket.onclose = () =>
+        subscriber.error(new Error('Order feed connection closed'));
+
+      return () => {
+        socket.onclose = null;
+        socket.close();
+      };
+    });
+  }
+
+  /**
+   * Listen to order feed events for the current user, reconnecting whenever
+   * the connection drops
+   * @param role Role to receive events for
+   */
+  public getOrderEvents(role: UserRole): Observable<OrderFeedEvent> {
+    return defer(() => this.getFeedToken()).pipe(
+      switchMap((token) => this.connect(role, token)),
+      retry({ delay: FeedService.RECONNECT_DELAY_MS })
+    );
+  }
+
+  /**
+   * Fetch data immediately and again whenever a matching order feed event
+   * arrives. Every (re)connect also refetches, as events may have been missed
+   * while disconnected.
+   * @param role Role to receive events for
+   * @param source$ Request for the data
+   * @param predicate Which events should trigger a refetch
+   */
+  public refetchOnOrderEvents<T>(
+    role: UserRole,
+    source$: Observable<T>,
+    predicate: (event: OrderFeedEvent) => boolean
+  ): Observable<T> {
+    return this.getOrderEvents(role).pipe(
+      filter(
+        (event) =>
+          event.type == OrderFeedEventType.FEED_CONNECTED || predicate(event)
+      ),
+      startWith(null),
+      switchMap(() => source$)
+    );
+  }
+}
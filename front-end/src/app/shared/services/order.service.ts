@@ -1,4 +1,4 @@
-import { HttpClient } from '@angular/common/http';
+import { HttpClient, HttpParams } from '@angular/common/http';
 import { Injectable } from '@angular/core';
 import {
   Observable,
@@ -15,6 +15,7 @@ import {
   CreateOrder,
   Order,
   OrderItem,
+  OrderPage,
   OrderRating,
   Product,
   ProductAddition,
@@ -98,14 +99,19 @@ export class OrderService {
   }
 
   /**
-   * Get all orders from the current user&#x27;s history
+   * Get a page of orders from the current user&#x27;s history, newest first
+   * @param cursor Cursor from the previous page, omit for the first page
    */
-  public getOrderHistory(): Observable<Order[]> {
+  public getOrderHistory(cursor?: string): Observable<OrderPage> {
     const url = `${environment.backendUrl}/orders`;
+    const params = cursor ? new HttpParams().set('cursor', cursor) : undefined;
     const headers = HttpUtils.getBaseHeaders();
 
-    return this.http.get<Order[]>(url, { headers }).pipe(
-      map((rawData) => this.cleanOrdersFromService(rawData)),
+    return this.http.get<OrderPage>(url, { headers, params }).pipe(
+      map((rawData) => ({
+        ...rawData,
+        orders: this.cleanOrdersFromService(rawData.orders),
+      })),
       tap((data) => console.log('Retrieved orders', data)),
       retry(HttpUtils.RETRY_ATTEMPTS),
       catchError((error) => HttpUtils.handleError(error))
@@ -0,0 +1,20 @@
+"""Lets benchmarks import project_utility outside of Lambda.
+
+project_utility reads its environment variables at import time, so every
+variable it references gets a placeholder value unless one is already set.
+"""
+import os
+import re
+import sys
+
+LAMBDA_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_UTILITY_PATH = os.path.join(LAMBDA_DIRECTORY, "project_utility.py")
+
+with open(PROJECT_UTILITY_PATH) as project_utility_file:
+    for name in re.findall(r'os\.environ\[\s*"(\w+)"\s*\]', project_utility_file.read()):
+        os.environ.setdefault(name, f"benchmark-{name.lower()}")
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+if LAMBDA_DIRECTORY not in sys.path:
+    sys.path.insert(0, LAMBDA_DIRECTORY)
@@ -0,0 +1,133 @@
+"""Compares the stored size of expanded and compact order items.
+
+Sizes follow DynamoDB's item size rules, which set the read and write
+capacity an order costs. Expansion time covers the extra work reads do.
+
+Usage: python order_format_benchmark.py [-n ORDERS] [-i ITEMS] [-r REPEAT]
+"""
+import argparse
+import random
+import timeit
+import uuid
+from decimal import Decimal
+
+import benchmark_environment  # noqa: F401
+from project_utility import (
+    COFFEE_TYPES,
+    MILK_TYPES,
+    compact_order,
+    expand_order_item,
+    serialize_to_dynamo_object,
+)
+
+READ_UNIT_BYTES = 4096
+
+
+def build_catalog_additions(count, rng):
+    additions = {}
+    for index in range(count):
+        addition_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        additions[addition_id] = {
+            "id": addition_id,
+            "name": f"Addition {index + 1}",
+            "price": Decimal(rng.randint(25, 150)).scaleb(-2),
+            "enabled": True,
+        }
+    return additions
+
+
+def build_orders(count, items_per_order, additions, seed=6998):
+    rng = random.Random(seed)
+    addition_list = list(additions.values())
+    orders = []
+    for _ in range(count):
+        items = []
+        for _ in range(rng.randint(1, items_per_order)):
+            item = {
+                "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "productId": str(uuid.UUID(int=rng.getrandbits(128))),
+                "basePrice": Decimal(rng.randint(200, 800)).scaleb(-2),
+                "coffeeType": rng.choice(COFFEE_TYPES),
+                "milkType": rng.choice(MILK_TYPES),
+            }
+            item_additions = rng.sample(addition_list, rng.randint(0, 3))
+            if len(item_additions) > 0:
+                item["additions"] = [dict(addition) for addition in item_additions]
+            items.append(item)
+        orders.append({"items": items})
+    return orders
+
+
+def number_size(value):
+    digits = len(value.lstrip("-").replace(".", "").strip("0")) or 1
+    return (digits + 1) // 2 + 1
+
+
+def attribute_value_size(value):
+    (value_type, content), = value.items()
+    if value_type == "S":
+        return len(content.encode("utf-8"))
+    elif value_type == "N":
+        return number_size(content)
+    elif value_type in ("BOOL", "NULL"):
+        return 1
+    elif value_type == "L":
+        return 3 + sum(1 + attribute_value_size(element) for element in content)
+    elif value_type == "M":
+        return 3 + sum(
+            1 + len(name.encode("utf-8")) + attribute_value_size(element)
+            for name, element in content.items()
+        )
+    raise ValueError(f"Unsupported type {value_type}")
+
+
+def item_size(item):
+    return sum(
+        len(name.encode("utf-8")) + attribute_value_size(value)
+        for name, value in serialize_to_dynamo_object(item).items()
+    )
+
+
+def expand_items(order, additions):
+    return [expand_order_item(item, additions) for item in order["items"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--orders", type=int, default=2000)
+    parser.add_argument("-i", "--items", type=int, default=8)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(6998)
+    additions = build_catalog_additions(20, rng)
+    orders = build_orders(args.orders, args.items, additions)
+    compact_orders = [compact_order(order) for order in orders]
+
+    for order, compacted in zip(orders, compact_orders):
+        if expand_items(compacted, additions) != order["items"]:
+            raise AssertionError(f"Round trip mismatch for {order}")
+    print(f"Compact items expand back to the original on {len(orders)} orders")
+
+    expanded_size = sum(item_size(order) for order in orders)
+    compact_size = sum(item_size(order) for order in compact_orders)
+    largest_order = max(orders, key=item_size)
+    print(f"expanded: {expanded_size / len(orders):8.1f} bytes/order")
+    print(f" compact: {compact_size / len(orders):8.1f} bytes/order")
+    print(f"   saved: {1 - compact_size / expanded_size:8.1%}")
+    print(
+        f" largest: {item_size(largest_order)} -> {item_size(compact_order(largest_order))} bytes"
+        f" ({READ_UNIT_BYTES} bytes per strongly consistent read unit)"
+    )
+
+    timings = timeit.repeat(
+        lambda: [expand_items(order, additions) for order in compact_orders],
+        number=1,
+        repeat=args.repeat,
+    )
+    per_order = min(timings) / len(orders) * 1_000_000
+    print(f"  expand: {min(timings) * 1000:8.2f} ms best, {per_order:6.2f} us/order")
+
+
+if __name__ == "__main__":
+    main()
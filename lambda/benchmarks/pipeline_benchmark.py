@@ -0,0 +1,221 @@
+"""Runs the order update pipeline end to end in one process.
+
+Order update tasks go through order-update, order-update-confirmation and
+user-notification using InProcessTransport, once in order and once on a
+thread pool. DynamoDB, API Gateway and SES are replaced by in-memory stand-ins
+that sleep for the given latency per call. Only user-notification is
+subscribed to the status topic.
+
+Usage: python pipeline_benchmark.py [-n ORDERS] [-w WORKERS] [-l LATENCY_MS] [-r REPEAT]
+"""
+import argparse
+import contextlib
+import importlib.util
+import os
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+# order-update reads this as a number, the other variables only need placeholders
+os.environ.setdefault("ORDER_ARCHIVE_AGE_DAYS", "30")
+
+from benchmark_environment import LAMBDA_DIRECTORY  # noqa: E402
+from project_utility import (  # noqa: E402
+    EnvironmentVariables,
+    InProcessTransport,
+    OrderStatus,
+    build_order_update_message,
+    send_sqs_message_batch,
+    serialize_to_dynamo_object,
+    set_message_transport,
+)
+
+
+class TransactionCanceledException(Exception):
+    pass
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class InMemoryAws:
+    def __init__(self, latency_ms):
+        self.latency_seconds = latency_ms / 1000
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+
+
+class InMemoryDynamo(InMemoryAws):
+    class exceptions:
+        TransactionCanceledException = TransactionCanceledException
+        ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self, latency_ms):
+        super().__init__(latency_ms)
+        self.orders = {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.call()
+        order = self.orders.get(Key["id"]["S"])
+        return {"Item": order} if order is not None else {}
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.call()
+
+    def transact_write_items(self, TransactItems):
+        self.call()
+        for transact_item in TransactItems:
+            put = transact_item.get("Put")
+            if put is None or put["TableName"] != EnvironmentVariables.ORDERS_TABLE.value:
+                continue
+            with self.lock:
+                self.orders[put["Item"]["id"]["S"]] = put["Item"]
+
+
+class InMemoryApiGateway(InMemoryAws):
+    def get_api_key(self, apiKey, includeValue=False):
+        self.call()
+        return {
+            "tags": {
+                "email": f"{apiKey}@example.com",
+                "username": apiKey,
+                "displayName": apiKey,
+                "roles": "REGULAR_USER",
+            }
+        }
+
+
+class InMemorySes(InMemoryAws):
+    def send_email(self, **kwargs):
+        self.call()
+        return {"MessageId": str(uuid.uuid4())}
+
+
+def load_lambda_module(name):
+    path = os.path.join(LAMBDA_DIRECTORY, name, "lambda_function.py")
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_order(index):
+    return {
+        "customerId": f"customer-{index % 50}",
+        "id": f"order-{index}",
+        "orderStatus": OrderStatus.PICKED_UP.value,
+        "shopId": f"shop-{index % 5}",
+        "delivererId": f"deliverer-{index % 10}",
+        "items": [
+            {
+                "id": f"item-{index}",
+                "productId": "product-1",
+                "basePrice": Decimal("4.50"),
+                "coffeeType": "REGULAR",
+                "milkType": "OAT",
+            }
+        ],
+        "commission": Decimal("3"),
+        "deliveryFee": Decimal("1.50"),
+        "updatedAt": 0,
+        "version": 1,
+    }
+
+
+def run_pipeline(order_count, concurrent, workers, latency_ms):
+    dynamo = InMemoryDynamo(latency_ms)
+    api_gateway = InMemoryApiGateway(latency_ms)
+    ses = InMemorySes(latency_ms)
+
+    order_update = load_lambda_module("order-update")
+    order_update.dynamo = dynamo
+    confirmation = load_lambda_module("order-update-confirmation")
+    confirmation.dynamo = dynamo
+    notification = load_lambda_module("user-notification")
+    notification.dynamo = dynamo
+    notification.api_gateway = api_gateway
+    notification.ses = ses
+
+    transport = InProcessTransport(concurrent=concurrent, max_workers=workers)
+    transport.subscribe(
+        EnvironmentVariables.ORDER_UPDATE_QUEUE_URL.value, order_update.lambda_handler
+    )
+    transport.subscribe(
+        EnvironmentVariables.ORDER_UPDATE_CONFIRMATION_QUEUE_URL.value,
+        confirmation.lambda_handler,
+    )
+    transport.subscribe(
+        EnvironmentVariables.ORDER_STATUS_TOPIC_ARN.value, notification.lambda_handler
+    )
+    previous_transport = set_message_transport(transport)
+
+    orders = [build_order(index) for index in range(order_count)]
+    for order in orders:
+        dynamo.orders[order["id"]] = serialize_to_dynamo_object(order)
+    messages = [
+        build_order_update_message(
+            order["customerId"],
+            order["id"],
+            order["orderStatus"],
+            OrderStatus.DELIVERED.value,
+            {},
+            1,
+        )
+        for order in orders
+    ]
+
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            send_sqs_message_batch(
+                None, EnvironmentVariables.ORDER_UPDATE_QUEUE_URL.value, messages
+            )
+            transport.drain()
+            elapsed = time.perf_counter() - started
+    finally:
+        transport.close()
+        set_message_transport(previous_transport)
+
+    delivered_orders = sum(
+        1
+        for order in dynamo.orders.values()
+        if order["orderStatus"]["S"] == OrderStatus.DELIVERED.value
+    )
+    if delivered_orders != order_count or ses.calls != order_count:
+        raise AssertionError(
+            f"Expected {order_count} delivered orders and emails,"
+            f" got {delivered_orders} and {ses.calls} (dropped {transport.dropped})"
+        )
+    return elapsed, transport.delivered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--orders", type=int, default=500)
+    parser.add_argument("-w", "--workers", type=int, default=16)
+    parser.add_argument("-l", "--latency-ms", type=float, default=2.0)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for name, concurrent in [("in order", False), ("concurrent", True)]:
+        results = [
+            run_pipeline(args.orders, concurrent, args.workers, args.latency_ms)
+            for _ in range(args.repeat)
+        ]
+        elapsed, deliveries = min(results)
+        print(
+            f"{name:>10}: {elapsed * 1000:8.1f} ms best, {args.orders / elapsed:8.1f} orders/s,"
+            f" {deliveries} deliveries"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Compares Decimal pricing with the integer-cents pricing in project_utility.
+
+Prices are drawn from a catalog of distinct prices, like real orders.
+
+Usage: python pricing_benchmark.py [-n ORDERS] [-i ITEMS] [-c CATALOG] [-r REPEAT]
+"""
+import argparse
+import random
+import timeit
+from decimal import Decimal
+
+import benchmark_environment  # noqa: F401
+from project_utility import calculate_order_fees, from_cents
+
+
+# The Decimal implementation pricing used before integer cents
+def legacy_order_total_percentage(order, rate, minimum):
+    order_total = Decimal(0)
+    for item in order["items"]:
+        order_total += item["basePrice"]
+        if "additions" in item:
+            for addition in item["additions"]:
+                order_total += addition["price"]
+
+    calculated = order_total * rate
+    output = max(calculated, minimum)
+
+    return round(output, 2)
+
+
+def legacy_order_fees(order):
+    commission = legacy_order_total_percentage(order, Decimal("0.20"), Decimal("3"))
+    delivery_fee = legacy_order_total_percentage(order, Decimal("0.1"), Decimal("1.5"))
+    return commission, delivery_fee
+
+
+def cents_order_fees(order):
+    _, commission, delivery_fee = calculate_order_fees(order)
+    return from_cents(commission), from_cents(delivery_fee)
+
+
+def build_orders(count, items_per_order, catalog_size, seed=6998):
+    rng = random.Random(seed)
+    catalog_prices = [
+        Decimal(rng.randint(0, 2000)).scaleb(-2) for _ in range(catalog_size)
+    ]
+
+    def random_price(rng):
+        return rng.choice(catalog_prices)
+
+    orders = []
+    for _ in range(count):
+        items = []
+        for _ in range(rng.randint(1, items_per_order)):
+            items.append(
+                {
+                    "basePrice": random_price(rng),
+                    "additions": [
+                        {"price": random_price(rng)} for _ in range(rng.randint(0, 3))
+                    ],
+                }
+            )
+        orders.append({"items": items})
+    return orders
+
+
+def check_equivalence(orders):
+    for order in orders:
+        legacy = legacy_order_fees(order)
+        cents = cents_order_fees(order)
+        if legacy != cents:
+            raise AssertionError(f"Pricing mismatch: {legacy} != {cents} for {order}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--orders", type=int, default=2000)
+    parser.add_argument("-i", "--items", type=int, default=8)
+    parser.add_argument("-c", "--catalog", type=int, default=50)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    orders = build_orders(args.orders, args.items, args.catalog)
+    check_equivalence(orders)
+    print(f"Decimal and cents pricing agree on {len(orders)} orders")
+
+    for name, price in [("decimal", legacy_order_fees), ("cents", cents_order_fees)]:
+        timings = timeit.repeat(
+            lambda: [price(order) for order in orders], number=1, repeat=args.repeat
+        )
+        per_order = min(timings) / len(orders) * 1_000_000
+        print(f"{name:>8}: {min(timings) * 1000:8.2f} ms best, {per_order:6.2f} us/order")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,59 @@
 import traceback
+from datetime import timedelta
 
 import boto3
 from project_utility import (
+    EARNINGS_OWNER_DELIVERER,
+    EXPORT_OWNER_DELIVERERS,
+    ORDERS_DELIVERER_UPDATED_AT_INDEX,
+    SCHEDULE_QUEUE_DELIVERY,
     EnvironmentVariables,
     ErrorCodes,
     OrderStatus,
     UserRole,
+    attach_live_order_status,
+    build_bulk_outcome,
     build_error_response,
+    build_projection_expression,
     build_response,
     deserialize_dynamo_object,
+    expand_order_items,
     extract_user_id,
+    get_bounded_int_parameter,
+    get_earnings,
+    get_earnings_date_range,
+    get_fields_parameter,
+    get_nearby_areas,
+    get_order_export,
+    get_order_ids_from_body,
     get_order_status,
+    get_order_statuses,
     get_path_parameter,
     get_query_parameter,
+    get_since_parameter,
+    get_user_saved_data,
+    get_zip_area,
+    query_all_items,
+    query_scheduled_orders,
     send_order_update_task,
+    send_order_update_tasks,
+    start_order_export,
     user_has_role,
 )
 
 # Clients
 dynamo = boto3.client("dynamodb")
+s3 = boto3.client("s3")
+sqs = boto3.client("sqs")
 
 # Constants
+LIVE_STATUS_FLAG = "liveStatus"
+DEFAULT_AVAILABLE_LIMIT = 50
+MAX_AVAILABLE_LIMIT = 100
+DEFAULT_WINDOW_HOURS = 48
+MAX_WINDOW_HOURS = 7 * 24
+DEFAULT_AREA_RADIUS = 1
+MAX_AREA_RADIUS = 10
 TRANFER_FIELDS = [
     "id",
     "orderStatus",
@@ -29,7 +62,27 @@ TRANFER_FIELDS = [
     "deliveryLocation",
     "deliveryFee",
     "items",
+    "updatedAt",
 ]
+# Statuses a deliverer may move their orders to, any other transition is rejected
+DELIVERER_STATUS_TRANSITIONS = {
+    OrderStatus.MADE.value: [OrderStatus.PICKED_UP.value],
+    OrderStatus.AWAITING_PICKUP.value: [OrderStatus.PICKED_UP.value],
+    OrderStatus.PICKED_UP.value: [OrderStatus.DELIVERED.value],
+}
+DELIVERER_NEW_STATUSES = {
+    status for statuses in DELIVERER_STATUS_TRANSITIONS.values() for status in statuses
+}
+
+
+def get_requested_fields(event):
+    fields, invalid_fields = get_fields_parameter(event, TRANFER_FIELDS, ["id"])
+    if len(invalid_fields) > 0:
+        return None, build_error_response(
+            ErrorCodes.INVALID_DATA,
+            f"Invalid field(s): {', '.join(invalid_fields)}. Valid field(s): {', '.join(TRANFER_FIELDS)}",
+        )
+    return fields, None
 
 
 def transfer_field(raw_order, destination_order, field, required=False):
@@ -39,61 +92,182 @@ def transfer_field(raw_order, destination_order, field, required=False):
         raise ValueError(f"Required field {field} not found on order")
 
 
-def build_delivery_orders_from_dynamo_response(items):
+def build_delivery_orders_from_dynamo_response(items, fields=TRANFER_FIELDS):
     orders = []
     for item in items:
-        order = deserialize_dynamo_object(item)
+        order = expand_order_items(dynamo, deserialize_dynamo_object(item))
         cleaned_order = {}
-        for field in TRANFER_FIELDS:
+        for field in fields:
             transfer_field(order, cleaned_order, field)
 
         orders.append(cleaned_order)
     return orders
 
 
+def get_changed_orders(deliverer_id, since, projection_expression, expression_names):
+    print(f"Looking up orders for deliverer {deliverer_id} changed since {since}")
+    return query_all_items(
+        dynamo,
+        {
+            "TableName": EnvironmentVariables.ORDERS_TABLE.value,
+            "IndexName": ORDERS_DELIVERER_UPDATED_AT_INDEX,
+            "KeyConditionExpression": "delivererId = :delivererId AND updatedAt > :since",
+            "ProjectionExpression": projection_expression,
+            "ExpressionAttributeNames": expression_names,
+            "ExpressionAttributeValues": {
+                ":delivererId": {
+                    "S": deliverer_id,
+                },
+                ":since": {
+                    "N": str(since),
+                },
+            },
+        },
+    )
+
+
 def get_previous_orders(event, context):
     deliverer_id = extract_user_id(event)
 
-    print(f"Looking up orders for deliverer {deliverer_id}")
-    response = dynamo.scan(
-        TableName=EnvironmentVariables.ORDERS_TABLE.value,
-        FilterExpression="delivererId = :delivererId",
-        ExpressionAttributeValues={
-            ":delivererId": {
-                "S": deliverer_id,
+    fields, error_response = get_requested_fields(event)
+    if error_response is not None:
+        return error_response
+    projection_expression, expression_names = build_projection_expression(fields)
+
+    try:
+        since = get_since_parameter(event)
+    except ValueError:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, "Since must be a non-negative timestamp"
+        )
+
+    if since is not None:
+        orders = get_changed_orders(
+            deliverer_id, since, projection_expression, expression_names
+        )
+    else:
+        print(f"Looking up orders for deliverer {deliverer_id}")
+        response = dynamo.scan(
+            TableName=EnvironmentVariables.ORDERS_TABLE.value,
+            FilterExpression="delivererId = :delivererId",
+            ProjectionExpression=projection_expression,
+            ExpressionAttributeNames=expression_names,
+            ExpressionAttributeValues={
+                ":delivererId": {
+                    "S": deliverer_id,
+                },
             },
-        },
-    )
-    orders = response["Items"]
+        )
+        orders = response["Items"]
 
     print(f"Found {len(orders)} orders")
-    orders = build_delivery_orders_from_dynamo_response(orders)
+    orders = build_delivery_orders_from_dynamo_response(orders, fields)
+    if get_query_parameter(event, LIVE_STATUS_FLAG, "false").lower() == "true":
+        attach_live_order_status(dynamo, orders)
     return build_response(200, orders)
 
 
+def export_previous_orders(event, context):
+    deliverer_id = extract_user_id(event)
+
+    fields, error_response = get_requested_fields(event)
+    if error_response is not None:
+        return error_response
+
+    try:
+        since = get_since_parameter(event)
+    except ValueError:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, "Since must be a non-negative timestamp"
+        )
+
+    print(f"Exporting orders for deliverer {deliverer_id}")
+    return start_order_export(
+        dynamo, sqs, EXPORT_OWNER_DELIVERERS, deliverer_id, fields, since
+    )
+
+
+def get_previous_orders_export(event, context):
+    deliverer_id = extract_user_id(event)
+
+    export_id = get_path_parameter(event, "id", None)
+    if export_id is None:
+        return build_error_response(ErrorCodes.MISSING_DATA, "Must specify an export ID")
+
+    return get_order_export(
+        dynamo, s3, EXPORT_OWNER_DELIVERERS, deliverer_id, export_id
+    )
+
+
+def get_earnings_summary(event, context):
+    deliverer_id = extract_user_id(event)
+
+    try:
+        first_day, last_day = get_earnings_date_range(event)
+    except ValueError as e:
+        return build_error_response(ErrorCodes.INVALID_DATA, str(e))
+
+    print(f"Looking up earnings for deliverer {deliverer_id} from {first_day} to {last_day}")
+    earnings = get_earnings(dynamo, EARNINGS_OWNER_DELIVERER, deliverer_id, first_day, last_day)
+    return build_response(200, earnings)
+
+
 def get_available_orders(event, context):
     deliverer_id = extract_user_id(event)
 
-    print(f"Looking up available orders for deliverer {deliverer_id}")
-    response = dynamo.scan(
-        TableName=EnvironmentVariables.ORDERS_TABLE.value,
-        FilterExpression="attribute_not_exists(delivererId) AND orderStatus = :orderStatus",
-        ExpressionAttributeValues={
-            ":orderStatus": {
-                "S": OrderStatus.MADE.value,
-            },
-        },
+    fields, error_response = get_requested_fields(event)
+    if error_response is not None:
+        return error_response
+
+    try:
+        limit = get_bounded_int_parameter(
+            event, "limit", DEFAULT_AVAILABLE_LIMIT, 1, MAX_AVAILABLE_LIMIT
+        )
+        window_hours = get_bounded_int_parameter(
+            event, "windowHours", DEFAULT_WINDOW_HOURS, 1, MAX_WINDOW_HOURS
+        )
+        radius = get_bounded_int_parameter(
+            event, "radius", DEFAULT_AREA_RADIUS, 0, MAX_AREA_RADIUS
+        )
+    except ValueError as e:
+        return build_error_response(ErrorCodes.INVALID_DATA, str(e))
+
+    zip_code = get_query_parameter(event, "zip", None)
+    if zip_code is not None:
+        area = get_zip_area({"zip": zip_code})
+        if area is None:
+            return build_error_response(ErrorCodes.INVALID_DATA, "Invalid zip")
+    else:
+        saved_data = get_user_saved_data(dynamo, deliverer_id)
+        locations = saved_data.get("locations", []) if saved_data else []
+        area = get_zip_area(locations[0]) if len(locations) > 0 else None
+
+    # Without a known area, fall back to every available order in the window
+    areas = get_nearby_areas(area, radius) if area is not None else None
+
+    print(
+        f"Looking up {limit} available orders due within {window_hours} hours for deliverer {deliverer_id} near area {area}"
+    )
+    orders = query_scheduled_orders(
+        dynamo,
+        SCHEDULE_QUEUE_DELIVERY,
+        timedelta(hours=window_hours),
+        limit,
+        fields,
+        areas,
     )
-    orders = response["Items"]
 
     print(f"Found {len(orders)} orders")
-    orders = build_delivery_orders_from_dynamo_response(orders)
+    orders = build_delivery_orders_from_dynamo_response(orders, fields)
 
     return build_response(200, orders)
 
 
 def get_order_for_deliverer(deliverer_id, order_id):
     print(f"Getting order {order_id} for deliverer {deliverer_id}")
+    projection_expression, expression_names = build_projection_expression(
+        TRANFER_FIELDS
+    )
     response = dynamo.scan(
         TableName=EnvironmentVariables.ORDERS_TABLE.value,
         FilterExpression="id = :orderId AND delivererId = :delivererId",
@@ -105,6 +279,8 @@ def get_order_for_deliverer(deliverer_id, order_id):
                 "S": deliverer_id,
             },
         },
+        ProjectionExpression=projection_expression,
+        ExpressionAttributeNames=expression_names,
     )
 
     orders = response["Items"] if "Items" in response else None
@@ -151,6 +327,7 @@ def secure_order(event, context):
             OrderStatus.MADE.value,
             OrderStatus.AWAITING_PICKUP.value,
             new_order_info,
+            deliverer_id,
         )
         is None
     ):
@@ -160,6 +337,15 @@ def secure_order(event, context):
     return build_response(200, None)
 
 
+def is_valid_new_status(new_status):
+    # Bodies are arbitrary JSON, so the status may not even be a string
+    return isinstance(new_status, str) and new_status in DELIVERER_NEW_STATUSES
+
+
+def is_valid_status_transition(current_status, new_status):
+    return new_status in DELIVERER_STATUS_TRANSITIONS.get(current_status, [])
+
+
 def update_order_status(event, context):
     deliverer_id = extract_user_id(event)
 
@@ -176,13 +362,7 @@ def update_order_status(event, context):
         return build_error_response(ErrorCodes.NOT_FOUND, "Order not found")
 
     new_status = get_query_parameter(event, "newStatus", OrderStatus.PICKED_UP.value)
-    if (
-        order_status["orderStatus"] == OrderStatus.MADE.value
-        and new_status != OrderStatus.PICKED_UP.value
-    ) or (
-        order_status["orderStatus"] == OrderStatus.PICKED_UP.value
-        and new_status != OrderStatus.DELIVERED.value
-    ):
+    if not is_valid_status_transition(order_status["orderStatus"], new_status):
         return build_error_response(
             ErrorCodes.INVALID_DATA, f"Invalid new status: {new_status}"
         )
@@ -195,6 +375,7 @@ def update_order_status(event, context):
             order_status["orderStatus"],
             new_status,
             None,
+            deliverer_id,
         )
         is None
     ):
@@ -204,6 +385,94 @@ def update_order_status(event, context):
     return build_response(200, None)
 
 
+def secure_orders(event, context):
+    deliverer_id = extract_user_id(event)
+
+    order_ids, _, error_response = get_order_ids_from_body(event)
+    if error_response is not None:
+        return error_response
+
+    print(f"Attempting to secure {len(order_ids)} orders for deliverer {deliverer_id}")
+    order_statuses = get_order_statuses(dynamo, order_ids)
+
+    outcomes = {}
+    available = []
+    for order_id in order_ids:
+        order_status = order_statuses.get(order_id)
+        if order_status is None or order_status["orderStatus"] != OrderStatus.MADE.value:
+            outcomes[order_id] = build_bulk_outcome(
+                order_id, False, "Order is not available"
+            )
+        else:
+            available.append(order_status)
+
+    if len(available) > 0:
+        new_order_info = {
+            "delivererId": deliverer_id,
+        }
+        results = send_order_update_tasks(
+            dynamo,
+            available,
+            OrderStatus.AWAITING_PICKUP.value,
+            new_order_info,
+            deliverer_id,
+        )
+        for order_id, message_id in results.items():
+            if message_id is None:
+                outcomes[order_id] = build_bulk_outcome(
+                    order_id, False, "Failed to secure order"
+                )
+            else:
+                outcomes[order_id] = build_bulk_outcome(order_id, True)
+
+    return build_response(200, [outcomes[order_id] for order_id in order_ids])
+
+
+def update_orders_status(event, context):
+    deliverer_id = extract_user_id(event)
+
+    order_ids, body, error_response = get_order_ids_from_body(event)
+    if error_response is not None:
+        return error_response
+
+    new_status = body.get("newStatus", OrderStatus.PICKED_UP.value)
+    if not is_valid_new_status(new_status):
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, f"Invalid new status: {new_status}"
+        )
+
+    order_statuses = get_order_statuses(dynamo, order_ids)
+
+    outcomes = {}
+    owned = []
+    for order_id in order_ids:
+        order_status = order_statuses.get(order_id)
+        if (
+            order_status is None
+            or "delivererId" not in order_status
+            or order_status["delivererId"] != deliverer_id
+        ):
+            outcomes[order_id] = build_bulk_outcome(order_id, False, "Order not found")
+        elif not is_valid_status_transition(order_status["orderStatus"], new_status):
+            outcomes[order_id] = build_bulk_outcome(
+                order_id, False, f"Invalid new status: {new_status}"
+            )
+        else:
+            owned.append(order_status)
+
+    if len(owned) > 0:
+        results = send_order_update_tasks(dynamo, owned, new_status, None, deliverer_id)
+        for order_id, message_id in results.items():
+            if message_id is None:
+                outcomes[order_id] = build_bulk_outcome(
+                    order_id, False, "Failed to update order"
+                )
+            else:
+                outcomes[order_id] = build_bulk_outcome(order_id, True)
+
+    return build_response(200, [outcomes[order_id] for order_id in order_ids])
+
+
 def lambda_handler(event, context):
     print(f"Received event: {event}")
     print(f"Context: {context}")
@@ -225,6 +494,10 @@ def lambda_handler(event, context):
             if httpMethod == "GET":
                 if resource == "/deliveries":
                     response = get_previous_orders(event, context)
+                elif resource == "/deliveries/export/{id}":
+                    response = get_previous_orders_export(event, context)
+                elif resource == "/deliveries/earnings":
+                    response = get_earnings_summary(event, context)
                 elif resource == "/deliveries/available":
                     response = get_available_orders(event, context)
                 elif resource == "/deliveries/{id}":
@@ -234,6 +507,12 @@ def lambda_handler(event, context):
                     response = secure_order(event, context)
                 elif resource == "/deliveries/{id}/status":
                     response = update_order_status(event, context)
+                elif resource == "/deliveries/secure":
+                    response = secure_orders(event, context)
+                elif resource == "/deliveries/status":
+                    response = update_orders_status(event, context)
+                elif resource == "/deliveries/export":
+                    response = export_previous_orders(event, context)
     except Exception as e:
         error_string = traceback.format_exc()
         print(error_string)
@@ -6,18 +6,25 @@ from decimal import Decimal
 
 import boto3
 from project_utility import (
+    LOCATION_SCHEMA,
+    PAYMENT_INFORMATION_SCHEMA,
     EnvironmentVariables,
     ErrorCodes,
     UserRole,
+    any_schema,
     build_error_response,
+    build_order_feed_token,
     build_response,
+    build_validation_error_response,
     extract_user_id,
     get_user_info,
     get_user_saved_data,
+    list_schema,
+    object_schema,
     serialize_to_dynamo_object,
+    string_schema,
     user_has_role,
-    validate_location,
-    validate_payment_information,
+    validate_schema,
 )
 
 # Clients
@@ -51,106 +58,49 @@ def get_validated_user_info(event, context):
     return build_response(200, validated_user_info)
 
 
-def validate_favorite_order_item(item, name):
-    # TODO - Should validate item validity
-    return True, item
-
-
-def validate_favorite_order(favorite, name):
-    validated_favorite = {"id": str(uuid.uuid4())}
+FAVORITE_ORDER_SCHEMA = object_schema(
+    {
+        "id": string_schema(),
+        "name": string_schema(),
+        # TODO - Should validate item validity
+        "items": list_schema(any_schema()),
+    },
+    required=["name", "items"],
+)
 
-    if "id" in favorite:
-        # TODO - Should match up old and new favorites
-        validated_favorite["id"] = str(favorite["id"])
+USER_DATA_SCHEMA = object_schema(
+    {
+        "locations": list_schema(LOCATION_SCHEMA),
+        "paymentMethods": list_schema(PAYMENT_INFORMATION_SCHEMA),
+        "favorites": list_schema(FAVORITE_ORDER_SCHEMA),
+    }
+)
 
-    if "name" in favorite:
-        validated_favorite["name"] = str(favorite["name"])
-    else:
-        return False, f"{name} must have a name"
-
-    if "items" in favorite:
-        validated_favorite_items = []
-        for index, item in enumerate(favorite["items"]):
-            is_valid, data = validate_favorite_order_item(
-                item, f"{name} Item {index + 1}"
-            )
-            if is_valid:
-                validated_favorite_items.append(data)
-            else:
-                return False, None, data
+USER_DATA_FIELDS = ["locations", "paymentMethods", "favorites"]
 
-        validated_favorite["items"] = validated_favorite_items
-    else:
-        return False, f"{name} must have items"
 
-    return True, validated_favorite
+def validate_user_data(user_id, input_data, existing_data):
+    print("Validating user data...")
 
+    input_user_data, errors = validate_schema(USER_DATA_SCHEMA, input_data)
+    if len(errors) > 0:
+        return False, None, errors
 
-def validate_user_data(user_id, input_data, existing_data):
     validated_user_data = {
         "id": user_id,
         "_lastUpdated": datetime.now(timezone.utc).isoformat(),
     }
 
-    print("Validating user data...")
-
-    if "locations" in input_data:
-        valid_locations = []
-        for index, location in enumerate(input_data["locations"]):
-            is_valid, data = validate_location(location, f"Saved Location {index + 1}")
-            if is_valid:
-                valid_locations.append(data)
-            else:
-                return False, None, data
-
-        validated_user_data["locations"] = valid_locations
-    elif existing_data is not None and "locations" in existing_data:
-        validated_user_data["locations"] = existing_data["locations"]
-
-    if "paymentMethods" in input_data:
-        valid_payment_methods = []
-        for index, payment_method in enumerate(input_data["paymentMethods"]):
-            is_valid, data = validate_payment_information(
-                payment_method, f"Saved Payment {index + 1}"
-            )
-            if is_valid:
-                valid_payment_methods.append(data)
-            else:
-                return False, None, data
-
-        validated_user_data["paymentMethods"] = valid_payment_methods
-    elif existing_data is not None and "paymentMethods" in existing_data:
-        validated_user_data["paymentMethods"] = existing_data["paymentMethods"]
-
-    if "paymentMethods" in input_data:
-        valid_payment_methods = []
-        for index, payment_method in enumerate(input_data["paymentMethods"]):
-            is_valid, data = validate_payment_information(
-                payment_method, f"Saved Payment {index + 1}"
-            )
-            if is_valid:
-                valid_payment_methods.append(data)
-            else:
-                return False, None, data
-
-        validated_user_data["paymentMethods"] = valid_payment_methods
-    elif existing_data is not None and "paymentMethods" in existing_data:
-        validated_user_data["paymentMethods"] = existing_data["paymentMethods"]
-
-    if "favorites" in input_data:
-        valid_favorites = []
-        for index, favorite in enumerate(input_data["favorites"]):
-            is_valid, data = validate_favorite_order(
-                favorite, f"Favorite Order {index + 1}"
-            )
-            if is_valid:
-                valid_favorites.append(data)
-            else:
-                return False, None, data
+    for field in USER_DATA_FIELDS:
+        if field in input_user_data:
+            validated_user_data[field] = input_user_data[field]
+        elif existing_data is not None and field in existing_data:
+            validated_user_data[field] = existing_data[field]
 
-        validated_user_data["favorites"] = valid_favorites
-    elif existing_data is not None and "favorites" in existing_data:
-        validated_user_data["favorites"] = existing_data["favorites"]
+    # TODO - Should match up old and new favorites
+    for favorite in validated_user_data.get("favorites", []):
+        if "id" not in favorite:
+            favorite["id"] = str(uuid.uuid4())
 
     print("Validated", validated_user_data)
     return True, validated_user_data, "Validated"
@@ -170,7 +120,7 @@ def update_user_data(event, context):
 
     input_data = json.loads(event["body"], parse_float=Decimal)
     existing_data = get_user_saved_data(dynamo, user_id)
-    is_valid, data, message = validate_user_data(user_id, input_data, existing_data)
+    is_valid, data, errors = validate_user_data(user_id, input_data, existing_data)
 
     if is_valid:
         dynamo.put_item(
@@ -183,7 +133,13 @@ def update_user_data(event, context):
             validated_user_info[key] = data[key]
         return build_response(200, validated_user_info)
     else:
-        return build_error_response(ErrorCodes.INVALID_DATA, message)
+        return build_validation_error_response(errors)
+
+
+def get_order_feed_token(event, context):
+    user_id = extract_user_id(event)
+    token, expires_at = build_order_feed_token(user_id)
+    return build_response(200, {"token": token, "expiresAt": expires_at})
 
 
 def lambda_handler(event, context):
@@ -207,6 +163,8 @@ def lambda_handler(event, context):
                 response = build_error_response(
                     ErrorCodes.NOT_AUTHORIZED, "You must sign up to be a customer!"
                 )
+        elif httpMethod == "GET" and resource == "/user/feed-token":
+            response = get_order_feed_token(event, context)
 
     except Exception as e:
         error_string = traceback.format_exc()
@@ -0,0 +1,116 @@
+"""Adds ratings saved before the product rating aggregates existed to the aggregates.
+
+Each unflagged rating is added to its product and flagged in one transaction,
+so it is counted once even while customers keep rating. Ratings changed while
+the scan runs are skipped, the orders function counts them when it saves them.
+Re-running only picks up ratings that are still unflagged.
+
+Usage: python aggregate_order_ratings.py --ratings-table ORDER_RATINGS_TABLE
+           --product-ratings-table PRODUCT_RATINGS_TABLE [--dry-run]
+"""
+import argparse
+import os
+import sys
+
+LAMBDA_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(LAMBDA_DIRECTORY, "benchmarks"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ratings-table", required=True)
+    parser.add_argument("--product-ratings-table", required=True)
+    parser.add_argument("--dry-run", action="store_true")
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ["ORDER_RATINGS_TABLE"] = args.ratings_table
+os.environ["PRODUCT_RATINGS_TABLE"] = args.product_ratings_table
+
+# Placeholders for the variables project_utility reads but the migration never uses
+import benchmark_environment  # noqa: E402,F401
+import boto3  # noqa: E402
+from project_utility import (  # noqa: E402
+    RATING_AGGREGATED_FIELD,
+    build_product_rating_aggregate_update,
+)
+
+dynamo = boto3.client("dynamodb")
+
+
+def aggregate_rating(raw_rating):
+    if "productId" not in raw_rating:
+        print(
+            f"Skipping rating {raw_rating['orderId']['S']}/{raw_rating['orderItemId']['S']}"
+            " without a product"
+        )
+        return False
+    if args.dry_run:
+        return True
+
+    try:
+        dynamo.transact_write_items(
+            TransactItems=[
+                {
+                    "Update": {
+                        "Key": {
+                            "orderId": raw_rating["orderId"],
+                            "orderItemId": raw_rating["orderItemId"],
+                        },
+                        "TableName": args.ratings_table,
+                        "UpdateExpression": "SET #AGGREGATED = :aggregated",
+                        "ConditionExpression": "rating = :rating AND attribute_not_exists(#AGGREGATED)",
+                        "ExpressionAttributeNames": {
+                            "#AGGREGATED": RATING_AGGREGATED_FIELD,
+                        },
+                        "ExpressionAttributeValues": {
+                            ":aggregated": {
+                                "BOOL": True,
+                            },
+                            ":rating": raw_rating["rating"],
+                        },
+                    }
+                },
+                {
+                    "Update": build_product_rating_aggregate_update(
+                        raw_rating["productId"]["S"],
+                        None,
+                        int(raw_rating["rating"]["N"]),
+                    )
+                },
+            ]
+        )
+        return True
+    except dynamo.exceptions.TransactionCanceledException:
+        return False
+
+
+def main():
+    scan_args = {
+        "TableName": args.ratings_table,
+        "FilterExpression": "attribute_not_exists(#AGGREGATED)",
+        "ExpressionAttributeNames": {
+            "#AGGREGATED": RATING_AGGREGATED_FIELD,
+        },
+    }
+
+    aggregated = 0
+    skipped = 0
+    while True:
+        response = dynamo.scan(**scan_args)
+        for raw_rating in response["Items"]:
+            if aggregate_rating(raw_rating):
+                aggregated += 1
+            else:
+                skipped += 1
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    action = "Would aggregate" if args.dry_run else "Aggregated"
+    print(f"{action} {aggregated} rating(s), skipped {skipped}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Rewrites orders stored with expanded items into the compact item format.
+
+Orders are read and written in either format, so this can run while the
+service is live and be re-run safely. Orders changed since they were scanned
+are skipped and picked up by the next run or by order-update, which compacts
+every order it saves.
+
+Usage: python compact_order_items.py --table ORDERS_TABLE [--segments N] [--dry-run]
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+LAMBDA_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(LAMBDA_DIRECTORY, "benchmarks"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", required=True)
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true")
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ["ORDERS_TABLE"] = args.table
+
+# Placeholders for the variables project_utility reads but the migration never uses
+import benchmark_environment  # noqa: E402,F401
+import boto3  # noqa: E402
+from project_utility import (  # noqa: E402
+    ORDER_FORMAT_FIELD,
+    compact_order,
+    deserialize_dynamo_object,
+    serialize_to_dynamo_object,
+)
+
+dynamo = boto3.client("dynamodb")
+
+
+def compact_raw_order(raw_order):
+    order = deserialize_dynamo_object(raw_order)
+    compacted = compact_order(order)
+    if args.dry_run:
+        return True
+
+    version = order.get("version")
+    if version is None:
+        version_condition = "attribute_not_exists(version)"
+        version_values = {}
+    else:
+        version_condition = "version = :version"
+        version_values = {":version": {"N": str(version)}}
+
+    updated = serialize_to_dynamo_object(
+        {"items": compacted["items"], "format": compacted[ORDER_FORMAT_FIELD]}
+    )
+    try:
+        dynamo.update_item(
+            TableName=args.table,
+            Key={
+                "customerId": raw_order["customerId"],
+                "id": raw_order["id"],
+            },
+            UpdateExpression="SET #ITEMS = :items, #FMT = :format",
+            ConditionExpression=f"attribute_not_exists(#FMT) AND {version_condition}",
+            ExpressionAttributeNames={
+                "#ITEMS": "items",
+                "#FMT": ORDER_FORMAT_FIELD,
+            },
+            ExpressionAttributeValues={
+                ":items": updated["items"],
+                ":format": updated["format"],
+                **version_values,
+            },
+        )
+        return True
+    except dynamo.exceptions.ConditionalCheckFailedException:
+        print(f"Order {raw_order['id']['S']} changed during migration, skipping")
+        return False
+
+
+def migrate_segment(segment):
+    scan_args = {
+        "TableName": args.table,
+        "Segment": segment,
+        "TotalSegments": args.segments,
+        "FilterExpression": "attribute_exists(#ITEMS) AND attribute_not_exists(#FMT)",
+        "ExpressionAttributeNames": {
+            "#ITEMS": "items",
+            "#FMT": ORDER_FORMAT_FIELD,
+        },
+    }
+
+    migrated = 0
+    skipped = 0
+    while True:
+        response = dynamo.scan(**scan_args)
+        for raw_order in response["Items"]:
+            if compact_raw_order(raw_order):
+                migrated += 1
+            else:
+                skipped += 1
+        if "LastEvaluatedKey" not in response:
+            return migrated, skipped
+        scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def main():
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        results = list(executor.map(migrate_segment, range(args.segments)))
+
+    migrated = sum(result[0] for result in results)
+    skipped = sum(result[1] for result in results)
+    action = "Would compact" if args.dry_run else "Compacted"
+    print(f"{action} {migrated} order(s), skipped {skipped}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Brings the sharded order status counters in line with the order-status table.
+
+Counts every order per status with a scan and adds the difference to the
+counter shards, so orders created before the counters existed are included.
+Status changes made while the scan runs can leave a small drift, so run it
+when traffic is low. Re-running corrects any remaining drift.
+
+Usage: python reconcile_order_status_counters.py --status-table ORDER_STATUS_TABLE
+           --counters-table ORDER_STATUS_COUNTERS_TABLE [--dry-run]
+"""
+import argparse
+import os
+import sys
+
+LAMBDA_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(LAMBDA_DIRECTORY, "benchmarks"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--status-table", required=True)
+    parser.add_argument("--counters-table", required=True)
+    parser.add_argument("--dry-run", action="store_true")
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ["ORDER_STATUS_COUNTERS_TABLE"] = args.counters_table
+
+# Placeholders for the variables project_utility reads but the migration never uses
+import benchmark_environment  # noqa: E402,F401
+import boto3  # noqa: E402
+from project_utility import (  # noqa: E402
+    get_order_status_counts,
+    is_counted_order_status,
+)
+
+dynamo = boto3.client("dynamodb")
+
+
+def count_statuses():
+    scan_args = {
+        "TableName": args.status_table,
+        "ProjectionExpression": "orderStatus",
+    }
+
+    counts = {}
+    while True:
+        response = dynamo.scan(**scan_args)
+        for row in response["Items"]:
+            status = row.get("orderStatus", {}).get("S")
+            if is_counted_order_status(status):
+                counts[status] = counts.get(status, 0) + 1
+        if "LastEvaluatedKey" not in response:
+            return counts
+        scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def main():
+    actual_counts = count_statuses()
+    counter_counts = get_order_status_counts(dynamo)
+
+    for status, counted in counter_counts.items():
+        actual = actual_counts.get(status, 0)
+        difference = actual - counted
+        print(f"{status}: {actual} order(s), counters say {counted}")
+        if difference == 0 or args.dry_run:
+            continue
+
+        dynamo.update_item(
+            TableName=args.counters_table,
+            Key={
+                "orderStatus": {
+                    "S": status,
+                },
+                "shard": {
+                    "N": "0",
+                },
+            },
+            UpdateExpression="ADD orderCount :delta",
+            ExpressionAttributeValues={
+                ":delta": {
+                    "N": str(difference),
+                },
+            },
+        )
+        print(f"Adjusted {status} by {difference}")
+
+
+if __name__ == "__main__":
+    main()
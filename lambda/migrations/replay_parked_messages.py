@@ -0,0 +1,86 @@
+"""Sends parked messages back to the queue they were consumed from.
+
+Use it once whatever made the messages fail has been fixed. Each message is
+removed from the parked-messages table after it has been re-sent.
+
+Usage: python replay_parked_messages.py --table PARKED_MESSAGES_TABLE
+           --queue-name QUEUE_NAME [--message-id ID ...] [--dry-run]
+"""
+import argparse
+import os
+import sys
+
+LAMBDA_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(LAMBDA_DIRECTORY, "benchmarks"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", required=True)
+    parser.add_argument("--queue-name", required=True)
+    parser.add_argument("--message-id", action="append", default=[])
+    parser.add_argument("--dry-run", action="store_true")
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ["PARKED_MESSAGES_TABLE"] = args.table
+
+# Placeholders for the variables project_utility reads but the migration never uses
+import benchmark_environment  # noqa: E402,F401
+import boto3  # noqa: E402
+from project_utility import query_all_items  # noqa: E402
+
+dynamo = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
+
+
+def get_parked_messages():
+    parked_messages = query_all_items(
+        dynamo,
+        {
+            "TableName": args.table,
+            "KeyConditionExpression": "queueName = :queue_name",
+            "ExpressionAttributeValues": {
+                ":queue_name": {
+                    "S": args.queue_name,
+                },
+            },
+        },
+    )
+    if len(args.message_id) > 0:
+        parked_messages = [
+            parked_message
+            for parked_message in parked_messages
+            if parked_message["messageId"]["S"] in args.message_id
+        ]
+    return parked_messages
+
+
+def main():
+    parked_messages = get_parked_messages()
+    action = "Would replay" if args.dry_run else "Replaying"
+    print(f"{action} {len(parked_messages)} message(s) to {args.queue_name}")
+    if args.dry_run:
+        for parked_message in parked_messages:
+            print(
+                f"{parked_message['messageId']['S']}: {parked_message['reason']['S']}"
+                f" {parked_message['errorType']['S']}: {parked_message['errorMessage']['S']}"
+            )
+        return
+
+    queue_url = sqs.get_queue_url(QueueName=args.queue_name)["QueueUrl"]
+    for parked_message in parked_messages:
+        sqs.send_message(QueueUrl=queue_url, MessageBody=parked_message["body"]["S"])
+        dynamo.delete_item(
+            TableName=args.table,
+            Key={
+                "queueName": parked_message["queueName"],
+                "messageId": parked_message["messageId"],
+            },
+        )
+    print(f"Replayed {len(parked_messages)} message(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Schedules archival of orders and statuses delivered before archiving existed.
+
+Each row is due the configured number of days after it was last updated.
+Orders already past that are due now, so the next archive job run moves them
+to the archive table. Orders that only have an archiveAt get the matching
+archiveBucket. Re-running skips rows that are already scheduled.
+
+Usage: python schedule_order_archival.py --orders-table ORDERS_TABLE
+           --status-table ORDER_STATUS_TABLE --age-days DAYS [--dry-run]
+"""
+import argparse
+import os
+import sys
+import time
+
+LAMBDA_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(LAMBDA_DIRECTORY, "benchmarks"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders-table", required=True)
+    parser.add_argument("--status-table", required=True)
+    parser.add_argument("--age-days", type=int, required=True)
+    parser.add_argument("--dry-run", action="store_true")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Placeholders for the variables project_utility reads but the migration never uses
+import benchmark_environment  # noqa: E402,F401
+import boto3  # noqa: E402
+from project_utility import (  # noqa: E402
+    ORDER_ARCHIVE_AT_FIELD,
+    ORDER_ARCHIVE_BUCKET_FIELD,
+    OrderStatus,
+    build_order_archive_bucket,
+)
+
+dynamo = boto3.client("dynamodb")
+
+
+def schedule_table(table_name, key_fields, with_bucket):
+    if with_bucket:
+        scheduled_field = ORDER_ARCHIVE_BUCKET_FIELD
+    else:
+        scheduled_field = ORDER_ARCHIVE_AT_FIELD
+    scan_args = {
+        "TableName": table_name,
+        "FilterExpression": "orderStatus = :delivered AND attribute_not_exists(#SCHEDULED)",
+        "ExpressionAttributeNames": {
+            "#SCHEDULED": scheduled_field,
+        },
+        "ExpressionAttributeValues": {
+            ":delivered": {
+                "S": OrderStatus.DELIVERED.value,
+            },
+        },
+    }
+
+    scheduled = 0
+    while True:
+        response = dynamo.scan(**scan_args)
+        for row in response["Items"]:
+            if ORDER_ARCHIVE_AT_FIELD in row:
+                archive_at = int(row[ORDER_ARCHIVE_AT_FIELD]["N"])
+            else:
+                updated_at_seconds = int(row.get("updatedAt", {"N": "0"})["N"]) // 1000
+                archive_at = updated_at_seconds + args.age_days * 24 * 60 * 60
+            if with_bucket:
+                # The archive job only looks back a few days, so overdue orders are due now
+                archive_at = max(archive_at, int(time.time()))
+            scheduled += 1
+            if args.dry_run:
+                continue
+
+            update_expression = "SET #ARCHIVE_AT = :archive_at"
+            expression_names = {
+                "#ARCHIVE_AT": ORDER_ARCHIVE_AT_FIELD,
+            }
+            expression_values = {
+                ":archive_at": {
+                    "N": str(archive_at),
+                },
+                ":delivered": {
+                    "S": OrderStatus.DELIVERED.value,
+                },
+            }
+            if with_bucket:
+                update_expression = f"{update_expression}, #BUCKET = :bucket"
+                expression_names["#BUCKET"] = ORDER_ARCHIVE_BUCKET_FIELD
+                expression_values[":bucket"] = {
+                    "S": build_order_archive_bucket(archive_at),
+                }
+
+            try:
+                dynamo.update_item(
+                    TableName=table_name,
+                    Key={field: row[field] for field in key_fields},
+                    UpdateExpression=update_expression,
+                    ConditionExpression="orderStatus = :delivered",
+                    ExpressionAttributeNames=expression_names,
+                    ExpressionAttributeValues=expression_values,
+                )
+            except dynamo.exceptions.ConditionalCheckFailedException:
+                scheduled -= 1
+        if "LastEvaluatedKey" not in response:
+            return scheduled
+        scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def main():
+    action = "Would schedule" if args.dry_run else "Scheduled"
+    orders = schedule_table(args.orders_table, ["customerId", "id"], True)
+    print(f"{action} {orders} order(s) for archival")
+    statuses = schedule_table(args.status_table, ["id"], False)
+    print(f"{action} {statuses} status(es) for archival")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import traceback
+
+import boto3
+from project_utility import (
+    ErrorCodes,
+    UserRole,
+    build_error_response,
+    build_response,
+    extract_user_id,
+    get_order_status_counts,
+    user_has_role,
+)
+
+# Clients
+dynamo = boto3.client("dynamodb")
+
+
+def get_order_counts(event, context):
+    print("Summing order status counters...")
+    counts = get_order_status_counts(dynamo)
+    return build_response(
+        200,
+        {
+            "counts": counts,
+            "total": sum(counts.values()),
+        },
+    )
+
+
+def lambda_handler(event, context):
+    print(f"Received event: {event}")
+    print(f"Context: {context}")
+
+    try:
+        if not user_has_role(extract_user_id(event), UserRole.ADMIN):
+            response = build_error_response(
+                ErrorCodes.NOT_AUTHORIZED, "You are not an admin!"
+            )
+        else:
+            httpMethod = event["httpMethod"]
+            resource = event["resource"]
+
+            response = build_error_response(
+                ErrorCodes.UNKNOWN_ERROR,
+                f"Unknown resource: {httpMethod} {resource}",
+            )
+
+            if httpMethod == "GET":
+                if resource == "/operations/order-counts":
+                    response = get_order_counts(event, context)
+    except Exception as e:
+        error_string = traceback.format_exc()
+        print(error_string)
+        response = build_error_response(ErrorCodes.UNKNOWN_ERROR, "Internal Exception")
+
+    print("Response", response)
+    return response
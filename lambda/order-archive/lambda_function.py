@@ -0,0 +1,143 @@
+import time
+import traceback
+
+import boto3
+from project_utility import (
+    ORDER_ARCHIVE_AT_FIELD,
+    ORDER_ARCHIVE_BUCKET_FIELD,
+    EnvironmentVariables,
+    build_order_archive_bucket,
+    has_time_for,
+)
+
+# Clients
+dynamo = boto3.client("dynamodb")
+
+# Constants
+ORDER_ARCHIVE_INDEX = "archiveBucket-archiveAt-index"
+# Days behind today still queried, so a few failed runs don't strand orders
+ORDER_ARCHIVE_LOOKBACK_DAYS = 7
+# Time one order takes to copy and delete, runs stop early and the next run continues
+ORDER_ARCHIVE_COST_MILLIS = 200
+HOT_ONLY_FIELDS = [
+    ORDER_ARCHIVE_AT_FIELD,
+    ORDER_ARCHIVE_BUCKET_FIELD,
+    "scheduleBucket",
+    "areaBucket",
+]
+
+
+def get_due_buckets(now):
+    return [
+        build_order_archive_bucket(now - days * 24 * 60 * 60)
+        for days in range(ORDER_ARCHIVE_LOOKBACK_DAYS, -1, -1)
+    ]
+
+
+def build_archived_order(order):
+    archived_order = dict(order)
+    for field in HOT_ONLY_FIELDS:
+        archived_order.pop(field, None)
+    return archived_order
+
+
+def archive_order(key, now):
+    response = dynamo.get_item(
+        TableName=EnvironmentVariables.ORDERS_TABLE.value,
+        Key=key,
+        ConsistentRead=True,
+    )
+    order = response["Item"] if "Item" in response else None
+    if order is None or ORDER_ARCHIVE_AT_FIELD not in order:
+        return False
+    if int(order[ORDER_ARCHIVE_AT_FIELD]["N"]) > now:
+        return False
+
+    # Copy first, so the order is never missing from both tables
+    dynamo.put_item(
+        TableName=EnvironmentVariables.ORDER_ARCHIVE_TABLE.value,
+        Item=build_archived_order(order),
+    )
+
+    if "version" in order:
+        delete_condition = {
+            "ConditionExpression": "version = :version",
+            "ExpressionAttributeValues": {
+                ":version": order["version"],
+            },
+        }
+    else:
+        delete_condition = {
+            "ConditionExpression": "attribute_not_exists(version)",
+        }
+
+    try:
+        dynamo.delete_item(
+            TableName=EnvironmentVariables.ORDERS_TABLE.value,
+            Key=key,
+            **delete_condition,
+        )
+    except dynamo.exceptions.ConditionalCheckFailedException:
+        # Changed after the copy, the next run copies the new version again
+        print(f"Order {key['id']['S']} changed while archiving, keeping it")
+        return False
+    return True
+
+
+def archive_due_orders(context):
+    now = int(time.time())
+    archived = 0
+    for bucket in get_due_buckets(now):
+        query_args = {
+            "TableName": EnvironmentVariables.ORDERS_TABLE.value,
+            "IndexName": ORDER_ARCHIVE_INDEX,
+            "KeyConditionExpression": "#BUCKET = :bucket AND #ARCHIVE_AT <= :now",
+            "ExpressionAttributeNames": {
+                "#BUCKET": ORDER_ARCHIVE_BUCKET_FIELD,
+                "#ARCHIVE_AT": ORDER_ARCHIVE_AT_FIELD,
+            },
+            "ExpressionAttributeValues": {
+                ":bucket": {
+                    "S": bucket,
+                },
+                ":now": {
+                    "N": str(now),
+                },
+            },
+        }
+        while True:
+            response = dynamo.query(**query_args)
+            for key in response["Items"]:
+                if not has_time_for(context, ORDER_ARCHIVE_COST_MILLIS):
+                    print(f"Stopping early after archiving {archived} order(s)")
+                    return archived
+                order_key = {
+                    "customerId": key["customerId"],
+                    "id": key["id"],
+                }
+                if archive_order(order_key, now):
+                    archived += 1
+            if "LastEvaluatedKey" not in response:
+                break
+            query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    print(f"Archived {archived} order(s)")
+    return archived
+
+
+def lambda_handler(event, context):
+    print(f"Received event: {event}")
+    print(f"Context: {context}")
+
+    response = {}
+
+    try:
+        response["archived"] = archive_due_orders(context)
+    except Exception:
+        error_string = traceback.format_exc()
+        print(error_string)
+        # Fail the invocation so it shows up in the function error metrics
+        raise
+
+    print("Response", response)
+    return response
@@ -0,0 +1,153 @@
+import json
+import traceback
+
+import boto3
+from project_utility import (
+    EXPORT_OWNER_CUSTOMERS,
+    EXPORT_OWNER_DELIVERERS,
+    EXPORT_OWNER_SHOPS,
+    EXPORT_STATUS_COMPLETE,
+    EXPORT_STATUS_FAILED,
+    ORDERS_CUSTOMER_UPDATED_AT_INDEX,
+    ORDERS_DELIVERER_UPDATED_AT_INDEX,
+    ORDERS_SHOP_UPDATED_AT_INDEX,
+    SQS_MAX_RECEIVES,
+    EnvironmentVariables,
+    PermanentError,
+    build_export_key,
+    build_projection_expression,
+    deserialize_dynamo_object,
+    expand_order_items,
+    get_receive_count,
+    is_permanent_error,
+    process_sqs_batch,
+    query_order_history_pages,
+    require_message_fields,
+    write_ndjson_export,
+)
+
+# Clients
+dynamo = boto3.client("dynamodb")
+s3 = boto3.client("s3")
+sqs = boto3.client("sqs")
+
+# Constants
+EXPORT_OWNER_INDEXES = {
+    EXPORT_OWNER_CUSTOMERS: (ORDERS_CUSTOMER_UPDATED_AT_INDEX, "customerId"),
+    EXPORT_OWNER_SHOPS: (ORDERS_SHOP_UPDATED_AT_INDEX, "shopId"),
+    EXPORT_OWNER_DELIVERERS: (ORDERS_DELIVERER_UPDATED_AT_INDEX, "delivererId"),
+}
+
+
+def build_export_records(items, fields):
+    for item in items:
+        order = expand_order_items(dynamo, deserialize_dynamo_object(item))
+        yield {field: order[field] for field in fields if field in order}
+
+
+def update_export_status(owner_id, export_id, status, field_updates):
+    update_expression = "SET exportStatus = :status"
+    expression_values = {
+        ":status": {
+            "S": status,
+        },
+    }
+    for key, value in field_updates.items():
+        update_expression = f"{update_expression}, {key} = :{key}"
+        expression_values[f":{key}"] = value
+
+    dynamo.update_item(
+        TableName=EnvironmentVariables.ORDER_EXPORTS_TABLE.value,
+        Key={
+            "ownerId": {
+                "S": owner_id,
+            },
+            "id": {
+                "S": export_id,
+            },
+        },
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_values,
+    )
+
+
+def run_export(message):
+    owner_type = message["ownerType"]
+    owner_id = message["ownerId"]
+    fields = message["fields"]
+    if owner_type not in EXPORT_OWNER_INDEXES:
+        raise PermanentError(f"Unknown export owner type {owner_type}")
+    index_name, owner_field = EXPORT_OWNER_INDEXES[owner_type]
+
+    print(f"Exporting orders for {owner_type} {owner_id}")
+    projection_expression, expression_names = build_projection_expression(fields)
+    pages = query_order_history_pages(
+        dynamo,
+        index_name,
+        owner_field,
+        owner_id,
+        message.get("since"),
+        projection_expression,
+        expression_names,
+    )
+    records = (
+        record for page in pages for record in build_export_records(page, fields)
+    )
+
+    key = build_export_key(owner_type, owner_id)
+    count = write_ndjson_export(s3, key, records)
+    update_export_status(
+        owner_id,
+        message["exportId"],
+        EXPORT_STATUS_COMPLETE,
+        {
+            "exportKey": {
+                "S": key,
+            },
+            "orderCount": {
+                "N": str(count),
+            },
+        },
+    )
+
+
+def process_message(record):
+    message_id = record["messageId"]
+    message_body = json.loads(record["body"])
+
+    print(f"Processing message {message_id}...")
+
+    require_message_fields(message_body, ["exportId", "ownerType", "ownerId", "fields"])
+    try:
+        run_export(message_body)
+    except Exception as e:
+        # The message is parked after this, so the job must not stay pending
+        if is_permanent_error(e) or get_receive_count(record) >= SQS_MAX_RECEIVES:
+            update_export_status(
+                message_body["ownerId"],
+                message_body["exportId"],
+                EXPORT_STATUS_FAILED,
+                {},
+            )
+        raise
+
+    print(f"Processed message {message_id}")
+
+
+def lambda_handler(event, context):
+    print(f"Received event: {event}")
+    print(f"Context: {context}")
+
+    response = {}
+
+    try:
+        if event:
+            response["batchItemFailures"] = process_sqs_batch(
+                event["Records"], context, process_message, dynamo, sqs
+            )
+    except Exception as e:
+        error_string = traceback.format_exc()
+        print(error_string)
+
+    print("Response", response)
+    return response
@@ -0,0 +1,291 @@
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from project_utility import (
+    EnvironmentVariables,
+    OrderStatus,
+    PermanentError,
+    UserNotificationTypes,
+    UserRole,
+    get_query_parameter,
+    get_shop_by_id,
+    get_user_saved_data,
+    get_zip_area,
+    process_sqs_batch,
+    query_all_items,
+    require_message_fields,
+    serialize_to_dynamo_object,
+    user_has_role,
+    verify_order_feed_token,
+)
+
+# Clients
+dynamo = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
+management_clients = {}
+
+# Constants
+CONNECTION_TTL_SECONDS = 2 * 60 * 60
+MAX_WORKERS = 8
+FEED_ROLE_INDEX = "feedRole-index"
+USER_ID_INDEX = "userId-index"
+
+FEED_ROLES = [
+    UserRole.REGULAR_USER.value,
+    UserRole.SHOP_OWNER.value,
+    UserRole.DELIVERER.value,
+]
+
+# Statuses that make an order available (True) or unavailable (False) to a role
+AVAILABILITY_CHANGES = {
+    UserRole.SHOP_OWNER.value: {
+        OrderStatus.RECEIVED.value: True,
+        OrderStatus.BREWING.value: False,
+    },
+    UserRole.DELIVERER.value: {
+        OrderStatus.MADE.value: True,
+        OrderStatus.AWAITING_PICKUP.value: False,
+    },
+}
+
+ORDER_STATUS_UPDATE_EVENT = "ORDER_STATUS_UPDATE"
+ORDER_AVAILABILITY_EVENT = "ORDER_AVAILABILITY"
+ORDER_OFFER_EVENT = "ORDER_OFFER"
+
+
+def get_management_client(callback_url):
+    if callback_url not in management_clients:
+        management_clients[callback_url] = boto3.client(
+            "apigatewaymanagementapi", endpoint_url=callback_url
+        )
+    return management_clients[callback_url]
+
+
+def build_ok_response():
+    return {"statusCode": 200}
+
+
+def get_connection_area(event, user_id, role):
+    # The area lets the matching service rank connected shops and deliverers
+    if role == UserRole.SHOP_OWNER.value:
+        shop_info = get_shop_by_id(dynamo, user_id)
+        return get_zip_area(shop_info.get("location")) if shop_info else None
+    elif role == UserRole.DELIVERER.value:
+        zip_code = get_query_parameter(event, "zip", None)
+        if zip_code is not None:
+            return get_zip_area({"zip": zip_code})
+
+        saved_data = get_user_saved_data(dynamo, user_id)
+        locations = saved_data.get("locations", []) if saved_data else []
+        return get_zip_area(locations[0]) if len(locations) > 0 else None
+    else:
+        return None
+
+
+def connect(event, context):
+    # Browsers can't set the API key header here, so callers pass a feed token
+    user_id = verify_order_feed_token(get_query_parameter(event, "token", None))
+    if user_id is None:
+        print("Rejecting connection without a valid feed token")
+        return {"statusCode": 401}
+
+    role = str(get_query_parameter(event, "role", UserRole.REGULAR_USER.value)).upper()
+
+    if role not in FEED_ROLES or not user_has_role(user_id, UserRole(role)):
+        print(f"User {user_id} cannot subscribe to the {role} feed")
+        return {"statusCode": 401}
+
+    request_context = event["requestContext"]
+    connection = {
+        "connectionId": request_context["connectionId"],
+        "userId": user_id,
+        "feedRole": role,
+        "callbackUrl": f"https://{request_context['domainName']}/{request_context['stage']}",
+        "expiresAt": int(time.time()) + CONNECTION_TTL_SECONDS,
+    }
+
+    area = get_connection_area(event, user_id, role)
+    if area is not None:
+        connection["area"] = area
+
+    print("Saving connection", connection)
+    dynamo.put_item(
+        TableName=EnvironmentVariables.ORDER_FEED_CONNECTIONS_TABLE.value,
+        Item=serialize_to_dynamo_object(connection),
+    )
+    return build_ok_response()
+
+
+def remove_connection(connection_id):
+    print(f"Removing connection {connection_id}")
+    dynamo.delete_item(
+        TableName=EnvironmentVariables.ORDER_FEED_CONNECTIONS_TABLE.value,
+        Key={
+            "connectionId": {
+                "S": connection_id,
+            },
+        },
+    )
+
+
+def disconnect(event, context):
+    remove_connection(event["requestContext"]["connectionId"])
+    return build_ok_response()
+
+
+def get_role_connections(role):
+    return query_all_items(
+        dynamo,
+        {
+            "TableName": EnvironmentVariables.ORDER_FEED_CONNECTIONS_TABLE.value,
+            "IndexName": FEED_ROLE_INDEX,
+            "KeyConditionExpression": "feedRole = :feedRole",
+            "ExpressionAttributeValues": {
+                ":feedRole": {
+                    "S": role,
+                },
+            },
+        },
+    )
+
+
+def get_user_connections(user_id, role):
+    return query_all_items(
+        dynamo,
+        {
+            "TableName": EnvironmentVariables.ORDER_FEED_CONNECTIONS_TABLE.value,
+            "IndexName": USER_ID_INDEX,
+            "KeyConditionExpression": "userId = :userId",
+            "FilterExpression": "feedRole = :feedRole",
+            "ExpressionAttributeValues": {
+                ":userId": {
+                    "S": user_id,
+                },
+                ":feedRole": {
+                    "S": role,
+                },
+            },
+        },
+    )
+
+
+def post_to_connection(connection, data):
+    connection_id = connection["connectionId"]["S"]
+    client = get_management_client(connection["callbackUrl"]["S"])
+    try:
+        client.post_to_connection(ConnectionId=connection_id, Data=data)
+    except client.exceptions.GoneException:
+        remove_connection(connection_id)
+
+
+def broadcast(connections, feed_event):
+    if len(connections) == 0:
+        return
+
+    print(f"Sending {feed_event['type']} to {len(connections)} connection(s)")
+    data = json.dumps(feed_event).encode("utf-8")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Consume results so any unexpected error fails the record
+        list(
+            executor.map(lambda connection: post_to_connection(connection, data), connections)
+        )
+
+
+def publish_order_status_update(message):
+    customer_id = message["customerId"]
+    order_id = message["orderId"]
+    order_status = message["orderStatus"]
+
+    broadcast(
+        get_user_connections(customer_id, UserRole.REGULAR_USER.value),
+        {
+            "type": ORDER_STATUS_UPDATE_EVENT,
+            "orderId": order_id,
+            "orderStatus": order_status,
+        },
+    )
+
+    for role, changes in AVAILABILITY_CHANGES.items():
+        if order_status in changes:
+            broadcast(
+                get_role_connections(role),
+                {
+                    "type": ORDER_AVAILABILITY_EVENT,
+                    "orderId": order_id,
+                    "orderStatus": order_status,
+                    "available": changes[order_status],
+                },
+            )
+
+
+def publish_order_offer(message):
+    broadcast(
+        get_user_connections(message["targetUserId"], message["feedRole"]),
+        {
+            "type": ORDER_OFFER_EVENT,
+            "orderId": message["orderId"],
+            "orderStatus": message["orderStatus"],
+            "expiresAt": message["expiresAt"],
+        },
+    )
+
+
+def process_message(record):
+    message_id = record["messageId"]
+    message_body = json.loads(record["body"])
+
+    print(f"Processing message {message_id}...")
+
+    message_type = message_body["type"] if "type" in message_body else None
+    if message_type == UserNotificationTypes.ORDER_STATUS_UPDATE.type_code:
+        require_message_fields(message_body, ["customerId", "orderId", "orderStatus"])
+        publish_order_status_update(message_body)
+    elif message_type == UserNotificationTypes.ORDER_OFFER.type_code:
+        require_message_fields(
+            message_body,
+            ["targetUserId", "feedRole", "orderId", "orderStatus", "expiresAt"],
+        )
+        publish_order_offer(message_body)
+    else:
+        print(f"Unknown message type: {message_type}")
+        raise PermanentError("Unknown message type")
+
+    print(f"Processed message {message_id}")
+
+
+def process_records(event, context):
+    return {
+        "batchItemFailures": process_sqs_batch(
+            event["Records"], context, process_message, dynamo, sqs
+        )
+    }
+
+
+def lambda_handler(event, context):
+    print(f"Received event: {event}")
+    print(f"Context: {context}")
+
+    response = {}
+
+    try:
+        if event and "Records" in event:
+            response = process_records(event, context)
+        else:
+            route_key = event["requestContext"]["routeKey"]
+            response = build_ok_response()
+
+            if route_key == "$connect":
+                response = connect(event, context)
+            elif route_key == "$disconnect":
+                response = disconnect(event, context)
+    except Exception as e:
+        error_string = traceback.format_exc()
+        print(error_string)
+        if event and "Records" not in event:
+            response = {"statusCode": 500}
+
+    print("Response", response)
+    return response
@@ -0,0 +1,326 @@
+import json
+import time
+import traceback
+from datetime import datetime, timezone
+
+import boto3
+from project_utility import (
+    ORDERS_DELIVERER_UPDATED_AT_INDEX,
+    ORDERS_SHOP_UPDATED_AT_INDEX,
+    EnvironmentVariables,
+    OrderStatus,
+    PermanentError,
+    UserNotificationTypes,
+    UserRole,
+    deserialize_dynamo_object,
+    get_order_status,
+    get_schedule_area,
+    get_schedule_queue,
+    offer_order,
+    process_sqs_batch,
+    query_all_items,
+    require_message_fields,
+    send_sqs_message,
+)
+
+# Clients
+dynamo = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
+
+# Constants
+FEED_ROLE_INDEX = "feedRole-index"
+ORDER_MATCH_RETRY_TYPE = "ORDER_MATCH_RETRY"
+
+# Offers only block other candidates briefly, an unanswered one moves on quickly
+OFFER_DURATION_SECONDS = 10
+# Offers are free again once strictly past their expiry
+OFFER_RETRY_DELAY_SECONDS = OFFER_DURATION_SECONDS + 1
+MAX_OFFER_ATTEMPTS = 5
+MAX_CANDIDATES = 20
+LOAD_WINDOW_MILLIS = 4 * 60 * 60 * 1000
+
+# Score weights, lower scores are better
+DISTANCE_WEIGHT = 1.0
+LOAD_WEIGHT = 2.0
+URGENT_LOAD_WEIGHT = 5.0
+UNKNOWN_AREA_DISTANCE = 100
+URGENT_DELIVERY_SECONDS = 60 * 60
+# Older orders were stored without the fraction when it was zero
+DELIVERY_TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"]
+
+# Role, assignment field and index used to measure load for each matchable status
+MATCHING_ROLES = {
+    OrderStatus.RECEIVED.value: (
+        UserRole.SHOP_OWNER.value,
+        "shopId",
+        ORDERS_SHOP_UPDATED_AT_INDEX,
+    ),
+    OrderStatus.MADE.value: (
+        UserRole.DELIVERER.value,
+        "delivererId",
+        ORDERS_DELIVERER_UPDATED_AT_INDEX,
+    ),
+}
+
+# Statuses that count as active work for a candidate
+ACTIVE_STATUSES = {
+    UserRole.SHOP_OWNER.value: [
+        OrderStatus.BREWING.value,
+        OrderStatus.MADE.value,
+    ],
+    UserRole.DELIVERER.value: [
+        OrderStatus.AWAITING_PICKUP.value,
+        OrderStatus.PICKED_UP.value,
+    ],
+}
+
+
+def get_order(customer_id, order_id):
+    response = dynamo.get_item(
+        TableName=EnvironmentVariables.ORDERS_TABLE.value,
+        Key={
+            "customerId": {
+                "S": customer_id,
+            },
+            "id": {
+                "S": order_id,
+            },
+        },
+    )
+
+    if "Item" in response:
+        return deserialize_dynamo_object(response["Item"])
+    else:
+        return None
+
+
+def get_connected_candidates(role):
+    connections = query_all_items(
+        dynamo,
+        {
+            "TableName": EnvironmentVariables.ORDER_FEED_CONNECTIONS_TABLE.value,
+            "IndexName": FEED_ROLE_INDEX,
+            "KeyConditionExpression": "feedRole = :feedRole",
+            # TTL deletes lag behind, expired connections can't receive the offer
+            "FilterExpression": "expiresAt > :now",
+            "ExpressionAttributeValues": {
+                ":feedRole": {
+                    "S": role,
+                },
+                ":now": {
+                    "N": str(int(time.time())),
+                },
+            },
+        },
+    )
+
+    # A candidate may have several connections, keep the first known area
+    candidates = {}
+    for connection in connections:
+        user_id = connection["userId"]["S"]
+        area = connection["area"]["S"] if "area" in connection else None
+        if user_id not in candidates or candidates[user_id] is None:
+            candidates[user_id] = area
+    return candidates
+
+
+def get_area_distance(order_area, candidate_area):
+    if order_area is None or candidate_area is None:
+        return UNKNOWN_AREA_DISTANCE
+    return abs(int(order_area) - int(candidate_area))
+
+
+def get_candidate_load(role, candidate_id, assignment_field, index_name):
+    active_statuses = ACTIVE_STATUSES[role]
+    status_values = {
+        f":status{i}": {"S": status} for i, status in enumerate(active_statuses)
+    }
+
+    query_args = {
+        "TableName": EnvironmentVariables.ORDERS_TABLE.value,
+        "IndexName": index_name,
+        "KeyConditionExpression": "#ASSIGNEE = :candidate AND updatedAt >= :since",
+        "FilterExpression": f"orderStatus IN ({', '.join(status_values.keys())})",
+        "ExpressionAttributeNames": {
+            "#ASSIGNEE": assignment_field,
+        },
+        "ExpressionAttributeValues": {
+            ":candidate": {
+                "S": candidate_id,
+            },
+            ":since": {
+                "N": str(int(time.time() * 1000) - LOAD_WINDOW_MILLIS),
+            },
+            **status_values,
+        },
+        "Select": "COUNT",
+    }
+
+    load = 0
+    while True:
+        response = dynamo.query(**query_args)
+        load += response["Count"]
+        if "LastEvaluatedKey" not in response:
+            return load
+        query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def parse_delivery_time(value):
+    for time_format in DELIVERY_TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return None
+
+
+def is_urgent(order):
+    delivery_time = (
+        parse_delivery_time(order["deliveryTime"]) if "deliveryTime" in order else None
+    )
+    if delivery_time is None:
+        return False
+
+    remaining = delivery_time - datetime.now(timezone.utc)
+    return remaining.total_seconds() < URGENT_DELIVERY_SECONDS
+
+
+def rank_candidates(order, order_status, excluded_candidates):
+    role, assignment_field, index_name = MATCHING_ROLES[order_status]
+    order_area = get_schedule_area(order, get_schedule_queue(order))
+
+    candidates = get_connected_candidates(role)
+    nearest = sorted(
+        (
+            (get_area_distance(order_area, area), candidate_id)
+            for candidate_id, area in candidates.items()
+            if candidate_id not in excluded_candidates
+        ),
+    )[:MAX_CANDIDATES]
+
+    # Busy candidates matter more when the order is due soon
+    load_weight = URGENT_LOAD_WEIGHT if is_urgent(order) else LOAD_WEIGHT
+
+    scored = []
+    for distance, candidate_id in nearest:
+        load = get_candidate_load(role, candidate_id, assignment_field, index_name)
+        score = distance * DISTANCE_WEIGHT + load * load_weight
+        print(f"Candidate {candidate_id}: distance {distance}, load {load}, score {score}")
+        scored.append((score, candidate_id))
+
+    scored.sort()
+    return role, [candidate_id for _, candidate_id in scored]
+
+
+def send_offer_notification(role, candidate_id, order_id, order_status, expires_at):
+    message = {
+        "type": UserNotificationTypes.ORDER_OFFER.type_code,
+        "targetUserId": candidate_id,
+        "feedRole": role,
+        "orderId": order_id,
+        "orderStatus": order_status,
+        "expiresAt": expires_at,
+    }
+    send_sqs_message(sqs, EnvironmentVariables.ORDER_FEED_QUEUE_URL.value, message)
+
+
+def schedule_next_offer(message, excluded_candidates):
+    retry_message = {
+        "type": ORDER_MATCH_RETRY_TYPE,
+        "customerId": message["customerId"],
+        "orderId": message["orderId"],
+        "orderStatus": message["orderStatus"],
+        "attempt": message.get("attempt", 0) + 1,
+        "excludedCandidates": excluded_candidates,
+    }
+
+    print(f"Scheduling offer attempt {retry_message['attempt']} for order {message['orderId']}")
+    send_sqs_message(
+        sqs,
+        EnvironmentVariables.ORDER_MATCHING_QUEUE_URL.value,
+        retry_message,
+        delay_seconds=OFFER_RETRY_DELAY_SECONDS,
+    )
+
+
+def match_order(message):
+    order_id = message["orderId"]
+    order_status = message["orderStatus"]
+    attempt = message.get("attempt", 0)
+    excluded_candidates = message.get("excludedCandidates", [])
+
+    if order_status not in MATCHING_ROLES:
+        print(f"Order {order_id} is {order_status}, nothing to match")
+        return
+
+    if attempt >= MAX_OFFER_ATTEMPTS:
+        print(f"Order {order_id} was not accepted after {attempt} offers, leaving it open")
+        return
+
+    current_status = get_order_status(dynamo, order_id)
+    if current_status is None or current_status["orderStatus"] != order_status:
+        print(f"Order {order_id} has moved on from {order_status}")
+        return
+
+    order = get_order(message["customerId"], order_id)
+    if order is None or get_schedule_queue(order) is None:
+        print(f"Order {order_id} is no longer waiting for assignment")
+        return
+
+    role, candidates = rank_candidates(order, order_status, excluded_candidates)
+    if len(candidates) == 0:
+        print(f"No connected candidates for order {order_id}, leaving it open")
+        return
+
+    candidate_id = candidates[0]
+    expires_at = offer_order(
+        dynamo, order_id, order_status, candidate_id, OFFER_DURATION_SECONDS
+    )
+    if expires_at is None:
+        # The order is leased or offered right now, check back once that settles
+        print(f"Order {order_id} is currently leased or offered, retrying later")
+        schedule_next_offer(message, excluded_candidates)
+        return
+
+    print(f"Offered order {order_id} to {candidate_id} until {expires_at}")
+    send_offer_notification(role, candidate_id, order_id, order_status, expires_at)
+    schedule_next_offer(message, excluded_candidates + [candidate_id])
+
+
+def process_message(record):
+    message_id = record["messageId"]
+    message_body = json.loads(record["body"])
+
+    print(f"Processing message {message_id}...")
+
+    message_type = message_body["type"] if "type" in message_body else None
+    if message_type in [
+        UserNotificationTypes.ORDER_STATUS_UPDATE.type_code,
+        ORDER_MATCH_RETRY_TYPE,
+    ]:
+        require_message_fields(message_body, ["customerId", "orderId", "orderStatus"])
+        match_order(message_body)
+    else:
+        print(f"Unknown message type: {message_type}")
+        raise PermanentError("Unknown message type")
+
+    print(f"Processed message {message_id}")
+
+
+def lambda_handler(event, context):
+    print(f"Received event: {event}")
+    print(f"Context: {context}")
+
+    response = {}
+
+    try:
+        if event:
+            response["batchItemFailures"] = process_sqs_batch(
+                event["Records"], context, process_message, dynamo, sqs
+            )
+    except Exception as e:
+        error_string = traceback.format_exc()
+        print(error_string)
+
+    print("Response", response)
+    return response
@@ -3,29 +3,49 @@ import traceback
 
 import boto3
 from project_utility import (
+    PermanentError,
+    get_order_status,
+    process_sqs_batch,
     send_order_status_update_message,
     update_order_status,
 )
 
 # Clients
 dynamo = boto3.client("dynamodb")
+sns = boto3.client("sns")
 sqs = boto3.client("sqs")
 
 
+def is_status_already_applied(order_id, new_status, lease_token):
+    # A retry after a failed publish finds its own update already written
+    order_status = get_order_status(dynamo, order_id)
+    return (
+        order_status is not None
+        and order_status.get("orderStatus") == new_status
+        and int(order_status.get("leaseToken", -1)) == int(lease_token)
+    )
+
+
 def process_message(record):
     message_id = record["messageId"]
     message_body = json.loads(record["body"])
 
     print(f"Processing message {message_id}...")
 
-    customer_id = message_body["customerId"]
-    order_id = message_body["orderId"]
-    old_status = message_body["previousStatus"]
-    new_status = message_body["newStatus"]
-    field_updates = message_body["fieldUpdates"]
-    if update_order_status(dynamo, order_id, old_status, new_status, field_updates) is None:
-        raise ValueError("Failed to update order status")
-    send_order_status_update_message(customer_id, order_id, new_status)
+    try:
+        customer_id = message_body["customerId"]
+        order_id = message_body["orderId"]
+        old_status = message_body["previousStatus"]
+        new_status = message_body["newStatus"]
+        field_updates = message_body["fieldUpdates"]
+        lease_token = message_body["leaseToken"]
+    except KeyError as e:
+        raise PermanentError(f"Message {message_id} is missing {e}")
+    if not update_order_status(
+        dynamo, order_id, old_status, new_status, field_updates, lease_token
+    ) and not is_status_already_applied(order_id, new_status, lease_token):
+        raise PermanentError("Failed to update order status")
+    send_order_status_update_message(customer_id, order_id, new_status, sns)
 
     print(f"Processed message {message_id}")
 
@@ -34,19 +54,13 @@ def lambda_handler(event, context):
     print(f"Received event: {event}")
     print(f"Context: {context}")
 
-    batch_item_failures = []
     response = {}
 
     try:
         if event:
-            for record in event["Records"]:
-                try:
-                    process_message(record)
-                except Exception as e:
-                    print(f"Error processing record {record['messageId']}", repr(e))
-                    batch_item_failures.append({"itemIdentifier": record["messageId"]})
-
-            response["batchItemFailures"] = batch_item_failures
+            response["batchItemFailures"] = process_sqs_batch(
+                event["Records"], context, process_message, dynamo, sqs
+            )
     except Exception as e:
         error_string = traceback.format_exc()
         print(error_string)
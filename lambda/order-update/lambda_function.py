@@ -3,8 +3,21 @@ import traceback
 
 import boto3
 from project_utility import (
+    ORDER_ARCHIVE_AT_FIELD,
     EnvironmentVariables,
+    OrderStatus,
+    PermanentError,
+    TransientError,
+    apply_order_archive_bucket,
+    apply_schedule_bucket,
+    build_earnings_rollup_updates,
+    compact_order,
+    current_timestamp_millis,
     deserialize_dynamo_object,
+    get_earnings_day,
+    get_order_archive_at,
+    is_condition_check_failure,
+    process_sqs_batch,
     send_sqs_message,
     serialize_to_dynamo_object,
 )
@@ -14,7 +27,7 @@ dynamo = boto3.client("dynamodb")
 sqs = boto3.client("sqs")
 
 
-def update_order(user_id, order_id, field_updates):
+def update_order(user_id, order_id, previous_status, field_updates, lease_token):
     response = dynamo.get_item(
         TableName=EnvironmentVariables.ORDERS_TABLE.value,
         Key={
@@ -29,23 +42,88 @@ def update_order(user_id, order_id, field_updates):
 
     order = response["Item"] if "Item" in response else None
     if order is None:
-        raise ValueError(f"Couldn't find order {order_id}")
+        raise PermanentError(f"Couldn't find order {order_id}")
 
     order = deserialize_dynamo_object(order)
+    previous_version = order.get("version")
+    was_delivered = order.get("orderStatus") == OrderStatus.DELIVERED.value
 
     for key in field_updates:
         order[key] = field_updates[key]
+    apply_schedule_bucket(order)
+    apply_order_archive_bucket(order)
 
-    dynamo.put_item(
-        TableName=EnvironmentVariables.ORDERS_TABLE.value,
-        Item=serialize_to_dynamo_object(order),
+    # Keep the change stamp monotonic even if clocks drift between writers
+    order["updatedAt"] = max(
+        current_timestamp_millis(), int(order.get("updatedAt", 0)) + 1
     )
+    order["version"] = int(previous_version or 0) + 1
+
+    if previous_version is None:
+        put_condition = {
+            "ConditionExpression": "attribute_not_exists(version)",
+        }
+    else:
+        put_condition = {
+            "ConditionExpression": "version = :previous_version",
+            "ExpressionAttributeValues": {
+                ":previous_version": {
+                    "N": str(previous_version),
+                },
+            },
+        }
+
+    transact_items = [
+        {
+            "ConditionCheck": {
+                "Key": {
+                    "id": {
+                        "S": order_id,
+                    },
+                },
+                "TableName": EnvironmentVariables.ORDER_STATUS_TABLE.value,
+                "ConditionExpression": "orderStatus = :old_status AND leaseToken = :lease_token",
+                "ExpressionAttributeValues": {
+                    ":old_status": {
+                        "S": previous_status,
+                    },
+                    ":lease_token": {
+                        "N": str(lease_token),
+                    },
+                },
+            }
+        },
+        {
+            "Put": {
+                "Item": serialize_to_dynamo_object(compact_order(order)),
+                "TableName": EnvironmentVariables.ORDERS_TABLE.value,
+                **put_condition,
+            }
+        },
+    ]
+
+    # Retries see the stored DELIVERED status and concurrent writers fail the version check,
+    # so each order is added to the rollups once
+    if order["orderStatus"] == OrderStatus.DELIVERED.value and not was_delivered:
+        day = get_earnings_day(order["updatedAt"])
+        transact_items.extend(
+            {"Update": update} for update in build_earnings_rollup_updates(order, day)
+        )
+
+    try:
+        # Only the current lease holder may write the order
+        dynamo.transact_write_items(TransactItems=transact_items)
+    except dynamo.exceptions.TransactionCanceledException as e:
+        if not is_condition_check_failure(e):
+            reasons = e.response.get("CancellationReasons", [])
+            raise TransientError(f"Order {order_id} write was cancelled: {reasons}")
+        raise PermanentError(f"Lease {lease_token} no longer held for order {order_id}")
 
     print("Order saved")
 
 
 def send_order_update_confirmation_message(
-    customer_id, order_id, old_status, new_status, field_updates
+    customer_id, order_id, old_status, new_status, field_updates, lease_token
 ):
     print(
         f"Sending order update confirmation message for customer {customer_id}'s order {order_id} with status {new_status}"
@@ -57,6 +135,7 @@ def send_order_update_confirmation_message(
         "previousStatus": old_status,
         "newStatus": new_status,
         "fieldUpdates": field_updates,
+        "leaseToken": lease_token,
     }
     return send_sqs_message(
         sqs, EnvironmentVariables.ORDER_UPDATE_CONFIRMATION_QUEUE_URL.value, message
@@ -69,16 +148,23 @@ def process_message(record):
 
     print(f"Processing message {message_id}...")
 
-    customer_id = message_body["customerId"]
-    order_id = message_body["orderId"]
-    field_updates = message_body["fieldUpdates"]
-    old_status = message_body["previousStatus"]
-    new_status = message_body["newStatus"]
+    try:
+        customer_id = message_body["customerId"]
+        order_id = message_body["orderId"]
+        field_updates = message_body["fieldUpdates"]
+        old_status = message_body["previousStatus"]
+        new_status = message_body["newStatus"]
+        lease_token = message_body["leaseToken"]
+    except KeyError as e:
+        raise PermanentError(f"Message {message_id} is missing {e}")
 
     field_updates["orderStatus"] = new_status
-    update_order(customer_id, order_id, field_updates)
+    if new_status == OrderStatus.DELIVERED.value:
+        # Delivered orders stay hot for a while, then the archive job moves them
+        field_updates[ORDER_ARCHIVE_AT_FIELD] = get_order_archive_at()
+    update_order(customer_id, order_id, old_status, field_updates, lease_token)
     send_order_update_confirmation_message(
-        customer_id, order_id, old_status, new_status, field_updates
+        customer_id, order_id, old_status, new_status, field_updates, lease_token
     )
 
     print(f"Processed message {message_id}")
@@ -88,19 +174,13 @@ def lambda_handler(event, context):
     print(f"Received event: {event}")
     print(f"Context: {context}")
 
-    batch_item_failures = []
     response = {}
 
     try:
         if event:
-            for record in event["Records"]:
-                try:
-                    process_message(record)
-                except Exception as e:
-                    print(f"Error processing record {record['messageId']}", repr(e))
-                    batch_item_failures.append({"itemIdentifier": record["messageId"]})
-
-            response["batchItemFailures"] = batch_item_failures
+            response["batchItemFailures"] = process_sqs_batch(
+                event["Records"], context, process_message, dynamo, sqs
+            )
     except Exception as e:
         error_string = traceback.format_exc()
         print(error_string)
@@ -1,84 +1,257 @@
 import json
+import time
 import traceback
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from decimal import Decimal
 
 import boto3
 from project_utility import (
+    EXPORT_OWNER_CUSTOMERS,
+    LOCATION_SCHEMA,
+    MAX_RATING,
+    MIN_RATING,
+    ORDERS_CUSTOMER_DELIVERY_TIME_INDEX,
+    ORDERS_CUSTOMER_UPDATED_AT_INDEX,
+    ORDER_ARCHIVE_AT_FIELD,
+    ORDER_ARCHIVE_BUCKET_FIELD,
+    PAYMENT_INFORMATION_SCHEMA,
+    QUOTE_TTL_SECONDS,
+    RATING_AGGREGATED_FIELD,
     EnvironmentVariables,
     ErrorCodes,
     OrderStatus,
     UserRole,
+    add_validation_error,
+    apply_schedule_bucket,
+    attach_live_order_status,
+    batch_get_items,
     build_error_response,
+    build_product_rating_aggregate_update,
+    build_product_rating_aggregates_update,
+    build_projection_expression,
     build_response,
-    calculate_commission,
-    calculate_delivery_fee,
+    build_validation_error_response,
+    calculate_item_total_cents,
+    calculate_order_fees,
+    compact_order,
+    compile_product_rules,
+    compute_cart_hash,
+    current_timestamp_millis,
+    decode_pagination_cursor,
     deserialize_dynamo_object,
+    encode_pagination_cursor,
+    expand_order_items,
     extract_user_id,
+    from_cents,
     get_additions_by_id,
+    get_cached_catalog,
+    get_cached_product_rules,
+    get_fields_parameter,
+    get_order_export,
     get_path_parameter,
     get_products_by_id,
+    get_query_parameter,
+    get_quote_signing_key,
+    get_since_parameter,
     initialize_order_status,
+    join_validation_path,
+    list_schema,
+    object_schema,
+    query_all_items,
     send_order_status_update_message,
     serialize_to_dynamo_object,
+    sign_payload,
+    start_order_export,
+    string_schema,
     to_coffee_type,
+    to_field_list,
     to_milk_type,
     user_has_role,
-    validate_location,
-    validate_payment_information,
+    validate_schema,
+    verify_signed_payload,
 )
 
 # Clients
 dynamo = boto3.client("dynamodb")
+s3 = boto3.client("s3")
+sqs = boto3.client("sqs")
 
 # Constants
 PRODUCT_TYPE = "PRODUCT"
 ADDITION_TYPE = "ADDITION"
 MINIMUM_ORDER_TIME_DELTA_MINUTES = 30
 MINIMUM_ORDER_TIME_DELTA = timedelta(minutes=MINIMUM_ORDER_TIME_DELTA_MINUTES)
+LIVE_STATUS_FLAG = "liveStatus"
+ARCHIVED_FLAG = "archived"
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_BATCH_RATINGS = 25
+MAX_BATCH_ORDER_IDS = 100
+MAX_WORKERS = 8
+ORDER_FIELDS = [
+    "id",
+    "orderStatus",
+    "deliveryTime",
+    "deliveryLocation",
+    "preparedLocation",
+    "payment",
+    "items",
+    "commission",
+    "deliveryFee",
+    "shopId",
+    "delivererId",
+    "updatedAt",
+]
 
 
 def _build_items_from_dynamo_response(items):
     cleaned_items = []
     for item in items:
         order = deserialize_dynamo_object(item)
-        order.pop("customerId")
+        order.pop("customerId", None)
+        order.pop("scheduleBucket", None)
+        order.pop("areaBucket", None)
+        order.pop(ORDER_ARCHIVE_AT_FIELD, None)
+        order.pop(ORDER_ARCHIVE_BUCKET_FIELD, None)
         cleaned_items.append(order)
     return cleaned_items
 
 
 def build_orders_from_dynamo_response(items):
-    return _build_items_from_dynamo_response(items)
+    return [
+        expand_order_items(dynamo, order)
+        for order in _build_items_from_dynamo_response(items)
+    ]
 
 
 def build_order_ratings_from_dynamo_response(items):
-    return _build_items_from_dynamo_response(items)
+    ratings = _build_items_from_dynamo_response(items)
+    for rating in ratings:
+        rating.pop(RATING_AGGREGATED_FIELD, None)
+    return ratings
+
+
+def get_requested_projection(event):
+    fields = get_query_parameter(event, "fields", None)
+    if fields is None:
+        return None, None, None
+
+    fields, invalid_fields = to_field_list(fields, ORDER_FIELDS)
+    if len(invalid_fields) > 0:
+        return (
+            None,
+            None,
+            build_error_response(
+                ErrorCodes.INVALID_DATA,
+                f"Invalid field(s): {', '.join(invalid_fields)}. Valid field(s): {', '.join(ORDER_FIELDS)}",
+            ),
+        )
+    if "id" not in fields:
+        fields.insert(0, "id")
+
+    projection_expression, expression_names = build_projection_expression(fields)
+    return projection_expression, expression_names, None
 
 
 def get_orders(event, context):
     customer_id = extract_user_id(event)
-
-    print(f"Getting all orders for customer {customer_id}")
-    response = dynamo.query(
-        TableName=EnvironmentVariables.ORDERS_TABLE.value,
-        KeyConditionExpression="customerId = :customerId",
-        ExpressionAttributeValues={
+    live_status = (
+        get_query_parameter(event, LIVE_STATUS_FLAG, "false").lower() == "true"
+    )
+    archived = get_query_parameter(event, ARCHIVED_FLAG, "false").lower() == "true"
+    if archived:
+        # Archived orders are delivered and no longer have a status row
+        live_status = False
+
+    query_args = {
+        "TableName": (
+            EnvironmentVariables.ORDER_ARCHIVE_TABLE.value
+            if archived
+            else EnvironmentVariables.ORDERS_TABLE.value
+        ),
+        "IndexName": ORDERS_CUSTOMER_DELIVERY_TIME_INDEX,
+        "KeyConditionExpression": "customerId = :customerId",
+        "ExpressionAttributeValues": {
             ":customerId": {
                 "S": customer_id,
             },
         },
+        # Newest orders first
+        "ScanIndexForward": False,
+    }
+
+    try:
+        since = get_since_parameter(event)
+    except ValueError:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, "Since must be a non-negative timestamp"
+        )
+
+    if since is not None:
+        # Only orders changed after the given timestamp, oldest change first
+        query_args["IndexName"] = ORDERS_CUSTOMER_UPDATED_AT_INDEX
+        query_args["KeyConditionExpression"] = (
+            "customerId = :customerId AND updatedAt > :since"
+        )
+        query_args["ExpressionAttributeValues"][":since"] = {
+            "N": str(since),
+        }
+        query_args["ScanIndexForward"] = True
+
+    projection_expression, expression_names, error_response = get_requested_projection(
+        event
     )
+    if error_response is not None:
+        return error_response
+    if projection_expression is not None:
+        query_args["ProjectionExpression"] = projection_expression
+        query_args["ExpressionAttributeNames"] = expression_names
+
+    limit = get_query_parameter(event, "limit", None)
+    cursor = get_query_parameter(event, "cursor", None)
+    try:
+        # Always page so a long history can't exhaust the function
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ValueError("Limit out of range")
+    except ValueError:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA,
+            f"Limit must be an integer between 1 and {MAX_PAGE_SIZE}",
+        )
+    query_args["Limit"] = limit
+
+    if cursor is not None:
+        try:
+            start_key = decode_pagination_cursor(cursor)
+            if start_key.get("customerId", {}).get("S") != customer_id:
+                raise ValueError("Cursor belongs to another customer")
+        except ValueError:
+            return build_error_response(ErrorCodes.INVALID_DATA, "Invalid cursor")
+        query_args["ExclusiveStartKey"] = start_key
+
+    print(f"Getting a page of {limit} orders for customer {customer_id}")
+    response = dynamo.query(**query_args)
     orders = response["Items"]
 
     print(f"Found {len(orders)} orders")
     orders = build_orders_from_dynamo_response(orders)
-    return build_response(200, orders)
+    if live_status:
+        attach_live_order_status(dynamo, orders)
+    next_cursor = encode_pagination_cursor(response.get("LastEvaluatedKey"))
+    return build_response(200, {"orders": orders, "cursor": next_cursor})
 
 
 def user_owns_order(user_id, order_id):
     print(f"Checking user {user_id} owns order {order_id}")
     order = get_raw_order_for_user(user_id, order_id)
+    if order is None:
+        print(f"Order {order_id} is not live, checking the archive")
+        order = get_raw_order_for_user(
+            user_id, order_id, EnvironmentVariables.ORDER_ARCHIVE_TABLE.value
+        )
     return order is not None, order
 
 
@@ -112,6 +285,43 @@ def get_order_ratings(event, context):
     return build_response(200, ratings)
 
 
+def validate_order_rating(user_id, order_id, raw_order, input_rating):
+    validated_rating = {"customerId": user_id}
+
+    if "orderId" not in input_rating or input_rating["orderId"] != order_id:
+        return False, "Invalid orderId value in rating"
+    validated_rating["orderId"] = order_id
+
+    order_items = build_orders_from_dynamo_response([raw_order])[0]["items"]
+    order_item_products = {item["id"]: item["productId"] for item in order_items}
+    if (
+        "orderItemId" not in input_rating
+        or str(input_rating["orderItemId"]) not in order_item_products
+    ):
+        return False, "Invalid orderItemId value in rating"
+    validated_rating["orderItemId"] = str(input_rating["orderItemId"])
+    validated_rating["productId"] = order_item_products[
+        validated_rating["orderItemId"]
+    ]
+
+    if "rating" not in input_rating:
+        return False, "You must specify a rating value"
+    else:
+        try:
+            rating_value = int(input_rating["rating"])
+            if rating_value < MIN_RATING or rating_value > MAX_RATING:
+                return (
+                    False,
+                    f"Rating must be an integer between {MIN_RATING} and {MAX_RATING}",
+                )
+
+            validated_rating["rating"] = rating_value
+        except:
+            return False, "Invalid rating value"
+
+    return True, validated_rating
+
+
 def submit_order_rating(event, context):
     user_id = extract_user_id(event)
 
@@ -126,56 +336,318 @@ def submit_order_rating(event, context):
         )
 
     input_rating = json.loads(event["body"])
-    validated_rating = {"customerId": user_id}
+    is_valid, data = validate_order_rating(user_id, order_id, raw_order, input_rating)
+    if not is_valid:
+        return build_error_response(ErrorCodes.INVALID_DATA, data)
+    validated_rating = data
 
-    if "orderId" not in input_rating or input_rating["orderId"] != order_id:
+    print("Validated. Saving to Dynamo...", validated_rating)
+
+    previous_rating = get_previous_rating(
+        order_id, validated_rating["orderItemId"]
+    )
+    if not save_order_rating(validated_rating, previous_rating):
         return build_error_response(
-            ErrorCodes.INVALID_DATA, "Invalid orderId value in rating"
+            ErrorCodes.INVALID_DATA, "Rating was changed concurrently, try again"
         )
-    validated_rating["orderId"] = order_id
 
-    order_items = build_orders_from_dynamo_response([raw_order])[0]["items"]
-    order_item_ids = [item["id"] for item in order_items]
-    if (
-        "orderItemId" not in input_rating
-        or str(input_rating["orderItemId"]) not in order_item_ids
-    ):
+    print("Order rating saved")
+    return build_response(200, None)
+
+
+def get_raw_orders_for_user(user_id, order_ids, projection_fields=None):
+    keys = [
+        {"customerId": {"S": user_id}, "id": {"S": order_id}}
+        for order_id in set(order_ids)
+    ]
+    print(f"Getting {len(keys)} orders for customer {user_id}")
+
+    projection_args = {}
+    if projection_fields is not None:
+        projection_expression, expression_names = build_projection_expression(
+            projection_fields
+        )
+        projection_args = {
+            "projection_expression": projection_expression,
+            "expression_names": expression_names,
+        }
+
+    raw_orders = batch_get_items(
+        dynamo, EnvironmentVariables.ORDERS_TABLE.value, keys, **projection_args
+    )
+    found_orders = {raw_order["id"]["S"]: raw_order for raw_order in raw_orders}
+
+    archived_keys = [key for key in keys if key["id"]["S"] not in found_orders]
+    if len(archived_keys) > 0:
+        print(f"Checking the archive for {len(archived_keys)} orders")
+        archived_orders = batch_get_items(
+            dynamo,
+            EnvironmentVariables.ORDER_ARCHIVE_TABLE.value,
+            archived_keys,
+            **projection_args,
+        )
+        for raw_order in archived_orders:
+            found_orders[raw_order["id"]["S"]] = raw_order
+    return found_orders
+
+
+def get_previous_ratings(rating_keys):
+    keys = [
+        {"orderId": {"S": order_id}, "orderItemId": {"S": order_item_id}}
+        for order_id, order_item_id in rating_keys
+    ]
+    raw_ratings = batch_get_items(
+        dynamo,
+        EnvironmentVariables.ORDER_RATINGS_TABLE.value,
+        keys,
+        consistent_read=True,
+        projection_expression=f"orderId, orderItemId, rating, {RATING_AGGREGATED_FIELD}",
+    )
+    return {
+        (
+            raw_rating["orderId"]["S"],
+            raw_rating["orderItemId"]["S"],
+        ): build_previous_rating(raw_rating)
+        for raw_rating in raw_ratings
+    }
+
+
+def build_order_ratings_transaction_items(ratings, previous_ratings):
+    transaction_items = []
+    rating_changes = {}
+    for rating in ratings:
+        previous_rating = previous_ratings.get(
+            (rating["orderId"], rating["orderItemId"])
+        )
+        # Only the rating puts here, aggregates are merged per product below
+        transaction_items.append(
+            build_order_rating_transaction_items(rating, previous_rating)[0]
+        )
+        rating_changes.setdefault(rating["productId"], []).append(
+            (get_aggregated_rating(previous_rating), rating["rating"])
+        )
+
+    for product_id, changes in rating_changes.items():
+        aggregate_update = build_product_rating_aggregates_update(product_id, changes)
+        if aggregate_update is not None:
+            transaction_items.append({"Update": aggregate_update})
+
+    return transaction_items
+
+
+def submit_order_ratings(event, context):
+    user_id = extract_user_id(event)
+
+    if "body" not in event or event["body"] is None:
         return build_error_response(
-            ErrorCodes.INVALID_DATA, "Invalid orderItemId value in rating"
+            ErrorCodes.MISSING_BODY, "Must specify a request body"
         )
-    validated_rating["orderItemId"] = str(input_rating["orderItemId"])
 
-    if "rating" not in input_rating:
+    input_ratings = json.loads(event["body"])
+    if not isinstance(input_ratings, list) or len(input_ratings) == 0:
         return build_error_response(
-            ErrorCodes.INVALID_DATA, "You must specify a rating value"
+            ErrorCodes.MISSING_DATA, "Must specify a list of ratings"
+        )
+    elif len(input_ratings) > MAX_BATCH_RATINGS:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA,
+            f"Cannot submit more than {MAX_BATCH_RATINGS} ratings at once",
         )
-    else:
-        try:
-            rating_value = int(input_rating["rating"])
-            if rating_value < 1 or rating_value > 5:
-                return build_error_response(
-                    ErrorCodes.INVALID_DATA, "Rating must be an integer between 1 and 5"
-                )
 
-            validated_rating["rating"] = rating_value
-        except:
-            return build_error_response(ErrorCodes.INVALID_DATA, "Invalid rating value")
+    order_ids = [
+        str(input_rating.get("orderId")) if isinstance(input_rating, dict) else None
+        for input_rating in input_ratings
+    ]
+    raw_orders = get_raw_orders_for_user(
+        user_id, [order_id for order_id in order_ids if order_id is not None]
+    )
 
-    print("Validated. Saving to Dynamo...", validated_rating)
+    validated_ratings = []
+    rating_keys = set()
+    for index, (order_id, input_rating) in enumerate(zip(order_ids, input_ratings)):
+        if order_id not in raw_orders:
+            return build_error_response(
+                ErrorCodes.NOT_AUTHORIZED,
+                f"You must own the order to submit rating {index + 1}",
+            )
 
-    dynamo.put_item(
+        is_valid, data = validate_order_rating(
+            user_id, order_id, raw_orders[order_id], input_rating
+        )
+        if not is_valid:
+            return build_error_response(
+                ErrorCodes.INVALID_DATA, f"Rating {index + 1}: {data}"
+            )
+
+        rating_key = (data["orderId"], data["orderItemId"])
+        if rating_key in rating_keys:
+            return build_error_response(
+                ErrorCodes.INVALID_DATA, f"Rating {index + 1} repeats an order item"
+            )
+        rating_keys.add(rating_key)
+        validated_ratings.append(data)
+
+    print(f"Validated. Saving {len(validated_ratings)} ratings to Dynamo...")
+
+    previous_ratings = get_previous_ratings(rating_keys)
+    try:
+        dynamo.transact_write_items(
+            TransactItems=build_order_ratings_transaction_items(
+                validated_ratings, previous_ratings
+            )
+        )
+    except dynamo.exceptions.TransactionCanceledException:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, "Ratings were changed concurrently, try again"
+        )
+
+    print("Order ratings saved")
+    return build_response(200, None)
+
+
+def query_order_ratings(order_id):
+    return query_all_items(
+        dynamo,
+        {
+            "TableName": EnvironmentVariables.ORDER_RATINGS_TABLE.value,
+            "KeyConditionExpression": "orderId = :orderId",
+            "ExpressionAttributeValues": {
+                ":orderId": {
+                    "S": order_id,
+                },
+            },
+        },
+    )
+
+
+def get_orders_ratings(event, context):
+    user_id = extract_user_id(event)
+
+    order_ids_value = get_query_parameter(event, "orderIds", None)
+    if order_ids_value is None:
+        return build_error_response(
+            ErrorCodes.MISSING_DATA, "Must specify a list of order IDs"
+        )
+
+    order_ids = list(
+        dict.fromkeys(
+            order_id.strip()
+            for order_id in str(order_ids_value).split(",")
+            if order_id.strip()
+        )
+    )
+    if len(order_ids) == 0 or len(order_ids) > MAX_BATCH_ORDER_IDS:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA,
+            f"Must specify between 1 and {MAX_BATCH_ORDER_IDS} order IDs",
+        )
+
+    owned_orders = get_raw_orders_for_user(user_id, order_ids, ["id"])
+    if any(order_id not in owned_orders for order_id in order_ids):
+        return build_error_response(
+            ErrorCodes.NOT_AUTHORIZED, "You must own the orders to see ratings"
+        )
+
+    print(f"Getting all order ratings for {len(order_ids)} orders")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(query_order_ratings, order_ids)
+        ratings = [rating for order_ratings in results for rating in order_ratings]
+
+    print(f"Found {len(ratings)} order ratings")
+    ratings = build_order_ratings_from_dynamo_response(ratings)
+    return build_response(200, ratings)
+
+
+def get_previous_rating(order_id, order_item_id):
+    response = dynamo.get_item(
         TableName=EnvironmentVariables.ORDER_RATINGS_TABLE.value,
-        Item=serialize_to_dynamo_object(validated_rating),
+        Key={
+            "orderId": {
+                "S": order_id,
+            },
+            "orderItemId": {
+                "S": order_item_id,
+            },
+        },
+        ProjectionExpression=f"rating, {RATING_AGGREGATED_FIELD}",
+        ConsistentRead=True,
     )
 
-    print("Order rating saved")
-    return build_response(200, None)
+    if "Item" in response:
+        return build_previous_rating(response["Item"])
+    else:
+        return None
+
+
+def build_previous_rating(raw_rating):
+    return {
+        "rating": int(raw_rating["rating"]["N"]),
+        "aggregated": RATING_AGGREGATED_FIELD in raw_rating,
+    }
+
+
+def get_aggregated_rating(previous_rating):
+    # A rating the aggregates never counted is added like a new one
+    if previous_rating is None or not previous_rating["aggregated"]:
+        return None
+    return previous_rating["rating"]
 
 
-def get_raw_order_for_user(user_id, order_id):
+def build_order_rating_transaction_items(rating, previous_rating):
+    if previous_rating is None:
+        put_condition = {
+            "ConditionExpression": "attribute_not_exists(orderId)",
+        }
+    else:
+        if previous_rating["aggregated"]:
+            aggregated_condition = "attribute_exists(#AGGREGATED)"
+        else:
+            aggregated_condition = "attribute_not_exists(#AGGREGATED)"
+        put_condition = {
+            "ConditionExpression": f"rating = :previous_rating AND {aggregated_condition}",
+            "ExpressionAttributeNames": {
+                "#AGGREGATED": RATING_AGGREGATED_FIELD,
+            },
+            "ExpressionAttributeValues": {
+                ":previous_rating": {"N": str(previous_rating["rating"])},
+            },
+        }
+
+    transaction_items = [
+        {
+            "Put": {
+                "Item": serialize_to_dynamo_object(
+                    {**rating, RATING_AGGREGATED_FIELD: True}
+                ),
+                "TableName": EnvironmentVariables.ORDER_RATINGS_TABLE.value,
+                **put_condition,
+            }
+        }
+    ]
+
+    aggregate_update = build_product_rating_aggregate_update(
+        rating["productId"], get_aggregated_rating(previous_rating), rating["rating"]
+    )
+    if aggregate_update is not None:
+        transaction_items.append({"Update": aggregate_update})
+
+    return transaction_items
+
+
+def save_order_rating(rating, previous_rating):
+    try:
+        dynamo.transact_write_items(
+            TransactItems=build_order_rating_transaction_items(rating, previous_rating)
+        )
+        return True
+    except dynamo.exceptions.TransactionCanceledException:
+        return False
+
+
+def get_raw_order_for_user(user_id, order_id, table_name=None):
     print(f"Getting order {order_id} for customer {user_id}")
     response = dynamo.get_item(
-        TableName=EnvironmentVariables.ORDERS_TABLE.value,
+        TableName=table_name or EnvironmentVariables.ORDERS_TABLE.value,
         Key={
             "customerId": {
                 "S": user_id,
@@ -189,6 +661,39 @@ def get_raw_order_for_user(user_id, order_id):
     return order
 
 
+def export_orders(event, context):
+    customer_id = extract_user_id(event)
+
+    fields, invalid_fields = get_fields_parameter(event, ORDER_FIELDS, ["id"])
+    if len(invalid_fields) > 0:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA,
+            f"Invalid field(s): {', '.join(invalid_fields)}. Valid field(s): {', '.join(ORDER_FIELDS)}",
+        )
+
+    try:
+        since = get_since_parameter(event)
+    except ValueError:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, "Since must be a non-negative timestamp"
+        )
+
+    print(f"Exporting orders for customer {customer_id}")
+    return start_order_export(
+        dynamo, sqs, EXPORT_OWNER_CUSTOMERS, customer_id, fields, since
+    )
+
+
+def get_orders_export(event, context):
+    customer_id = extract_user_id(event)
+
+    export_id = get_path_parameter(event, "id", None)
+    if export_id is None:
+        return build_error_response(ErrorCodes.MISSING_DATA, "Must specify an export ID")
+
+    return get_order_export(dynamo, s3, EXPORT_OWNER_CUSTOMERS, customer_id, export_id)
+
+
 def get_single_order(event, context):
     customer_id = extract_user_id(event)
 
@@ -197,6 +702,11 @@ def get_single_order(event, context):
         return build_error_response(ErrorCodes.MISSING_DATA, "Must specify an order ID")
 
     raw_order = get_raw_order_for_user(customer_id, order_id)
+    if raw_order is None:
+        print(f"Order {order_id} is not live, checking the archive")
+        raw_order = get_raw_order_for_user(
+            customer_id, order_id, EnvironmentVariables.ORDER_ARCHIVE_TABLE.value
+        )
     if raw_order is None:
         return build_error_response(ErrorCodes.NOT_FOUND, f"Order {order_id} not found")
 
@@ -215,7 +725,7 @@ def collect_used_products_and_additions(items):
 
             if "additions" in item and item["additions"] is not None:
                 for addition in item["additions"]:
-                    if "id" in addition and addition["id"] is not None:
+                    if addition is not None and "id" in addition:
                         addition_ids.append(addition["id"])
 
     products = get_products_by_id(dynamo, product_ids)
@@ -223,180 +733,323 @@ def collect_used_products_and_additions(items):
     return products, additions
 
 
-def validate_order_item(item, index, known_products, known_additions):
-    id = str(uuid.uuid4())
-    validated_order_item = {
-        "id": id,
-    }
+def validate_delivery_time(value, path, errors):
+    try:
+        delivery_time = datetime.strptime(str(value), "%Y-%m-%dT%H:%M:%S.%fZ")
+    except ValueError:
+        add_validation_error(errors, path, "must be a timestamp like 2024-01-01T12:00:00.000Z")
+        return None
+
+    if delivery_time < datetime.now() + MINIMUM_ORDER_TIME_DELTA:
+        add_validation_error(
+            errors,
+            path,
+            f"must be at least {MINIMUM_ORDER_TIME_DELTA_MINUTES} minutes in the future",
+        )
+        return None
+
+    # Always keep the milliseconds so stored times share one format and sort as text
+    return f"{delivery_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}Z"
+
+
+ORDER_ITEM_SCHEMA = object_schema(
+    {
+        "productId": string_schema(),
+        "coffeeType": string_schema(),
+        "milkType": string_schema(),
+        "additions": list_schema(
+            object_schema({"id": string_schema()}, required=["id"])
+        ),
+    },
+    required=["productId", "coffeeType"],
+)
 
-    if "productId" in item:
-        product_id = str(item["productId"])
-        if product_id not in known_products:
-            return False, f"Unknown product {product_id} for order item {index+1}"
+ORDER_ITEMS_SCHEMA = list_schema(ORDER_ITEM_SCHEMA, min_items=1)
 
-        validated_product = known_products[product_id]
-        validated_order_item["productId"] = product_id
-    else:
-        return False, f"Order item {index+1} missing product ID"
+ORDER_SCHEMA = object_schema(
+    {
+        "deliveryTime": validate_delivery_time,
+        "deliveryLocation": LOCATION_SCHEMA,
+        "payment": PAYMENT_INFORMATION_SCHEMA,
+        "items": ORDER_ITEMS_SCHEMA,
+    },
+    required=["deliveryTime", "deliveryLocation", "payment", "items"],
+)
+
+ORDER_QUOTE_SCHEMA = object_schema({"items": ORDER_ITEMS_SCHEMA}, required=["items"])
 
-    validated_order_item["basePrice"] = validated_product["basePrice"]
+
+def validate_order_item(item, path, product_rules, known_additions, errors):
+    # Items have already passed ORDER_ITEM_SCHEMA, so only the catalog rules remain
+    if item is None or "productId" not in item:
+        return None
+
+    product_id = item["productId"]
+    if product_id not in product_rules:
+        add_validation_error(
+            errors,
+            join_validation_path(path, "productId"),
+            f"is an unknown product ({product_id})",
+        )
+        return None
+
+    rules = product_rules[product_id]
+    validated_order_item = {
+        "id": str(uuid.uuid4()),
+        "productId": product_id,
+        "basePrice": rules.base_price,
+    }
 
     if "coffeeType" in item:
         coffee_type = to_coffee_type(item["coffeeType"])
-        if (
-            coffee_type is None
-            or coffee_type not in validated_product["allowedCoffeeTypes"]
-        ):
-            return (
-                False,
-                f"Order item {index+1} has invalid coffee type ({coffee_type}). Valid value(s): {', '.join(validated_product['allowedCoffeeTypes'])}",
+        if coffee_type is None or coffee_type not in rules.coffee_types:
+            add_validation_error(
+                errors,
+                join_validation_path(path, "coffeeType"),
+                f"has invalid coffee type ({item['coffeeType']}). Valid value(s): {', '.join(rules.coffee_type_names)}",
             )
+        else:
+            validated_order_item["coffeeType"] = coffee_type
 
-        validated_order_item["coffeeType"] = coffee_type
-    else:
-        return False, f"Order item {index+1} must have coffee type specified"
-
+    milk_path = join_validation_path(path, "milkType")
     if "milkType" in item:
-        if "allowedMilkTypes" not in validated_product:
-            return (
-                False,
-                f"Order item {index+1} specified a milk type but product doest not support milk types",
-            )
-
         milk_type = to_milk_type(item["milkType"])
-        if milk_type is None or milk_type not in validated_product["allowedMilkTypes"]:
-            return (
-                False,
-                f"Order item {index+1} has invalid milk type ({milk_type}). Valid value(s): {', '.join(validated_product['allowedMilkTypes'])}",
+        if rules.milk_types is None:
+            add_validation_error(
+                errors, milk_path, "is set but the product does not support milk types"
             )
-
-        validated_order_item["milkType"] = milk_type
-    elif validated_product["allowedMilkTypes"] is not None:
-        return (
-            False,
-            f"Order item {index+1} must specify a milk type. Valid value(s): {', '.join(validated_product['allowedMilkTypes'])}",
+        elif milk_type is None or milk_type not in rules.milk_types:
+            add_validation_error(
+                errors,
+                milk_path,
+                f"has invalid milk type ({item['milkType']}). Valid value(s): {', '.join(rules.milk_type_names)}",
+            )
+        else:
+            validated_order_item["milkType"] = milk_type
+    elif rules.milk_types is not None:
+        add_validation_error(
+            errors,
+            milk_path,
+            f"is required. Valid value(s): {', '.join(rules.milk_type_names)}",
         )
 
     if "additions" in item:
         validated_additions = []
-        allowed_addition_ids = (
-            validated_product["allowedAdditions"]
-            if "allowedAdditions" in validated_product
-            else []
-        )
-
-        for addition in item["additions"]:
-            if "id" not in addition:
-                return False, f"Order item {index+1} must specify addition IDs"
-            elif addition["id"] not in known_additions:
-                return (
-                    False,
-                    f"Order item {index+1} uses unknown addition {addition['id']}",
+        additions_path = join_validation_path(path, "additions")
+        for index, addition in enumerate(item["additions"]):
+            if addition is None or "id" not in addition:
+                continue
+
+            addition_id = addition["id"]
+            addition_path = join_validation_path(
+                join_validation_path(additions_path, index), "id"
+            )
+            if addition_id not in known_additions:
+                add_validation_error(
+                    errors, addition_path, f"is an unknown addition ({addition_id})"
                 )
-            elif addition["id"] not in allowed_addition_ids:
-                return (
-                    False,
-                    f"Order item {index+1} uses {addition['id']} which is not allowed on that product",
+            elif addition_id not in rules.additions:
+                add_validation_error(
+                    errors,
+                    addition_path,
+                    f"uses {addition_id} which is not allowed on that product",
                 )
-
-            valid_addition = known_additions[addition["id"]]
-            if not valid_addition["enabled"]:
-                return (
-                    False,
-                    f"Order item {index+1} uses disabled addition {addition['id']}",
+            elif not rules.additions[addition_id]["enabled"]:
+                add_validation_error(
+                    errors, addition_path, f"uses disabled addition {addition_id}"
                 )
             else:
-                validated_additions.append(valid_addition)
+                validated_additions.append(rules.additions[addition_id])
         validated_order_item["additions"] = validated_additions
 
-    return True, validated_order_item
+    return validated_order_item
+
+
+def validate_order_items(items, path, product_rules, known_additions, errors):
+    return [
+        validate_order_item(
+            item,
+            join_validation_path(path, index),
+            product_rules,
+            known_additions,
+            errors,
+        )
+        for index, item in enumerate(items)
+    ]
+
+
+def build_quoted_order_item(item, product_rules):
+    rules = product_rules[str(item["productId"])]
+    quoted_item = {
+        "id": str(uuid.uuid4()),
+        "productId": rules.product_id,
+        "basePrice": rules.base_price,
+        "coffeeType": to_coffee_type(item["coffeeType"]),
+    }
+    if "milkType" in item:
+        quoted_item["milkType"] = to_milk_type(item["milkType"])
+    if "additions" in item:
+        quoted_item["additions"] = [
+            rules.additions[addition["id"]] for addition in item["additions"]
+        ]
+    return quoted_item
+
+
+def build_line_item_pricing(validated_item):
+    addition_prices = [
+        {"id": addition["id"], "price": addition["price"]}
+        for addition in validated_item.get("additions", [])
+    ]
+    return {
+        "productId": validated_item["productId"],
+        "basePrice": validated_item["basePrice"],
+        "additions": addition_prices,
+        "itemTotal": from_cents(calculate_item_total_cents(validated_item)),
+    }
+
+
+def verify_quote_token(customer_id, quote_token, items):
+    if quote_token is None:
+        return None
+
+    quote = verify_signed_payload(quote_token, get_quote_signing_key())
+    if quote is None:
+        print("Ignoring quote token with a bad signature")
+        return None
+
+    _, _, catalog_version = get_cached_catalog(dynamo)
+    if (
+        quote.get("customerId") != customer_id
+        or quote.get("expiresAt", 0) < int(time.time())
+        or quote.get("catalogVersion") != catalog_version
+        or quote.get("cartHash") != compute_cart_hash(items)
+    ):
+        print("Ignoring stale quote token")
+        return None
+
+    return quote
+
+
+def quote_order(event, context):
+    customer_id = extract_user_id(event)
+
+    if "body" not in event or event["body"] is None:
+        return build_error_response(
+            ErrorCodes.MISSING_BODY, "Must specify a request body"
+        )
+
+    input_order = json.loads(event["body"], parse_float=Decimal)
+    validated_input, errors = validate_schema(ORDER_QUOTE_SCHEMA, input_order)
+    if len(errors) > 0:
+        return build_validation_error_response(errors)
+
+    items = validated_input["items"]
+    product_rules, additions, catalog_version = get_cached_product_rules(dynamo)
+    data = validate_order_items(items, "items", product_rules, additions, errors)
+    if len(errors) > 0:
+        return build_validation_error_response(errors)
+
+    subtotal, commission, delivery_fee = calculate_order_fees({"items": data})
+    line_items = [build_line_item_pricing(item) for item in data]
+    expires_at = int(time.time()) + QUOTE_TTL_SECONDS
+
+    quote_token = sign_payload(
+        {
+            "customerId": customer_id,
+            "cartHash": compute_cart_hash(items),
+            "catalogVersion": catalog_version,
+            "commissionCents": commission,
+            "deliveryFeeCents": delivery_fee,
+            "expiresAt": expires_at,
+        },
+        get_quote_signing_key(),
+    )
+
+    return build_response(
+        200,
+        {
+            "items": line_items,
+            "subtotal": from_cents(subtotal),
+            "commission": from_cents(commission),
+            "deliveryFee": from_cents(delivery_fee),
+            "expiresAt": expires_at,
+            "quoteToken": quote_token,
+        },
+    )
 
 
 def create_order(customer_id, order):
     id = str(uuid.uuid4())
+    updated_at = current_timestamp_millis()
     validated_order = {
         "customerId": customer_id,
         "id": id,
         "orderStatus": OrderStatus.RECEIVED.value,
+        "updatedAt": updated_at,
+        "version": 1,
     }
 
     print("Validating order...")
 
-    if "deliveryTime" in order:
-        delivery_time = order["deliveryTime"]
-        try:
-            delivery_time = datetime.strptime(delivery_time, "%Y-%m-%dT%H:%M:%S.%fZ")
-            if delivery_time < datetime.now() + MINIMUM_ORDER_TIME_DELTA:
-                return (
-                    False,
-                    None,
-                    f"Order delivery time must be at least {MINIMUM_ORDER_TIME_DELTA_MINUTES} minutes in the future",
-                )
-
-            validated_order["deliveryTime"] = f"{delivery_time.isoformat()}Z"
-        except:
-            return False, None, "Invalid delivery time"
-    else:
-        return False, None, "Order must have a delivery time"
-
-    if "deliveryLocation" in order:
-        is_valid, data = validate_location(
-            order["deliveryLocation"], "Delivery location"
-        )
-        if is_valid:
-            validated_order["deliveryLocation"] = data
-        else:
-            return False, None, data
-    else:
-        return False, None, "Order must have a delivery location"
-
-    if "payment" in order:
-        is_valid, data = validate_payment_information(
-            order["payment"], "Payment information"
-        )
-        if is_valid:
-            validated_order["payment"] = data
-        else:
-            return False, None, data
+    validated_input, errors = validate_schema(ORDER_SCHEMA, order)
+    if validated_input is None:
+        return False, None, errors
+    validated_order.update(validated_input)
+
+    items = validated_input.get("items") or []
+    quote = None
+    if len(errors) == 0:
+        quote = verify_quote_token(customer_id, order.get("quoteToken"), items)
+
+    if quote is not None:
+        # The quote already validated this exact cart against this catalog version
+        print("Using quoted prices...")
+        product_rules, _, _ = get_cached_product_rules(dynamo)
+        validated_order["items"] = [
+            build_quoted_order_item(item, product_rules) for item in items
+        ]
+        validated_order["commission"] = from_cents(quote["commissionCents"])
+        validated_order["deliveryFee"] = from_cents(quote["deliveryFeeCents"])
     else:
-        return False, None, "Order must have payment information"
-
-    if "items" not in order or len(order["items"]) == 0:
-        return False, None, "Order must have items"
-
-    items = order["items"]
-    products, additions = collect_used_products_and_additions(items)
+        # Catalog rules are checked even when other fields failed, so every
+        # problem is reported in one response. Missing or empty items were
+        # already reported by the schema and have nothing to check
+        if len(items) > 0:
+            products, additions = collect_used_products_and_additions(items)
+            product_rules = compile_product_rules(products, additions)
+            validated_order["items"] = validate_order_items(
+                items, "items", product_rules, additions, errors
+            )
+        if len(errors) > 0:
+            return False, None, errors
 
-    validated_items = []
-    for index, item in enumerate(items):
-        is_valid, data = validate_order_item(item, index, products, additions)
-        if is_valid:
-            validated_items.append(data)
-        else:
-            return False, None, f"Order item {index+1} invalid: {str(item)}"
-    validated_order["items"] = validated_items
+        print("Calculating fees...")
+        _, commission, delivery_fee = calculate_order_fees(validated_order)
+        validated_order["commission"] = from_cents(commission)
+        validated_order["deliveryFee"] = from_cents(delivery_fee)
 
-    print("Calculating fees...")
-    validated_order["commission"] = calculate_commission(validated_order)
-    validated_order["deliveryFee"] = calculate_delivery_fee(validated_order)
+    apply_schedule_bucket(validated_order)
 
     print("Validated. Saving to Dynamo...", validated_order)
 
     dynamo.put_item(
         TableName=EnvironmentVariables.ORDERS_TABLE.value,
-        Item=serialize_to_dynamo_object(validated_order),
+        Item=serialize_to_dynamo_object(compact_order(validated_order)),
     )
 
     order_status_info = {
         "id": id,
         "customerId": customer_id,
         "orderStatus": OrderStatus.RECEIVED.value,
-        "updating": False
+        "updatedAt": updated_at,
+        "version": 1,
     }
     initialize_order_status(dynamo, order_status_info)
 
     print("Order saved")
     validated_order.pop("customerId")
+    validated_order.pop("scheduleBucket", None)
+    validated_order.pop("areaBucket", None)
     return True, validated_order, id
 
 
@@ -415,7 +1068,7 @@ def submit_order(event, context):
         send_order_status_update_message(customer_id, order["id"], order["orderStatus"])
         return build_response(200, order)
     else:
-        return build_error_response(ErrorCodes.INVALID_DATA, data)
+        return build_validation_error_response(data)
 
 
 def lambda_handler(event, context):
@@ -438,14 +1091,24 @@ def lambda_handler(event, context):
             if httpMethod == "GET":
                 if resource == "/orders":
                     response = get_orders(event, context)
+                elif resource == "/orders/export/{id}":
+                    response = get_orders_export(event, context)
+                elif resource == "/orders/ratings":
+                    response = get_orders_ratings(event, context)
                 elif resource == "/orders/{id}/ratings":
                     response = get_order_ratings(event, context)
                 elif resource == "/orders/{id}":
                     response = get_single_order(event, context)
             elif httpMethod == "POST" and resource == "/orders":
                 response = submit_order(event, context)
+            elif httpMethod == "POST" and resource == "/orders/quote":
+                response = quote_order(event, context)
+            elif httpMethod == "POST" and resource == "/orders/export":
+                response = export_orders(event, context)
             elif httpMethod == "PUT" and resource == "/orders/{id}/ratings":
                 response = submit_order_rating(event, context)
+            elif httpMethod == "PUT" and resource == "/orders/ratings":
+                response = submit_order_ratings(event, context)
     except Exception as e:
         error_string = traceback.format_exc()
         print(error_string)
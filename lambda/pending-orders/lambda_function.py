@@ -1,28 +1,60 @@
 import traceback
+from datetime import timedelta
 
 import boto3
 from project_utility import (
+    EARNINGS_OWNER_SHOP,
+    EXPORT_OWNER_SHOPS,
+    ORDERS_SHOP_UPDATED_AT_INDEX,
+    SCHEDULE_QUEUE_SHOP,
     EnvironmentVariables,
     ErrorCodes,
     OrderStatus,
     UserRole,
+    attach_live_order_status,
+    build_bulk_outcome,
     build_error_response,
+    build_projection_expression,
     build_response,
     deserialize_dynamo_object,
+    expand_order_items,
     extract_user_id,
+    get_bounded_int_parameter,
+    get_earnings,
+    get_earnings_date_range,
+    get_fields_parameter,
+    get_nearby_areas,
+    get_order_export,
+    get_order_ids_from_body,
     get_order_status,
+    get_order_statuses,
     get_path_parameter,
     get_query_parameter,
     get_shop_by_id,
+    get_since_parameter,
+    get_zip_area,
     is_shop_set_up,
+    query_all_items,
+    query_scheduled_orders,
     send_order_update_task,
+    send_order_update_tasks,
+    start_order_export,
     user_has_role,
 )
 
 # Clients
 dynamo = boto3.client("dynamodb")
+s3 = boto3.client("s3")
+sqs = boto3.client("sqs")
 
 # Constants
+LIVE_STATUS_FLAG = "liveStatus"
+DEFAULT_AVAILABLE_LIMIT = 50
+MAX_AVAILABLE_LIMIT = 100
+DEFAULT_WINDOW_HOURS = 48
+MAX_WINDOW_HOURS = 7 * 24
+DEFAULT_AREA_RADIUS = 1
+MAX_AREA_RADIUS = 10
 TRANFER_FIELDS = [
     "id",
     "orderStatus",
@@ -30,7 +62,25 @@ TRANFER_FIELDS = [
     "deliveryLocation",
     "commission",
     "items",
+    "updatedAt",
 ]
+# Statuses a shop may move its orders to, any other transition is rejected
+SHOP_STATUS_TRANSITIONS = {
+    OrderStatus.BREWING.value: [OrderStatus.MADE.value],
+}
+SHOP_NEW_STATUSES = {
+    status for statuses in SHOP_STATUS_TRANSITIONS.values() for status in statuses
+}
+
+
+def get_requested_fields(event):
+    fields, invalid_fields = get_fields_parameter(event, TRANFER_FIELDS, ["id"])
+    if len(invalid_fields) > 0:
+        return None, build_error_response(
+            ErrorCodes.INVALID_DATA,
+            f"Invalid field(s): {', '.join(invalid_fields)}. Valid field(s): {', '.join(TRANFER_FIELDS)}",
+        )
+    return fields, None
 
 
 def transfer_field(raw_order, destination_order, field, required=False):
@@ -40,56 +90,171 @@ def transfer_field(raw_order, destination_order, field, required=False):
         raise ValueError(f"Required field {field} not found on order")
 
 
-def build_pending_orders_from_dynamo_response(items):
+def build_pending_orders_from_dynamo_response(items, fields=TRANFER_FIELDS):
     orders = []
     for item in items:
-        order = deserialize_dynamo_object(item)
+        order = expand_order_items(dynamo, deserialize_dynamo_object(item))
         cleaned_order = {}
-        for field in TRANFER_FIELDS:
+        for field in fields:
             transfer_field(order, cleaned_order, field)
 
         orders.append(cleaned_order)
     return orders
 
 
+def get_changed_orders(shop_id, since, projection_expression, expression_names):
+    print(f"Looking up orders for shop {shop_id} changed since {since}")
+    return query_all_items(
+        dynamo,
+        {
+            "TableName": EnvironmentVariables.ORDERS_TABLE.value,
+            "IndexName": ORDERS_SHOP_UPDATED_AT_INDEX,
+            "KeyConditionExpression": "shopId = :shopId AND updatedAt > :since",
+            "ProjectionExpression": projection_expression,
+            "ExpressionAttributeNames": expression_names,
+            "ExpressionAttributeValues": {
+                ":shopId": {
+                    "S": shop_id,
+                },
+                ":since": {
+                    "N": str(since),
+                },
+            },
+        },
+    )
+
+
 def get_previous_orders(event, context):
     shop_id = extract_user_id(event)
 
-    print(f"Looking up orders for shop {shop_id}")
-    response = dynamo.scan(
-        TableName=EnvironmentVariables.ORDERS_TABLE.value,
-        FilterExpression="shopId = :shopId",
-        ExpressionAttributeValues={
-            ":shopId": {
-                "S": shop_id,
+    fields, error_response = get_requested_fields(event)
+    if error_response is not None:
+        return error_response
+    projection_expression, expression_names = build_projection_expression(fields)
+
+    try:
+        since = get_since_parameter(event)
+    except ValueError:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, "Since must be a non-negative timestamp"
+        )
+
+    if since is not None:
+        orders = get_changed_orders(
+            shop_id, since, projection_expression, expression_names
+        )
+    else:
+        print(f"Looking up orders for shop {shop_id}")
+        response = dynamo.scan(
+            TableName=EnvironmentVariables.ORDERS_TABLE.value,
+            FilterExpression="shopId = :shopId",
+            ProjectionExpression=projection_expression,
+            ExpressionAttributeNames=expression_names,
+            ExpressionAttributeValues={
+                ":shopId": {
+                    "S": shop_id,
+                },
             },
-        },
-    )
-    orders = response["Items"]
+        )
+        orders = response["Items"]
 
     print(f"Found {len(orders)} orders")
-    orders = build_pending_orders_from_dynamo_response(orders)
+    orders = build_pending_orders_from_dynamo_response(orders, fields)
+    if get_query_parameter(event, LIVE_STATUS_FLAG, "false").lower() == "true":
+        attach_live_order_status(dynamo, orders)
     return build_response(200, orders)
 
 
+def export_previous_orders(event, context):
+    shop_id = extract_user_id(event)
+
+    fields, error_response = get_requested_fields(event)
+    if error_response is not None:
+        return error_response
+
+    try:
+        since = get_since_parameter(event)
+    except ValueError:
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, "Since must be a non-negative timestamp"
+        )
+
+    print(f"Exporting orders for shop {shop_id}")
+    return start_order_export(dynamo, sqs, EXPORT_OWNER_SHOPS, shop_id, fields, since)
+
+
+def get_previous_orders_export(event, context):
+    shop_id = extract_user_id(event)
+
+    export_id = get_path_parameter(event, "id", None)
+    if export_id is None:
+        return build_error_response(ErrorCodes.MISSING_DATA, "Must specify an export ID")
+
+    return get_order_export(dynamo, s3, EXPORT_OWNER_SHOPS, shop_id, export_id)
+
+
+def get_earnings_summary(event, context):
+    shop_id = extract_user_id(event)
+
+    try:
+        first_day, last_day = get_earnings_date_range(event)
+    except ValueError as e:
+        return build_error_response(ErrorCodes.INVALID_DATA, str(e))
+
+    print(f"Looking up earnings for shop {shop_id} from {first_day} to {last_day}")
+    earnings = get_earnings(dynamo, EARNINGS_OWNER_SHOP, shop_id, first_day, last_day)
+    return build_response(200, earnings)
+
+
 def get_available_orders(event, context):
     shop_id = extract_user_id(event)
 
-    print(f"Looking up available orders for shop {shop_id}")
-    response = dynamo.scan(
-        TableName=EnvironmentVariables.ORDERS_TABLE.value,
-        FilterExpression="attribute_not_exists(shopId)",
+    fields, error_response = get_requested_fields(event)
+    if error_response is not None:
+        return error_response
+
+    try:
+        limit = get_bounded_int_parameter(
+            event, "limit", DEFAULT_AVAILABLE_LIMIT, 1, MAX_AVAILABLE_LIMIT
+        )
+        window_hours = get_bounded_int_parameter(
+            event, "windowHours", DEFAULT_WINDOW_HOURS, 1, MAX_WINDOW_HOURS
+        )
+        radius = get_bounded_int_parameter(
+            event, "radius", DEFAULT_AREA_RADIUS, 0, MAX_AREA_RADIUS
+        )
+    except ValueError as e:
+        return build_error_response(ErrorCodes.INVALID_DATA, str(e))
+
+    shop_info = get_shop_by_id(dynamo, shop_id)
+    area = get_zip_area(shop_info.get("location")) if shop_info else None
+
+    # Without a known area, fall back to every available order in the window
+    areas = get_nearby_areas(area, radius) if area is not None else None
+
+    print(
+        f"Looking up {limit} available orders due within {window_hours} hours for shop {shop_id} near area {area}"
+    )
+    orders = query_scheduled_orders(
+        dynamo,
+        SCHEDULE_QUEUE_SHOP,
+        timedelta(hours=window_hours),
+        limit,
+        fields,
+        areas,
     )
-    orders = response["Items"]
 
     print(f"Found {len(orders)} orders")
-    orders = build_pending_orders_from_dynamo_response(orders)
+    orders = build_pending_orders_from_dynamo_response(orders, fields)
 
     return build_response(200, orders)
 
 
 def get_order_for_shop(shop_id, order_id):
     print(f"Getting order {order_id} for shop {shop_id}")
+    projection_expression, expression_names = build_projection_expression(
+        TRANFER_FIELDS
+    )
     response = dynamo.scan(
         TableName=EnvironmentVariables.ORDERS_TABLE.value,
         FilterExpression="id = :orderId AND shopId = :shopId",
@@ -101,6 +266,8 @@ def get_order_for_shop(shop_id, order_id):
                 "S": shop_id,
             },
         },
+        ProjectionExpression=projection_expression,
+        ExpressionAttributeNames=expression_names,
     )
 
     orders = response["Items"] if "Items" in response else None
@@ -150,6 +317,7 @@ def secure_order(event, context):
             OrderStatus.RECEIVED.value,
             OrderStatus.BREWING.value,
             new_order_info,
+            shop_id,
         )
         is None
     ):
@@ -159,6 +327,15 @@ def secure_order(event, context):
     return build_response(200, None)
 
 
+def is_valid_new_status(new_status):
+    # Bodies are arbitrary JSON, so the status may not even be a string
+    return isinstance(new_status, str) and new_status in SHOP_NEW_STATUSES
+
+
+def is_valid_status_transition(current_status, new_status):
+    return new_status in SHOP_STATUS_TRANSITIONS.get(current_status, [])
+
+
 def update_order_status(event, context):
     shop_id = extract_user_id(event)
 
@@ -167,7 +344,7 @@ def update_order_status(event, context):
         return build_error_response(ErrorCodes.MISSING_DATA, "Must specify an order ID")
 
     new_status = get_query_parameter(event, "newStatus", OrderStatus.MADE.value)
-    if new_status != OrderStatus.MADE.value:
+    if not is_valid_new_status(new_status):
         return build_error_response(
             ErrorCodes.INVALID_DATA, f"Invalid new status: {new_status}"
         )
@@ -180,6 +357,11 @@ def update_order_status(event, context):
     ):
         return build_error_response(ErrorCodes.NOT_FOUND, "Order not found")
 
+    if not is_valid_status_transition(order_status["orderStatus"], new_status):
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, f"Invalid new status: {new_status}"
+        )
+
     if (
         send_order_update_task(
             dynamo,
@@ -188,6 +370,7 @@ def update_order_status(event, context):
             order_status["orderStatus"],
             new_status,
             None,
+            shop_id,
         )
         is None
     ):
@@ -197,6 +380,92 @@ def update_order_status(event, context):
     return build_response(200, None)
 
 
+def secure_orders(event, context):
+    shop_id = extract_user_id(event)
+
+    order_ids, _, error_response = get_order_ids_from_body(event)
+    if error_response is not None:
+        return error_response
+
+    print(f"Attempting to secure {len(order_ids)} orders for shop {shop_id}")
+    order_statuses = get_order_statuses(dynamo, order_ids)
+
+    outcomes = {}
+    available = []
+    for order_id in order_ids:
+        order_status = order_statuses.get(order_id)
+        if (
+            order_status is None
+            or order_status["orderStatus"] != OrderStatus.RECEIVED.value
+        ):
+            outcomes[order_id] = build_bulk_outcome(
+                order_id, False, "Order is not available"
+            )
+        else:
+            available.append(order_status)
+
+    if len(available) > 0:
+        shop_info = get_shop_by_id(dynamo, shop_id)
+        new_order_info = {"shopId": shop_id, "preparedLocation": shop_info["location"]}
+        results = send_order_update_tasks(
+            dynamo, available, OrderStatus.BREWING.value, new_order_info, shop_id
+        )
+        for order_id, message_id in results.items():
+            if message_id is None:
+                outcomes[order_id] = build_bulk_outcome(
+                    order_id, False, "Failed to secure order"
+                )
+            else:
+                outcomes[order_id] = build_bulk_outcome(order_id, True)
+
+    return build_response(200, [outcomes[order_id] for order_id in order_ids])
+
+
+def update_orders_status(event, context):
+    shop_id = extract_user_id(event)
+
+    order_ids, body, error_response = get_order_ids_from_body(event)
+    if error_response is not None:
+        return error_response
+
+    new_status = body.get("newStatus", OrderStatus.MADE.value)
+    if not is_valid_new_status(new_status):
+        return build_error_response(
+            ErrorCodes.INVALID_DATA, f"Invalid new status: {new_status}"
+        )
+
+    order_statuses = get_order_statuses(dynamo, order_ids)
+
+    outcomes = {}
+    owned = []
+    for order_id in order_ids:
+        order_status = order_statuses.get(order_id)
+        if (
+            order_status is None
+            or "shopId" not in order_status
+            or order_status["shopId"] != shop_id
+        ):
+            outcomes[order_id] = build_bulk_outcome(order_id, False, "Order not found")
+        elif not is_valid_status_transition(order_status["orderStatus"], new_status):
+            outcomes[order_id] = build_bulk_outcome(
+                order_id, False, f"Invalid new status: {new_status}"
+            )
+        else:
+            owned.append(order_status)
+
+    if len(owned) > 0:
+        results = send_order_update_tasks(dynamo, owned, new_status, None, shop_id)
+        for order_id, message_id in results.items():
+            if message_id is None:
+                outcomes[order_id] = build_bulk_outcome(
+                    order_id, False, "Failed to update order"
+                )
+            else:
+                outcomes[order_id] = build_bulk_outcome(order_id, True)
+
+    return build_response(200, [outcomes[order_id] for order_id in order_ids])
+
+
 def lambda_handler(event, context):
     print(f"Received event: {event}")
     print(f"Context: {context}")
@@ -223,6 +492,10 @@ def lambda_handler(event, context):
             if httpMethod == "GET":
                 if resource == "/pending-orders":
                     response = get_previous_orders(event, context)
+                elif resource == "/pending-orders/export/{id}":
+                    response = get_previous_orders_export(event, context)
+                elif resource == "/pending-orders/earnings":
+                    response = get_earnings_summary(event, context)
                 elif resource == "/pending-orders/available":
                     response = get_available_orders(event, context)
                 elif resource == "/pending-orders/{id}":
@@ -232,6 +505,12 @@ def lambda_handler(event, context):
                     response = secure_order(event, context)
                 elif resource == "/pending-orders/{id}/status":
                     response = update_order_status(event, context)
+                elif resource == "/pending-orders/secure":
+                    response = secure_orders(event, context)
+                elif resource == "/pending-orders/status":
+                    response = update_orders_status(event, context)
+                elif resource == "/pending-orders/export":
+                    response = export_previous_orders(event, context)
     except Exception as e:
         error_string = traceback.format_exc()
         print(error_string)
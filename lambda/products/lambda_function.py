@@ -15,6 +15,7 @@ from project_utility import (
     deserialize_dynamo_object,
     extract_user_id,
     get_additions_by_id,
+    get_product_rating_aggregates,
     get_query_parameter,
     is_valid_user,
     serialize_to_dynamo_object,
@@ -29,6 +30,7 @@ dynamo = boto3.client("dynamodb")
 
 # Constants
 INCLUDE_DISABLED_FLAG = "includeDisabled"
+INCLUDE_RATINGS_FLAG = "includeRatings"
 PRODUCT_TYPE = "PRODUCT"
 ADDITION_TYPE = "ADDITION"
 
@@ -87,9 +89,31 @@ def get_products(event, context):
                     if include_disabled or addition["enabled"]:
                         allowed_additions.append(all_additions[id])
             product["allowedAdditions"] = allowed_additions
+
+    include_ratings = (
+        get_query_parameter(event, INCLUDE_RATINGS_FLAG, "false").lower() == "true"
+    )
+    if include_ratings:
+        attach_product_ratings(products)
+
     return build_response(200, products)
 
 
+def attach_product_ratings(products):
+    print(f"Attaching ratings to {len(products)} products")
+    aggregates = get_product_rating_aggregates(
+        dynamo, [product["id"] for product in products]
+    )
+    for product in products:
+        aggregate = aggregates.get(product["id"])
+        if aggregate is not None:
+            product["averageRating"] = aggregate["averageRating"]
+            product["ratingCount"] = aggregate["ratingCount"]
+        else:
+            product["averageRating"] = None
+            product["ratingCount"] = 0
+
+
 def create_product(product):
     validated_product = {"_type": PRODUCT_TYPE}
 
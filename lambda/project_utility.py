@@ -1,7 +1,19 @@
+import base64
+import hashlib
+import hmac
 import json
 import os
+import random
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal, InvalidOperation
 from enum import Enum
+from typing import NamedTuple, Optional
 
 import boto3
 from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
@@ -22,6 +34,21 @@ class EnvironmentVariables(Enum):
         "ORDER_UPDATE_CONFIRMATION_QUEUE_URL"
     ]
     UI_BASE_URL = os.environ["UI_BASE_URL"]
+    PRODUCT_RATINGS_TABLE = os.environ["PRODUCT_RATINGS_TABLE"]
+    ORDER_STATUS_TOPIC_ARN = os.environ["ORDER_STATUS_TOPIC_ARN"]
+    ORDER_FEED_CONNECTIONS_TABLE = os.environ["ORDER_FEED_CONNECTIONS_TABLE"]
+    ORDER_FEED_QUEUE_URL = os.environ["ORDER_FEED_QUEUE_URL"]
+    ORDER_MATCHING_QUEUE_URL = os.environ["ORDER_MATCHING_QUEUE_URL"]
+    QUOTE_SIGNING_SECRET_ARN = os.environ["QUOTE_SIGNING_SECRET_ARN"]
+    ORDER_FEED_TOKEN_SECRET_ARN = os.environ["ORDER_FEED_TOKEN_SECRET_ARN"]
+    ORDER_ARCHIVE_TABLE = os.environ["ORDER_ARCHIVE_TABLE"]
+    ORDER_ARCHIVE_AGE_DAYS = os.environ["ORDER_ARCHIVE_AGE_DAYS"]
+    ORDER_EXPORT_BUCKET = os.environ["ORDER_EXPORT_BUCKET"]
+    EARNINGS_TABLE = os.environ["EARNINGS_TABLE"]
+    ORDER_STATUS_COUNTERS_TABLE = os.environ["ORDER_STATUS_COUNTERS_TABLE"]
+    PARKED_MESSAGES_TABLE = os.environ["PARKED_MESSAGES_TABLE"]
+    ORDER_EXPORTS_TABLE = os.environ["ORDER_EXPORTS_TABLE"]
+    ORDER_EXPORT_QUEUE_URL = os.environ["ORDER_EXPORT_QUEUE_URL"]
 
     def __str__(self):
         return self.name
@@ -38,13 +65,136 @@ USER_INFO_USERNAME_TAG = "username"
 USER_INFO_DISPLAY_NAME_TAG = "displayName"
 USER_INFO_ROLES_TAG = "roles"
 
-COMMISSION_RATE = Decimal("0.20")
-MIN_COMMISSION = Decimal("3")
-DELIVERY_FEE_RATE = Decimal("0.1")
-MIN_DELIVERY_FEE = Decimal("1.5")
+# Money is handled as integer cents and rates as basis points inside pricing
+CENTS_PER_UNIT = 100
+BASIS_POINTS_PER_UNIT = 10000
+COMMISSION_RATE_BASIS_POINTS = 2000
+MIN_COMMISSION_CENTS = 300
+DELIVERY_FEE_RATE_BASIS_POINTS = 1000
+MIN_DELIVERY_FEE_CENTS = 150
+PRICE_CENTS_CACHE_SIZE = 4096
+
+ORDERS_CUSTOMER_DELIVERY_TIME_INDEX = "customerId-deliveryTime-index"
+ORDERS_CUSTOMER_UPDATED_AT_INDEX = "customerId-updatedAt-index"
+ORDERS_SHOP_UPDATED_AT_INDEX = "shopId-updatedAt-index"
+ORDERS_DELIVERER_UPDATED_AT_INDEX = "delivererId-updatedAt-index"
+ORDERS_SCHEDULE_INDEX = "scheduleBucket-deliveryTime-index"
+ORDERS_AREA_SCHEDULE_INDEX = "areaBucket-deliveryTime-index"
+
+SCHEDULE_QUEUE_SHOP = "SHOP"
+SCHEDULE_QUEUE_DELIVERY = "DELIVERY"
+SCHEDULE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+SCHEDULE_AREA_LENGTH = 3
+
+ORDER_FORMAT_FIELD = "_fmt"
+COMPACT_ORDER_FORMAT = 2
+
+# Delivered orders are copied to the archive once archiveAt has passed, statuses expire by TTL
+ORDER_ARCHIVE_AT_FIELD = "archiveAt"
+# Day of archiveAt, so the archive job only queries the days that can be due
+ORDER_ARCHIVE_BUCKET_FIELD = "archiveBucket"
+ORDER_ARCHIVE_BUCKET_FORMAT = "%Y-%m-%d"
+
+MIN_RATING = 1
+MAX_RATING = 5
+RATING_HISTOGRAM_PREFIX = "histogram"
+# Set on ratings counted in the product aggregates, older ratings were never counted
+RATING_AGGREGATED_FIELD = "aggregated"
+BATCH_GET_MAX_KEYS = 100
+BATCH_WRITE_MAX_ITEMS = 25
+# Unprocessed batch keys or items mean the table is throttling, so back off before retrying
+BATCH_RETRY_MAX_ATTEMPTS = 8
+BATCH_RETRY_BASE_SECONDS = 0.05
+BATCH_RETRY_MAX_SECONDS = 2
+TRANSACT_WRITE_MAX_ITEMS = 100
+SQS_BATCH_MAX_MESSAGES = 10
+
+# SQS consumers stop before their timeout so only unstarted records are redelivered.
+# A record is expected to take as long as the slowest one so far in the batch
+SQS_RECORD_COST_ESTIMATE_MILLIS = 1000
+SQS_DEADLINE_RESERVE_MILLIS = 500
+
+# Transiently failing messages come back after an exponentially growing visibility
+# timeout. Permanent failures and messages that keep failing are parked for review
+SQS_RETRY_BASE_SECONDS = 5
+SQS_RETRY_MAX_SECONDS = 15 * 60
+SQS_MAX_RECEIVES = 8
+PARKED_MESSAGE_TTL_DAYS = 14
+PARK_REASON_PERMANENT = "PERMANENT"
+PARK_REASON_RETRIES_EXHAUSTED = "RETRIES_EXHAUSTED"
+BULK_MAX_ORDERS = 100
+
+CATALOG_CACHE_TTL_SECONDS = 60
+SIGNING_KEY_CACHE_TTL_SECONDS = 300
+# Browsers can't send the API key header on WebSocket connects, so the order
+# feed is joined with a short-lived token fetched over the REST API instead
+ORDER_FEED_TOKEN_TTL_SECONDS = 5 * 60
+
+# Earnings rollups hold one row per shop or deliverer per UTC day
+EARNINGS_OWNER_SHOP = "SHOP"
+EARNINGS_OWNER_DELIVERER = "DELIVERER"
+EARNINGS_DAY_FORMAT = "%Y-%m-%d"
+EARNINGS_DEFAULT_RANGE_DAYS = 30
+EARNINGS_MAX_RANGE_DAYS = 366
+EARNINGS_SUM_FIELDS = {
+    "commissionCents": "commission",
+    "deliveryFeeCents": "deliveryFee",
+}
+
+# S3 multipart parts must be at least 5 MB except for the last one
+EXPORT_PART_BYTES = 8 * 1024 * 1024
+EXPORT_URL_TTL_SECONDS = 15 * 60
+EXPORT_CONTENT_TYPE = "application/x-ndjson"
+# Exports run in order-export, the API only queues them and reports their status
+EXPORT_OWNER_CUSTOMERS = "customers"
+EXPORT_OWNER_SHOPS = "shops"
+EXPORT_OWNER_DELIVERERS = "deliverers"
+EXPORT_STATUS_PENDING = "PENDING"
+EXPORT_STATUS_COMPLETE = "COMPLETE"
+EXPORT_STATUS_FAILED = "FAILED"
+# Matches the export bucket lifecycle, so a job never outlives its file
+EXPORT_JOB_TTL_SECONDS = 24 * 60 * 60
+QUOTE_TTL_SECONDS = 5 * 60
+
+# Live order counts per status are spread over shards so busy statuses don't
+# contend on one item, a shard conflict is retried on freshly picked shards
+ORDER_STATUS_COUNTER_SHARDS = 10
+ORDER_STATUS_COUNTER_ATTEMPTS = 3
+
+# How long an order stays locked for a status update before it can be reclaimed
+ORDER_LEASE_DURATION_SECONDS = 60
+# The lease can only be taken once it expired, and while an order is offered
+# only by the offered candidate
+ORDER_LEASE_FREE_CONDITION = (
+    "(attribute_not_exists(leaseExpiresAt) OR leaseExpiresAt < :now)"
+    " AND (attribute_not_exists(offerExpiresAt) OR offerExpiresAt < :now"
+    " OR offeredTo = :owner)"
+)
+ORDER_STATUS_RESERVED_FIELDS = [
+    "id",
+    "orderStatus",
+    "updatedAt",
+    "version",
+    "leaseOwner",
+    "leaseExpiresAt",
+    "leaseToken",
+    "offeredTo",
+    "offerExpiresAt",
+    ORDER_ARCHIVE_AT_FIELD,
+]
 
 
 # Classes
+# Retrying can never make the message succeed, so it is parked right away
+class PermanentError(Exception):
+    pass
+
+
+# The failure may clear up on its own, so the message is retried with backoff
+class TransientError(Exception):
+    pass
+
+
 class ErrorCode:
     def __init__(self, internal_code: int, http_error_code: int):
         self.internal_code = internal_code
@@ -70,11 +220,22 @@ class UserNotificationType:
 
 class UserNotificationTypes(UserNotificationType, Enum):
     ORDER_STATUS_UPDATE = "ORDER_STATUS_UPDATE"
+    ORDER_OFFER = "ORDER_OFFER"
 
     def __str__(self):
         return self.name
 
 
+class ProductRules(NamedTuple):
+    product_id: str
+    base_price: Decimal
+    coffee_types: frozenset
+    coffee_type_names: tuple
+    milk_types: Optional[frozenset]
+    milk_type_names: Optional[tuple]
+    additions: dict
+
+
 class UserRole(Enum):
     REGULAR_USER = "REGULAR_USER"
     ADMIN = "ADMIN"
@@ -97,40 +258,394 @@ class OrderStatus(Enum):
         return self.name
 
 
-def calculate_order_total_percentage(order, rate, minimum):
-    order_total = Decimal(0)
-    for item in order["items"]:
-        order_total += item["basePrice"]
-        if "additions" in item:
-            for addition in item["additions"]:
-                order_total += addition["price"]
+# Sends queue and topic messages through SQS and SNS
+class SqsTransport:
+    def send_message(self, sqs, queue_url, message, delay_seconds=0):
+        response = sqs.send_message(
+            QueueUrl=queue_url,
+            MessageBody=json.dumps(message),
+            DelaySeconds=delay_seconds,
+        )
+        return response["MessageId"]
+
+    def send_message_batch(self, sqs, queue_url, messages):
+        message_ids = [None] * len(messages)
+        for start in range(0, len(messages), SQS_BATCH_MAX_MESSAGES):
+            entries = [
+                {"Id": str(index), "MessageBody": json.dumps(messages[index])}
+                for index in range(
+                    start, min(start + SQS_BATCH_MAX_MESSAGES, len(messages))
+                )
+            ]
+            response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+            for sent in response.get("Successful", []):
+                message_ids[int(sent["Id"])] = sent["MessageId"]
+            for failed in response.get("Failed", []):
+                print(f"Failed to send message {failed['Id']}", failed)
+
+        return message_ids
+
+    def publish_message(self, sns, topic_arn, message):
+        response = sns.publish(TopicArn=topic_arn, Message=json.dumps(message))
+        return response["MessageId"]
+
+
+# Hands messages straight to the lambda_handler subscribed to each queue or topic,
+# so the whole pipeline can run in one process. Messages are queued and delivered
+# in order by drain(), or concurrently on a thread pool, one record per event.
+# Delays and visibility backoff are ignored, failed records are redelivered at once
+class InProcessTransport:
+    def __init__(self, concurrent=False, max_workers=8):
+        self.handlers = {}
+        self.concurrent = concurrent
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if concurrent else None
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.in_flight = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, address, handler):
+        self.handlers.setdefault(address, []).append(handler)
+
+    def send_message(self, sqs, queue_url, message, delay_seconds=0):
+        return self._fan_out(queue_url, message)
+
+    def send_message_batch(self, sqs, queue_url, messages):
+        return [self._fan_out(queue_url, message) for message in messages]
+
+    def publish_message(self, sns, topic_arn, message):
+        return self._fan_out(topic_arn, message)
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if len(self.pending) == 0:
+                    while self.in_flight > 0:
+                        self.idle.wait()
+                    if len(self.pending) == 0:
+                        return
+                handler, record = self.pending.popleft()
+            self._deliver(handler, record)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def _fan_out(self, address, message):
+        handlers = self.handlers.get(address, [])
+        if len(handlers) == 0:
+            print(f"No in-process subscriber for {address}, dropping message")
+            with self.lock:
+                self.dropped += 1
+            return None
+
+        body = json.dumps(message)
+        message_ids = [str(uuid.uuid4()) for _ in handlers]
+        for handler, message_id in zip(handlers, message_ids):
+            self._dispatch(handler, build_in_process_record(message_id, body, 1))
+        return message_ids[0]
+
+    def _dispatch(self, handler, record):
+        with self.lock:
+            if not self.concurrent:
+                self.pending.append((handler, record))
+                return
+            self.in_flight += 1
+        self.executor.submit(self._run, handler, record)
+
+    def _run(self, handler, record):
+        try:
+            self._deliver(handler, record)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.idle.notify_all()
+
+    def _deliver(self, handler, record):
+        response = handler({"Records": [record]}, None) or {}
+        failed_ids = [
+            failure["itemIdentifier"] for failure in response.get("batchItemFailures", [])
+        ]
+        if record["messageId"] not in failed_ids:
+            with self.lock:
+                self.delivered += 1
+            return
+
+        receive_count = get_receive_count(record)
+        if receive_count >= SQS_MAX_RECEIVES:
+            print(f"Giving up on record {record['messageId']} after {receive_count} receive(s)")
+            with self.lock:
+                self.dropped += 1
+            return
+
+        self._dispatch(
+            handler,
+            build_in_process_record(record["messageId"], record["body"], receive_count + 1),
+        )
+
+
+# Every send and publish goes through this transport, see set_message_transport
+message_transport = SqsTransport()
+
+# Prices repeat across orders, so each distinct value is converted only once
+price_cents_cache = {}
+
+
+def _convert_to_cents(value):
+    if isinstance(value, int):
+        return value * CENTS_PER_UNIT
+
+    cents = Decimal(value).scaleb(2)
+    whole_cents = int(cents)
+    if cents != whole_cents:
+        raise ValueError(f"{value} has more than 2 decimal places")
+    return whole_cents
 
-    calculated = order_total * rate
-    output = max(calculated, minimum)
 
-    return round(output, 2)
+def to_cents(value):
+    cents = price_cents_cache.get(value)
+    if cents is None:
+        cents = _convert_to_cents(value)
+        if len(price_cents_cache) >= PRICE_CENTS_CACHE_SIZE:
+            price_cents_cache.clear()
+        price_cents_cache[value] = cents
+    return cents
+
+
+def from_cents(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+def apply_rate_cents(amount_cents, rate_basis_points):
+    # Round half to even, the same rule round(Decimal, 2) used before cents
+    quotient, remainder = divmod(amount_cents * rate_basis_points, BASIS_POINTS_PER_UNIT)
+    doubled_remainder = remainder * 2
+    if doubled_remainder > BASIS_POINTS_PER_UNIT or (
+        doubled_remainder == BASIS_POINTS_PER_UNIT and quotient % 2 == 1
+    ):
+        quotient += 1
+    return quotient
+
+
+def calculate_item_total_cents(item):
+    item_total = to_cents(item["basePrice"])
+    if "additions" in item:
+        for addition in item["additions"]:
+            item_total += to_cents(addition["price"])
+    return item_total
+
+
+def calculate_order_total_cents(order):
+    return sum(calculate_item_total_cents(item) for item in order["items"])
+
+
+def calculate_order_total_percentage(order, rate_basis_points, minimum_cents):
+    order_total = calculate_order_total_cents(order)
+    return from_cents(max(apply_rate_cents(order_total, rate_basis_points), minimum_cents))
 
 
 def calculate_commission(order):
-    return calculate_order_total_percentage(order, COMMISSION_RATE, MIN_COMMISSION)
+    return calculate_order_total_percentage(
+        order, COMMISSION_RATE_BASIS_POINTS, MIN_COMMISSION_CENTS
+    )
 
 
 def calculate_delivery_fee(order):
-    return calculate_order_total_percentage(order, DELIVERY_FEE_RATE, MIN_DELIVERY_FEE)
+    return calculate_order_total_percentage(
+        order, DELIVERY_FEE_RATE_BASIS_POINTS, MIN_DELIVERY_FEE_CENTS
+    )
+
+
+def calculate_order_fees(order):
+    order_total = calculate_order_total_cents(order)
+    commission = max(
+        apply_rate_cents(order_total, COMMISSION_RATE_BASIS_POINTS),
+        MIN_COMMISSION_CENTS,
+    )
+    delivery_fee = max(
+        apply_rate_cents(order_total, DELIVERY_FEE_RATE_BASIS_POINTS),
+        MIN_DELIVERY_FEE_CENTS,
+    )
+    return order_total, commission, delivery_fee
+
+
+def current_timestamp_millis():
+    return int(time.time() * 1000)
 
 
 def createUiUrl(path):
     return f"{EnvironmentVariables.UI_BASE_URL.value}/{path}"
 
 
-def send_sqs_message(sqs, queue_url, message):
-    response = sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(message))
-    return response["MessageId"]
+def set_message_transport(transport):
+    global message_transport
+    previous_transport = message_transport
+    message_transport = transport
+    return previous_transport
 
 
-def send_order_status_update_message(customer_id, order_id, new_status, sqs=None):
-    if sqs is None:
-        sqs = boto3.client("sqs")
+def build_in_process_record(message_id, body, receive_count):
+    return {
+        "messageId": message_id,
+        "body": body,
+        "attributes": {
+            "ApproximateReceiveCount": str(receive_count),
+            "SentTimestamp": str(current_timestamp_millis()),
+        },
+        "eventSource": "in-process",
+    }
+
+
+def send_sqs_message(sqs, queue_url, message, delay_seconds=0):
+    return message_transport.send_message(sqs, queue_url, message, delay_seconds)
+
+
+def send_sqs_message_batch(sqs, queue_url, messages):
+    return message_transport.send_message_batch(sqs, queue_url, messages)
+
+
+def get_remaining_millis(context):
+    # Handlers invoked without a Lambda context have no deadline
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return context.get_remaining_time_in_millis()
+
+
+def has_time_for(context, cost_millis):
+    remaining_millis = get_remaining_millis(context)
+    return (
+        remaining_millis is None
+        or remaining_millis >= cost_millis + SQS_DEADLINE_RESERVE_MILLIS
+    )
+
+
+def is_permanent_error(error):
+    # Malformed message bodies fail the same way on every delivery. Consumers raise
+    # PermanentError for missing fields themselves, other KeyErrors are retried
+    return isinstance(error, (PermanentError, json.JSONDecodeError))
+
+
+def require_message_fields(message_body, fields):
+    missing_fields = [field for field in fields if field not in message_body]
+    if len(missing_fields) > 0:
+        raise PermanentError(f"Message is missing {', '.join(missing_fields)}")
+
+
+def get_receive_count(record):
+    return int(record.get("attributes", {}).get("ApproximateReceiveCount", 1))
+
+
+def get_queue_name(record):
+    return record.get("eventSourceARN", "unknown").split(":")[-1]
+
+
+def get_queue_url(record):
+    _, _, _, region, account_id, queue_name = record["eventSourceARN"].split(":")
+    return f"https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}"
+
+
+def get_retry_delay_seconds(receive_count):
+    return min(SQS_RETRY_BASE_SECONDS * 2 ** (receive_count - 1), SQS_RETRY_MAX_SECONDS)
+
+
+def delay_message_retry(sqs, record):
+    if "receiptHandle" not in record or "eventSourceARN" not in record:
+        return
+
+    delay_seconds = get_retry_delay_seconds(get_receive_count(record))
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=get_queue_url(record),
+            ReceiptHandle=record["receiptHandle"],
+            VisibilityTimeout=delay_seconds,
+        )
+        print(f"Retrying record {record['messageId']} in {delay_seconds} second(s)")
+    except Exception as e:
+        # The message still comes back after the queue's own visibility timeout
+        print(f"Couldn't delay retry of record {record['messageId']}", repr(e))
+
+
+def park_message(dynamo, record, error, reason):
+    parked_at = current_timestamp_millis()
+    parked_message = {
+        "queueName": get_queue_name(record),
+        "messageId": record["messageId"],
+        "body": record.get("body", ""),
+        "reason": reason,
+        "errorType": type(error).__name__,
+        "errorMessage": str(error),
+        "traceback": "".join(
+            traceback.format_exception(type(error), error, error.__traceback__)
+        ),
+        "receiveCount": get_receive_count(record),
+        "parkedAt": parked_at,
+        "expiresAt": parked_at // 1000 + PARKED_MESSAGE_TTL_DAYS * 24 * 60 * 60,
+    }
+    dynamo.put_item(
+        TableName=EnvironmentVariables.PARKED_MESSAGES_TABLE.value,
+        Item=serialize_to_dynamo_object(parked_message),
+    )
+    print(f"Parked record {record['messageId']} ({reason})")
+
+
+def handle_record_error(record, error, dynamo=None, sqs=None):
+    # Returns whether the record should be reported as a batch item failure
+    if is_permanent_error(error):
+        reason = PARK_REASON_PERMANENT
+    elif get_receive_count(record) >= SQS_MAX_RECEIVES:
+        reason = PARK_REASON_RETRIES_EXHAUSTED
+    else:
+        delay_message_retry(sqs or boto3.client("sqs"), record)
+        return True
+
+    try:
+        park_message(dynamo or boto3.client("dynamodb"), record, error, reason)
+        return False
+    except Exception as e:
+        print(f"Couldn't park record {record['messageId']}", repr(e))
+        return True
+
+
+def process_sqs_batch(records, context, process_record, dynamo=None, sqs=None):
+    batch_item_failures = []
+    slowest_millis = None
+
+    for index, record in enumerate(records):
+        cost_estimate_millis = (
+            SQS_RECORD_COST_ESTIMATE_MILLIS if slowest_millis is None else slowest_millis
+        )
+        if not has_time_for(context, cost_estimate_millis):
+            skipped = records[index:]
+            print(f"Stopping before the deadline, leaving {len(skipped)} record(s) for redelivery")
+            batch_item_failures.extend(
+                {"itemIdentifier": skipped_record["messageId"]}
+                for skipped_record in skipped
+            )
+            break
+
+        started = time.monotonic()
+        try:
+            process_record(record)
+        except Exception as e:
+            print(f"Error processing record {record['messageId']}", repr(e))
+            if handle_record_error(record, e, dynamo, sqs):
+                batch_item_failures.append({"itemIdentifier": record["messageId"]})
+
+        elapsed_millis = (time.monotonic() - started) * 1000
+        slowest_millis = max(slowest_millis or 0, elapsed_millis)
+
+    return batch_item_failures
+
+
+def publish_sns_message(sns, topic_arn, message):
+    return message_transport.publish_message(sns, topic_arn, message)
+
+
+def send_order_status_update_message(customer_id, order_id, new_status, sns=None):
+    if sns is None:
+        sns = boto3.client("sns")
 
     print(
         f"Sending order status update message for customer {customer_id}'s order {order_id} with status {new_status}"
@@ -141,8 +656,8 @@ def send_order_status_update_message(customer_id, order_id, new_status, sqs=None
         "orderId": order_id,
         "orderStatus": new_status,
     }
-    return send_sqs_message(
-        sqs, EnvironmentVariables.USER_NOTIFICATION_QUEUE_URL.value, message
+    return publish_sns_message(
+        sns, EnvironmentVariables.ORDER_STATUS_TOPIC_ARN.value, message
     )
 
 
@@ -268,6 +783,354 @@ def get_query_parameter(event, name, default_value):
     return _get_event_parameter(event, "queryStringParameters", name, default_value)
 
 
+def get_since_parameter(event):
+    since = get_query_parameter(event, "since", None)
+    if since is None:
+        return None
+
+    since = int(since)
+    if since < 0:
+        raise ValueError("Since must not be negative")
+    return since
+
+
+def get_bounded_int_parameter(event, name, default_value, minimum, maximum):
+    value = get_query_parameter(event, name, None)
+    if value is None:
+        return default_value
+
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+    if value < minimum or value > maximum:
+        raise ValueError(f"{name} must be between {minimum} and {maximum}")
+    return value
+
+
+def to_field_list(fields_value, allowed_fields):
+    if fields_value is None or len(str(fields_value).strip()) == 0:
+        return [], []
+
+    valid_fields = []
+    invalid_fields = []
+    for field in str(fields_value).split(","):
+        field = field.strip()
+        if field in allowed_fields:
+            if field not in valid_fields:
+                valid_fields.append(field)
+        elif len(field) > 0:
+            invalid_fields.append(field)
+    return valid_fields, invalid_fields
+
+
+def get_order_ids_from_body(event):
+    if "body" not in event or event["body"] is None:
+        return None, None, build_error_response(
+            ErrorCodes.MISSING_BODY, "Must specify a request body"
+        )
+
+    body = json.loads(event["body"])
+    order_ids = body.get("orderIds") if isinstance(body, dict) else None
+    if not isinstance(order_ids, list) or len(order_ids) == 0:
+        return None, None, build_error_response(
+            ErrorCodes.MISSING_DATA, "Must specify a list of order IDs"
+        )
+
+    # Drop duplicates but keep the caller's order for the outcomes
+    order_ids = list(dict.fromkeys(str(order_id) for order_id in order_ids))
+    if len(order_ids) > BULK_MAX_ORDERS:
+        return None, None, build_error_response(
+            ErrorCodes.INVALID_DATA, f"Cannot update more than {BULK_MAX_ORDERS} orders"
+        )
+
+    return order_ids, body, None
+
+
+def build_bulk_outcome(order_id, success, message=None):
+    outcome = {"orderId": order_id, "success": success}
+    if message is not None:
+        outcome["message"] = message
+    return outcome
+
+
+def get_fields_parameter(event, allowed_fields, required_fields):
+    fields_value = get_query_parameter(event, "fields", None)
+    if fields_value is None:
+        return list(allowed_fields), []
+
+    fields, invalid_fields = to_field_list(fields_value, allowed_fields)
+    for field in reversed(required_fields):
+        if field not in fields:
+            fields.insert(0, field)
+    return fields, invalid_fields
+
+
+def build_projection_expression(fields):
+    if "items" in fields and ORDER_FORMAT_FIELD not in fields:
+        # Compact items cannot be expanded without their format marker
+        fields = list(fields) + [ORDER_FORMAT_FIELD]
+
+    expression_names = {}
+    projected_names = []
+    for index, field in enumerate(fields):
+        name = f"#F{index}"
+        expression_names[name] = field
+        projected_names.append(name)
+    return ", ".join(projected_names), expression_names
+
+
+def encode_pagination_cursor(last_evaluated_key):
+    if last_evaluated_key is None:
+        return None
+    raw_cursor = json.dumps(last_evaluated_key, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw_cursor.encode("utf-8")).decode("ascii")
+
+
+def decode_pagination_cursor(cursor):
+    try:
+        raw_cursor = base64.urlsafe_b64decode(str(cursor).encode("ascii"))
+        key = json.loads(raw_cursor)
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(key, dict):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def get_batch_retry_delay_seconds(attempt):
+    # Full jitter, so throttled callers don't retry in lockstep
+    return random.uniform(
+        0, min(BATCH_RETRY_MAX_SECONDS, BATCH_RETRY_BASE_SECONDS * 2**attempt)
+    )
+
+
+def batch_get_items(
+    dynamo,
+    table_name,
+    keys,
+    consistent_read=False,
+    projection_expression=None,
+    expression_names=None,
+):
+    items = []
+    for start in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request_items = {
+            table_name: {
+                "Keys": keys[start : start + BATCH_GET_MAX_KEYS],
+                "ConsistentRead": consistent_read,
+            }
+        }
+        if projection_expression is not None:
+            request_items[table_name]["ProjectionExpression"] = projection_expression
+        if expression_names is not None:
+            request_items[table_name]["ExpressionAttributeNames"] = expression_names
+        attempt = 0
+        while len(request_items) > 0:
+            if attempt >= BATCH_RETRY_MAX_ATTEMPTS:
+                raise TransientError(
+                    f"Keys in {table_name} still unprocessed after {attempt} attempts"
+                )
+            if attempt > 0:
+                time.sleep(get_batch_retry_delay_seconds(attempt))
+            response = dynamo.batch_get_item(RequestItems=request_items)
+            items.extend(response["Responses"].get(table_name, []))
+            request_items = response.get("UnprocessedKeys", {})
+            attempt += 1
+    return items
+
+
+def query_pages(dynamo, query_args):
+    query_args = dict(query_args)
+    while True:
+        response = dynamo.query(**query_args)
+        yield response["Items"]
+        if "LastEvaluatedKey" not in response:
+            return
+        query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def query_order_history_pages(
+    dynamo,
+    index_name,
+    owner_field,
+    owner_id,
+    since=None,
+    projection_expression=None,
+    expression_names=None,
+):
+    key_condition = "#OWNER = :owner"
+    names = {"#OWNER": owner_field}
+    values = {":owner": {"S": owner_id}}
+    if since is not None:
+        key_condition = f"{key_condition} AND updatedAt > :since"
+        values[":since"] = {"N": str(since)}
+    if expression_names is not None:
+        names.update(expression_names)
+
+    # Live orders first, then the ones that have moved to the archive
+    for table_name in [
+        EnvironmentVariables.ORDERS_TABLE.value,
+        EnvironmentVariables.ORDER_ARCHIVE_TABLE.value,
+    ]:
+        query_args = {
+            "TableName": table_name,
+            "IndexName": index_name,
+            "KeyConditionExpression": key_condition,
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+        }
+        if projection_expression is not None:
+            query_args["ProjectionExpression"] = projection_expression
+        yield from query_pages(dynamo, query_args)
+
+
+def build_export_key(owner_type, owner_id):
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return f"exports/{owner_type}/{owner_id}/{timestamp}-{uuid.uuid4()}.ndjson"
+
+
+def write_ndjson_export(s3, key, records):
+    bucket = EnvironmentVariables.ORDER_EXPORT_BUCKET.value
+    buffer = bytearray()
+    parts = []
+    upload_id = None
+    count = 0
+
+    def upload_part():
+        part_number = len(parts) + 1
+        response = s3.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=bytes(buffer),
+        )
+        parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    try:
+        for record in records:
+            buffer.extend(json.dumps(record, default=decimal_encoder).encode("utf-8"))
+            buffer.extend(b"\n")
+            count += 1
+
+            # Only one part is held in memory however long the history is
+            if len(buffer) >= EXPORT_PART_BYTES:
+                if upload_id is None:
+                    upload_id = s3.create_multipart_upload(
+                        Bucket=bucket, Key=key, ContentType=EXPORT_CONTENT_TYPE
+                    )["UploadId"]
+                upload_part()
+                buffer = bytearray()
+
+        if upload_id is None:
+            s3.put_object(
+                Bucket=bucket, Key=key, Body=bytes(buffer), ContentType=EXPORT_CONTENT_TYPE
+            )
+        else:
+            if len(buffer) > 0:
+                upload_part()
+            s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+    except Exception:
+        if upload_id is not None:
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    print(f"Exported {count} record(s) to {key}")
+    return count
+
+
+def start_order_export(dynamo, sqs, owner_type, owner_id, fields, since):
+    export_id = str(uuid.uuid4())
+    dynamo.put_item(
+        TableName=EnvironmentVariables.ORDER_EXPORTS_TABLE.value,
+        Item=serialize_to_dynamo_object(
+            {
+                "ownerId": owner_id,
+                "id": export_id,
+                "ownerType": owner_type,
+                "exportStatus": EXPORT_STATUS_PENDING,
+                "createdAt": current_timestamp_millis(),
+                "expiresAt": int(time.time()) + EXPORT_JOB_TTL_SECONDS,
+            }
+        ),
+    )
+    send_sqs_message(
+        sqs,
+        EnvironmentVariables.ORDER_EXPORT_QUEUE_URL.value,
+        {
+            "exportId": export_id,
+            "ownerType": owner_type,
+            "ownerId": owner_id,
+            "fields": fields,
+            "since": since,
+        },
+    )
+
+    print(f"Queued export {export_id} for {owner_type} {owner_id}")
+    return build_response(
+        202,
+        {
+            "exportId": export_id,
+            "exportStatus": EXPORT_STATUS_PENDING,
+        },
+    )
+
+
+def get_order_export(dynamo, s3, owner_type, owner_id, export_id):
+    response = dynamo.get_item(
+        TableName=EnvironmentVariables.ORDER_EXPORTS_TABLE.value,
+        Key={
+            "ownerId": {
+                "S": owner_id,
+            },
+            "id": {
+                "S": export_id,
+            },
+        },
+        ConsistentRead=True,
+    )
+    export = (
+        deserialize_dynamo_object(response["Item"]) if "Item" in response else None
+    )
+    if export is None or export["ownerType"] != owner_type:
+        return build_error_response(ErrorCodes.NOT_FOUND, f"Export {export_id} not found")
+
+    body = {
+        "exportId": export_id,
+        "exportStatus": export["exportStatus"],
+    }
+    if export["exportStatus"] == EXPORT_STATUS_COMPLETE:
+        body["url"] = s3.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": EnvironmentVariables.ORDER_EXPORT_BUCKET.value,
+                "Key": export["exportKey"],
+            },
+            ExpiresIn=EXPORT_URL_TTL_SECONDS,
+        )
+        body["orderCount"] = int(export["orderCount"])
+        body["expiresAt"] = int(time.time()) + EXPORT_URL_TTL_SECONDS
+    return build_response(200, body)
+
+
+def query_all_items(dynamo, query_args):
+    items = []
+    query_args = dict(query_args)
+    while True:
+        response = dynamo.query(**query_args)
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return items
+        query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
 def build_response(code, body):
     formatted_body = body
     if body is not None and type(body) != str:
@@ -298,54 +1161,118 @@ def validate_price(value):
     return None
 
 
-def validate_location(location, name):
-    validated_location = {}
+# Validation schemas are built once at import into validator functions that take
+# (value, path, errors), append every problem found to errors and return the
+# validated value
+def add_validation_error(errors, path, message):
+    errors.append({"path": path, "message": message})
 
-    if "name" in location:
-        validated_location["name"] = str(location["name"])
 
-    if "streetAddress" in location:
-        validated_location["streetAddress"] = str(location["streetAddress"])
-    else:
-        return False, f"{name} must have a street address"
+def join_validation_path(path, key):
+    if isinstance(key, int):
+        return f"{path}[{key}]"
+    return f"{path}.{key}" if path else key
 
-    if "city" in location:
-        validated_location["city"] = str(location["city"])
-    else:
-        return False, f"{name} must have a city"
 
-    if "state" in location:
-        validated_location["state"] = str(location["state"])
-    else:
-        return False, f"{name} must have a state"
+def format_validation_errors(errors):
+    return "; ".join(
+        f"{error['path'] or 'Request body'} {error['message']}" for error in errors
+    )
 
-    if "zip" in location:
-        validated_location["zip"] = str(location["zip"])
-    else:
-        return False, f"{name} must have a zip"
 
-    return True, validated_location
+def build_validation_error_response(errors):
+    error_response = {
+        "code": ErrorCodes.INVALID_DATA.internal_code,
+        "message": format_validation_errors(errors),
+        "errors": errors,
+    }
+    return build_response(ErrorCodes.INVALID_DATA.http_error_code, error_response)
 
 
-def validate_payment_information(payment_info, name):
-    validated_payment_info = {}
+def any_schema():
+    def validate(value, path, errors):
+        return value
 
-    if "nameOnCard" in payment_info:
-        validated_payment_info["nameOnCard"] = str(payment_info["nameOnCard"])
-    else:
-        return False, f"{name} must have the name on the card"
+    return validate
 
-    if "cardNumber" in payment_info:
-        validated_payment_info["cardNumber"] = str(payment_info["cardNumber"])
-    else:
-        return False, f"{name} must have the card number"
 
-    if "cvv" in payment_info:
-        validated_payment_info["cvv"] = str(payment_info["cvv"])
-    else:
-        return False, f"{name} must have the CVV"
+def string_schema():
+    def validate(value, path, errors):
+        if value is None or isinstance(value, (dict, list)):
+            add_validation_error(errors, path, "must be a string")
+            return None
+        return str(value)
+
+    return validate
+
+
+def object_schema(fields, required=()):
+    field_validators = tuple(fields.items())
+    required_fields = frozenset(required)
 
-    return True, validated_payment_info
+    def validate(value, path, errors):
+        if not isinstance(value, dict):
+            add_validation_error(errors, path, "must be an object")
+            return None
+
+        validated = {}
+        for name, field_validator in field_validators:
+            field_path = join_validation_path(path, name)
+            if name in value:
+                field_value = field_validator(value[name], field_path, errors)
+                if field_value is not None:
+                    validated[name] = field_value
+            elif name in required_fields:
+                add_validation_error(errors, field_path, "is required")
+        return validated
+
+    return validate
+
+
+def list_schema(item_validator, min_items=0, max_items=None):
+    def validate(value, path, errors):
+        if not isinstance(value, list):
+            add_validation_error(errors, path, "must be a list")
+            return None
+
+        if len(value) < min_items:
+            add_validation_error(errors, path, f"must have at least {min_items} item(s)")
+        elif max_items is not None and len(value) > max_items:
+            add_validation_error(errors, path, f"must have at most {max_items} item(s)")
+
+        return [
+            item_validator(item, join_validation_path(path, index), errors)
+            for index, item in enumerate(value)
+        ]
+
+    return validate
+
+
+def validate_schema(schema, value, path=""):
+    errors = []
+    validated = schema(value, path, errors)
+    return validated, errors
+
+
+LOCATION_SCHEMA = object_schema(
+    {
+        "name": string_schema(),
+        "streetAddress": string_schema(),
+        "city": string_schema(),
+        "state": string_schema(),
+        "zip": string_schema(),
+    },
+    required=["streetAddress", "city", "state", "zip"],
+)
+
+PAYMENT_INFORMATION_SCHEMA = object_schema(
+    {
+        "nameOnCard": string_schema(),
+        "cardNumber": string_schema(),
+        "cvv": string_schema(),
+    },
+    required=["nameOnCard", "cardNumber", "cvv"],
+)
 
 
 def to_enum_string(value, valid_values):
@@ -372,10 +1299,11 @@ def to_enum_list(list_value, valid_enum_values):
 
 
 COFFEE_TYPES = ["REGULAR", "DECAF"]
+COFFEE_TYPE_SET = frozenset(COFFEE_TYPES)
 
 
 def to_coffee_type(coffee_type):
-    return to_enum_string(coffee_type, COFFEE_TYPES)
+    return to_enum_string(coffee_type, COFFEE_TYPE_SET)
 
 
 def to_coffee_type_list(coffee_types):
@@ -383,20 +1311,87 @@ def to_coffee_type_list(coffee_types):
 
 
 MILK_TYPES = ["REGULAR", "SKIM", "OAT", "ALMOND"]
+MILK_TYPE_SET = frozenset(MILK_TYPES)
 
 
 def to_milk_type(milk_type):
-    return to_enum_string(milk_type, MILK_TYPES)
+    return to_enum_string(milk_type, MILK_TYPE_SET)
 
 
 def to_milk_type_list(milk_types):
     return to_enum_list(milk_types, MILK_TYPES)
 
 
+# Compact stored order items use short attribute names, one letter enum codes and
+# [addition ID, price] pairs instead of full addition objects. Orders in this
+# format are marked with ORDER_FORMAT_FIELD, orders without it are stored expanded
+COFFEE_TYPE_CODES = {"REGULAR": "R", "DECAF": "D"}
+COFFEE_TYPES_BY_CODE = {code: value for value, code in COFFEE_TYPE_CODES.items()}
+MILK_TYPE_CODES = {"REGULAR": "R", "SKIM": "S", "OAT": "O", "ALMOND": "A"}
+MILK_TYPES_BY_CODE = {code: value for value, code in MILK_TYPE_CODES.items()}
+
+
+def compact_order_item(item):
+    compact_item = {
+        "id": item["id"],
+        "p": item["productId"],
+        "b": item["basePrice"],
+        "c": COFFEE_TYPE_CODES[item["coffeeType"]],
+    }
+    if "milkType" in item:
+        compact_item["m"] = MILK_TYPE_CODES[item["milkType"]]
+    if "additions" in item:
+        compact_item["a"] = [
+            [addition["id"], addition["price"]] for addition in item["additions"]
+        ]
+    return compact_item
+
+
+def compact_order(order):
+    if order.get(ORDER_FORMAT_FIELD) == COMPACT_ORDER_FORMAT or "items" not in order:
+        return order
+
+    compacted = dict(order)
+    compacted["items"] = [compact_order_item(item) for item in order["items"]]
+    compacted[ORDER_FORMAT_FIELD] = COMPACT_ORDER_FORMAT
+    return compacted
+
+
+def expand_order_item(compact_item, known_additions):
+    item = {
+        "id": compact_item["id"],
+        "productId": compact_item["p"],
+        "basePrice": compact_item["b"],
+        "coffeeType": COFFEE_TYPES_BY_CODE[compact_item["c"]],
+    }
+    if "m" in compact_item:
+        item["milkType"] = MILK_TYPES_BY_CODE[compact_item["m"]]
+    if "a" in compact_item:
+        additions = []
+        for addition_id, price in compact_item["a"]:
+            # Names come from the catalog, the price is what the customer paid
+            addition = dict(known_additions.get(addition_id, {"id": addition_id}))
+            addition["price"] = price
+            additions.append(addition)
+        item["additions"] = additions
+    return item
+
+
+def expand_order_items(dynamo, order):
+    if order.pop(ORDER_FORMAT_FIELD, None) != COMPACT_ORDER_FORMAT or "items" not in order:
+        return order
+
+    known_additions = {}
+    if any("a" in item for item in order["items"]):
+        _, known_additions, _ = get_cached_catalog(dynamo)
+    order["items"] = [expand_order_item(item, known_additions) for item in order["items"]]
+    return order
+
+
 def get_additions_by_id(dynamo, addition_ids):
     if addition_ids is not None:
         if len(addition_ids) == 0:
-            return []
+            return {}
 
         keys = []
         for id in list(set(addition_ids)):
@@ -440,7 +1435,7 @@ def get_additions_by_id(dynamo, addition_ids):
 def get_products_by_id(dynamo, product_ids):
     if product_ids is not None:
         if len(product_ids) == 0:
-            return []
+            return {}
 
         keys = []
         for id in list(set(product_ids)):
@@ -481,6 +1476,175 @@ def get_products_by_id(dynamo, product_ids):
     return products
 
 
+# Products and additions, kept across warm invocations
+catalog_cache = {}
+
+
+def catalog_encoder(value):
+    if isinstance(value, set):
+        return sorted(value)
+    return decimal_encoder(value)
+
+
+def compute_catalog_version(products, additions):
+    catalog = json.dumps(
+        {"products": products, "additions": additions},
+        sort_keys=True,
+        default=catalog_encoder,
+    )
+    return hashlib.sha256(catalog.encode("utf-8")).hexdigest()[:16]
+
+
+def get_cached_catalog(dynamo):
+    now = time.monotonic()
+    if catalog_cache.get("expiresAt", 0) <= now:
+        print("Refreshing catalog cache...")
+        products = get_products_by_id(dynamo, None)
+        additions = get_additions_by_id(dynamo, None)
+        version = compute_catalog_version(products, additions)
+        if catalog_cache.get("version") != version:
+            catalog_cache["rules"] = compile_product_rules(products, additions)
+        catalog_cache["products"] = products
+        catalog_cache["additions"] = additions
+        catalog_cache["version"] = version
+        catalog_cache["expiresAt"] = now + CATALOG_CACHE_TTL_SECONDS
+
+    return catalog_cache["products"], catalog_cache["additions"], catalog_cache["version"]
+
+
+def get_cached_product_rules(dynamo):
+    # Rules are only recompiled when the catalog version changes
+    _, additions, version = get_cached_catalog(dynamo)
+    return catalog_cache["rules"], additions, version
+
+
+def compile_product_rule(product, additions):
+    coffee_type_names = tuple(product.get("allowedCoffeeTypes", []))
+
+    milk_type_names = None
+    if "allowedMilkTypes" in product:
+        milk_type_names = tuple(product["allowedMilkTypes"])
+
+    # Resolve allowed additions up front so validating an item needs no lookups
+    allowed_additions = {}
+    for addition_id in product.get("allowedAdditions", []):
+        if addition_id in additions:
+            allowed_additions[addition_id] = additions[addition_id]
+
+    return ProductRules(
+        product_id=product["id"],
+        base_price=product["basePrice"],
+        coffee_types=frozenset(coffee_type_names),
+        coffee_type_names=coffee_type_names,
+        milk_types=frozenset(milk_type_names) if milk_type_names is not None else None,
+        milk_type_names=milk_type_names,
+        additions=allowed_additions,
+    )
+
+
+def compile_product_rules(products, additions):
+    return {
+        product_id: compile_product_rule(product, additions)
+        for product_id, product in products.items()
+    }
+
+
+def _encode_base64_url(data):
+    return base64.urlsafe_b64encode(data).decode("utf-8").rstrip("=")
+
+
+def _decode_base64_url(value):
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+# Secret ARN -> (expiration, signing key), kept across warm invocations
+signing_key_cache = {}
+
+
+def get_signing_key(secret_arn, secrets=None):
+    # Read from Secrets Manager so keys never sit in a function's environment
+    now = time.time()
+    cached = signing_key_cache.get(secret_arn)
+    if cached is None or cached[0] <= now:
+        secrets = secrets or boto3.client("secretsmanager")
+        response = secrets.get_secret_value(SecretId=secret_arn)
+        cached = (
+            now + SIGNING_KEY_CACHE_TTL_SECONDS,
+            response["SecretString"].encode("utf-8"),
+        )
+        signing_key_cache[secret_arn] = cached
+    return cached[1]
+
+
+def get_quote_signing_key(secrets=None):
+    return get_signing_key(EnvironmentVariables.QUOTE_SIGNING_SECRET_ARN.value, secrets)
+
+
+def get_order_feed_token_key(secrets=None):
+    return get_signing_key(
+        EnvironmentVariables.ORDER_FEED_TOKEN_SECRET_ARN.value, secrets
+    )
+
+
+def _sign(value, key):
+    return hmac.new(key, value.encode("utf-8"), hashlib.sha256).digest()
+
+
+def sign_payload(payload, key):
+    body = _encode_base64_url(
+        json.dumps(
+            payload, sort_keys=True, separators=(",", ":"), default=decimal_encoder
+        ).encode("utf-8")
+    )
+    return f"{body}.{_encode_base64_url(_sign(body, key))}"
+
+
+def verify_signed_payload(token, key):
+    try:
+        body, signature = str(token).split(".")
+        if not hmac.compare_digest(_decode_base64_url(signature), _sign(body, key)):
+            return None
+        return json.loads(_decode_base64_url(body))
+    except (ValueError, TypeError):
+        return None
+
+
+def build_order_feed_token(user_id):
+    expires_at = int(time.time()) + ORDER_FEED_TOKEN_TTL_SECONDS
+    token = sign_payload(
+        {"userId": user_id, "expiresAt": expires_at}, get_order_feed_token_key()
+    )
+    return token, expires_at
+
+
+def verify_order_feed_token(token):
+    payload = verify_signed_payload(token, get_order_feed_token_key())
+    if (
+        not isinstance(payload, dict)
+        or not isinstance(payload.get("expiresAt"), int)
+        or payload["expiresAt"] < int(time.time())
+    ):
+        return None
+    return payload.get("userId")
+
+
+def compute_cart_hash(items):
+    cart = []
+    for item in items:
+        additions = item.get("additions") or []
+        cart.append(
+            {
+                "productId": str(item.get("productId")),
+                "coffeeType": to_coffee_type(item.get("coffeeType")),
+                "milkType": to_milk_type(item.get("milkType")),
+                "additions": [str(addition.get("id")) for addition in additions],
+            }
+        )
+
+    canonical = json.dumps(cart, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
 def is_shop_set_up(dynamo, shop_id):
     shop_info = get_shop_by_id(dynamo, shop_id)
     if shop_info is not None and "location" in shop_info:
@@ -506,9 +1670,99 @@ def get_shop_by_id(dynamo, shop_id):
         return None
 
 
+def is_counted_order_status(status):
+    # Delivered orders only ever accumulate, so they are left out of the live counts
+    return status is not None and status != OrderStatus.DELIVERED.value
+
+
+def build_order_status_counter_update(status, delta):
+    return {
+        "Update": {
+            "Key": {
+                "orderStatus": {
+                    "S": status,
+                },
+                "shard": {
+                    "N": str(random.randrange(ORDER_STATUS_COUNTER_SHARDS)),
+                },
+            },
+            "TableName": EnvironmentVariables.ORDER_STATUS_COUNTERS_TABLE.value,
+            "UpdateExpression": "ADD orderCount :delta",
+            "ExpressionAttributeValues": {
+                ":delta": {
+                    "N": str(delta),
+                },
+            },
+        }
+    }
+
+
+def build_order_status_counter_updates(previous_status, new_status):
+    if previous_status == new_status:
+        return []
+
+    # Shards may go negative on their own, only their sum is meaningful
+    updates = []
+    if is_counted_order_status(previous_status):
+        updates.append(build_order_status_counter_update(previous_status, -1))
+    if is_counted_order_status(new_status):
+        updates.append(build_order_status_counter_update(new_status, 1))
+    return updates
+
+
+def is_transaction_conflict(error):
+    reasons = error.response.get("CancellationReasons", [])
+    return any(reason.get("Code") == "TransactionConflict" for reason in reasons)
+
+
+def is_condition_check_failure(error):
+    # Only a failed condition is final, throttling, conflicts and other reasons can pass on retry
+    codes = [
+        reason.get("Code") for reason in error.response.get("CancellationReasons", [])
+    ]
+    return "ConditionalCheckFailed" in codes and all(
+        code in ("None", "ConditionalCheckFailed") for code in codes
+    )
+
+
+def transact_write_counted_items(dynamo, transact_items, previous_status, new_status):
+    for attempt in range(ORDER_STATUS_COUNTER_ATTEMPTS):
+        counter_updates = build_order_status_counter_updates(previous_status, new_status)
+        try:
+            dynamo.transact_write_items(TransactItems=transact_items + counter_updates)
+            return
+        except dynamo.exceptions.TransactionCanceledException as e:
+            if attempt == ORDER_STATUS_COUNTER_ATTEMPTS - 1 or not is_transaction_conflict(e):
+                raise
+            print(f"Counter shard conflict, retrying (attempt {attempt + 1})")
+
+
+def get_order_status_counts(dynamo):
+    counts = {}
+    for status in OrderStatus:
+        if not is_counted_order_status(status.value):
+            continue
+
+        shards = query_all_items(
+            dynamo,
+            {
+                "TableName": EnvironmentVariables.ORDER_STATUS_COUNTERS_TABLE.value,
+                "KeyConditionExpression": "orderStatus = :status",
+                "ExpressionAttributeValues": {
+                    ":status": {
+                        "S": status.value,
+                    },
+                },
+            },
+        )
+        counts[status.value] = sum(int(shard["orderCount"]["N"]) for shard in shards)
+    return counts
+
+
 def initialize_order_status(dynamo, order_status):
-    dynamo.transact_write_items(
-        TransactItems=[
+    transact_write_counted_items(
+        dynamo,
+        [
             {
                 "Put": {
                     "Item": serialize_to_dynamo_object(order_status),
@@ -516,34 +1770,100 @@ def initialize_order_status(dynamo, order_status):
                 }
             },
         ],
+        None,
+        order_status["orderStatus"],
     )
 
 
 def get_order_status(dynamo, order_id):
     print(f"Getting order {order_id} status...")
-    response = dynamo.transact_get_items(
-        TransactItems=[
-            {
-                "Get": {
-                    "Key": {
-                        "id": {
-                            "S": order_id,
-                        },
-                    },
-                    "TableName": EnvironmentVariables.ORDER_STATUS_TABLE.value,
-                }
-            }
-        ]
+    response = dynamo.get_item(
+        TableName=EnvironmentVariables.ORDER_STATUS_TABLE.value,
+        Key={
+            "id": {
+                "S": order_id,
+            },
+        },
+        ConsistentRead=True,
     )
 
-    if "Responses" in response:
-        return deserialize_dynamo_object(response["Responses"][0]["Item"])
+    if "Item" in response:
+        return deserialize_dynamo_object(response["Item"])
     else:
         return None
 
 
-def update_order_status(dynamo, order_id, previous_status, new_status, field_updates):
-    update_expression = "SET orderStatus = :new_status, updating = :new_updating"
+def get_order_statuses(dynamo, order_ids):
+    print(f"Getting {len(order_ids)} order statuses...")
+    keys = [{"id": {"S": order_id}} for order_id in set(order_ids)]
+    raw_statuses = batch_get_items(
+        dynamo,
+        EnvironmentVariables.ORDER_STATUS_TABLE.value,
+        keys,
+        consistent_read=True,
+    )
+
+    statuses = {}
+    for raw_status in raw_statuses:
+        status = deserialize_dynamo_object(raw_status)
+        statuses[status["id"]] = status
+    return statuses
+
+
+def get_order_archive_at():
+    archive_age_days = int(EnvironmentVariables.ORDER_ARCHIVE_AGE_DAYS.value)
+    return int(time.time()) + archive_age_days * 24 * 60 * 60
+
+
+def build_order_archive_bucket(archive_at):
+    return datetime.fromtimestamp(int(archive_at), timezone.utc).strftime(
+        ORDER_ARCHIVE_BUCKET_FORMAT
+    )
+
+
+def apply_order_archive_bucket(order):
+    if ORDER_ARCHIVE_AT_FIELD in order:
+        order[ORDER_ARCHIVE_BUCKET_FIELD] = build_order_archive_bucket(
+            order[ORDER_ARCHIVE_AT_FIELD]
+        )
+    else:
+        order.pop(ORDER_ARCHIVE_BUCKET_FIELD, None)
+    return order
+
+
+def batch_write_items(dynamo, table_name, items):
+    for start in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        request_items = {
+            table_name: [
+                {"PutRequest": {"Item": item}}
+                for item in items[start : start + BATCH_WRITE_MAX_ITEMS]
+            ]
+        }
+        attempt = 0
+        while len(request_items) > 0:
+            if attempt >= BATCH_RETRY_MAX_ATTEMPTS:
+                raise TransientError(
+                    f"Items in {table_name} still unprocessed after {attempt} attempts"
+                )
+            if attempt > 0:
+                time.sleep(get_batch_retry_delay_seconds(attempt))
+            response = dynamo.batch_write_item(RequestItems=request_items)
+            request_items = response.get("UnprocessedItems", {})
+            attempt += 1
+
+
+def attach_live_order_status(dynamo, orders):
+    statuses = get_order_statuses(dynamo, [order["id"] for order in orders])
+    for order in orders:
+        if order["id"] in statuses:
+            order["orderStatus"] = statuses[order["id"]]["orderStatus"]
+    return orders
+
+
+def update_order_status(
+    dynamo, order_id, previous_status, new_status, field_updates, lease_token
+):
+    update_expression = "SET orderStatus = :new_status, updatedAt = :updated_at"
     expression_values = {
         ":old_status": {
             "S": previous_status,
@@ -551,20 +1871,41 @@ def update_order_status(dynamo, order_id, previous_status, new_status, field_upd
         ":new_status": {
             "S": new_status,
         },
-        ":old_updating": {"BOOL": True},
-        ":new_updating": {"BOOL": False},
+        ":lease_token": {
+            "N": str(lease_token),
+        },
+        ":updated_at": {
+            "N": str(current_timestamp_millis()),
+        },
+        ":one": {
+            "N": "1",
+        },
     }
 
     for key in field_updates:
-        if key != "orderStatus" and key != "updating":
+        if key not in ORDER_STATUS_RESERVED_FIELDS:
             update_expression = f"{update_expression}, {key} = :{key}"
             expression_values[f":{key}"] = {
                 "S": str(field_updates[key]),
             }
 
+    if ORDER_ARCHIVE_AT_FIELD in field_updates:
+        # TTL only works on numbers
+        update_expression = f"{update_expression}, {ORDER_ARCHIVE_AT_FIELD} = :archive_at"
+        expression_values[":archive_at"] = {
+            "N": str(field_updates[ORDER_ARCHIVE_AT_FIELD]),
+        }
+
+    # Release the lease but keep its token so fencing stays monotonic
+    update_expression = (
+        f"{update_expression} ADD version :one"
+        " REMOVE leaseOwner, leaseExpiresAt, offeredTo, offerExpiresAt"
+    )
+
     try:
-        dynamo.transact_write_items(
-            TransactItems=[
+        transact_write_counted_items(
+            dynamo,
+            [
                 {
                     "Update": {
                         "Key": {
@@ -574,70 +1915,601 @@ def update_order_status(dynamo, order_id, previous_status, new_status, field_upd
                         },
                         "TableName": EnvironmentVariables.ORDER_STATUS_TABLE.value,
                         "UpdateExpression": update_expression,
-                        "ConditionExpression": "orderStatus = :old_status AND updating = :old_updating",
+                        "ConditionExpression": "orderStatus = :old_status AND leaseToken = :lease_token",
                         "ExpressionAttributeValues": expression_values,
                     }
                 },
             ],
+            previous_status,
+            new_status,
         )
         return True
-    except dynamo.exceptions.TransactionCanceledException:
+    except dynamo.exceptions.TransactionCanceledException as e:
+        if not is_condition_check_failure(e):
+            reasons = e.response.get("CancellationReasons", [])
+            raise TransientError(f"Order {order_id} status write was cancelled: {reasons}")
         return False
 
 
-def mark_order_status_updating(dynamo, order_id, expected_status):
+def mark_order_status_updating(dynamo, order_id, expected_status, lease_owner):
+    now = int(time.time())
     try:
-        dynamo.transact_write_items(
-            TransactItems=[
-                {
-                    "Update": {
-                        "Key": {
-                            "id": {
-                                "S": order_id,
-                            },
-                        },
-                        "TableName": EnvironmentVariables.ORDER_STATUS_TABLE.value,
-                        "UpdateExpression": "SET updating = :new_updating",
-                        "ConditionExpression": "orderStatus = :expected_status AND updating = :old_updating",
-                        "ExpressionAttributeValues": {
-                            ":expected_status": {
-                                "S": expected_status,
-                            },
-                            ":old_updating": {"BOOL": False},
-                            ":new_updating": {"BOOL": True},
-                        },
-                    }
+        response = dynamo.update_item(
+            TableName=EnvironmentVariables.ORDER_STATUS_TABLE.value,
+            Key={
+                "id": {
+                    "S": order_id,
                 },
-            ],
+            },
+            UpdateExpression="SET leaseOwner = :owner, leaseExpiresAt = :expires_at ADD leaseToken :one REMOVE updating, offeredTo, offerExpiresAt",
+            # Only a free or expired lease can be taken, an offer only by its candidate
+            ConditionExpression=f"orderStatus = :expected_status AND {ORDER_LEASE_FREE_CONDITION}",
+            ExpressionAttributeValues={
+                ":expected_status": {
+                    "S": expected_status,
+                },
+                ":owner": {
+                    "S": str(lease_owner),
+                },
+                ":expires_at": {
+                    "N": str(now + ORDER_LEASE_DURATION_SECONDS),
+                },
+                ":now": {
+                    "N": str(now),
+                },
+                ":one": {
+                    "N": "1",
+                },
+            },
+            ReturnValues="UPDATED_NEW",
         )
-        return True
-    except dynamo.exceptions.TransactionCanceledException:
-        return False
+        return int(response["Attributes"]["leaseToken"]["N"])
+    except dynamo.exceptions.ConditionalCheckFailedException:
+        return None
 
 
-def send_order_update_task(
-    dynamo, customer_id, order_id, old_status, new_status, field_updates, sqs=None
-):
-    if sqs is None:
-        sqs = boto3.client("sqs")
+def offer_order(dynamo, order_id, expected_status, candidate_id, duration_seconds):
+    now = int(time.time())
+    expires_at = now + duration_seconds
+    try:
+        dynamo.update_item(
+            TableName=EnvironmentVariables.ORDER_STATUS_TABLE.value,
+            Key={
+                "id": {
+                    "S": order_id,
+                },
+            },
+            # Offers don't take the lease, so accepting one still needs a free lease
+            UpdateExpression="SET offeredTo = :owner, offerExpiresAt = :expires_at",
+            ConditionExpression=f"orderStatus = :expected_status AND {ORDER_LEASE_FREE_CONDITION}",
+            ExpressionAttributeValues={
+                ":expected_status": {
+                    "S": expected_status,
+                },
+                ":owner": {
+                    "S": str(candidate_id),
+                },
+                ":expires_at": {
+                    "N": str(expires_at),
+                },
+                ":now": {
+                    "N": str(now),
+                },
+            },
+        )
+        return expires_at
+    except dynamo.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def build_order_lease_transaction_item(order_status, lease_owner, now):
+    previous_token = int(order_status.get("leaseToken", 0))
+    return {
+        "Update": {
+            "Key": {
+                "id": {
+                    "S": order_status["id"],
+                },
+            },
+            "TableName": EnvironmentVariables.ORDER_STATUS_TABLE.value,
+            "UpdateExpression": "SET leaseOwner = :owner, leaseExpiresAt = :expires_at, leaseToken = :lease_token REMOVE updating, offeredTo, offerExpiresAt",
+            # The token read alongside the status fences out anyone who leased it since
+            "ConditionExpression": f"orderStatus = :expected_status AND {ORDER_LEASE_FREE_CONDITION} AND (attribute_not_exists(leaseToken) OR leaseToken = :previous_token)",
+            "ExpressionAttributeValues": {
+                ":expected_status": {
+                    "S": order_status["orderStatus"],
+                },
+                ":owner": {
+                    "S": str(lease_owner),
+                },
+                ":expires_at": {
+                    "N": str(now + ORDER_LEASE_DURATION_SECONDS),
+                },
+                ":now": {
+                    "N": str(now),
+                },
+                ":lease_token": {
+                    "N": str(previous_token + 1),
+                },
+                ":previous_token": {
+                    "N": str(previous_token),
+                },
+            },
+        }
+    }, previous_token + 1
+
 
-    if field_updates is None:
-        field_updates = {}
+def mark_orders_status_updating(dynamo, order_statuses, lease_owner):
+    now = int(time.time())
+    lease_tokens = {}
 
-    message_body = {
+    for start in range(0, len(order_statuses), TRANSACT_WRITE_MAX_ITEMS):
+        chunk = order_statuses[start : start + TRANSACT_WRITE_MAX_ITEMS]
+        while len(chunk) > 0:
+            items, tokens = zip(
+                *[
+                    build_order_lease_transaction_item(order_status, lease_owner, now)
+                    for order_status in chunk
+                ]
+            )
+            try:
+                dynamo.transact_write_items(TransactItems=list(items))
+                for order_status, token in zip(chunk, tokens):
+                    lease_tokens[order_status["id"]] = token
+                break
+            except dynamo.exceptions.TransactionCanceledException as e:
+                # Drop the orders that failed their condition and retry the rest once more
+                reasons = e.response.get("CancellationReasons", [])
+                failed = {
+                    index
+                    for index, reason in enumerate(reasons)
+                    if reason.get("Code") == "ConditionalCheckFailed"
+                }
+                if len(failed) == 0:
+                    print("Lease transaction cancelled", reasons)
+                    failed = set(range(len(chunk)))
+
+                for index in failed:
+                    lease_tokens[chunk[index]["id"]] = None
+                chunk = [
+                    order_status
+                    for index, order_status in enumerate(chunk)
+                    if index not in failed
+                ]
+
+    return lease_tokens
+
+
+def build_order_update_message(
+    customer_id, order_id, old_status, new_status, field_updates, lease_token
+):
+    return {
         "customerId": customer_id,
         "orderId": order_id,
         "previousStatus": old_status,
         "newStatus": new_status,
-        "fieldUpdates": field_updates,
+        "fieldUpdates": field_updates if field_updates is not None else {},
+        "leaseToken": lease_token,
     }
 
+
+def send_order_update_tasks(
+    dynamo, order_statuses, new_status, field_updates, lease_owner, sqs=None
+):
+    if sqs is None:
+        sqs = boto3.client("sqs")
+
+    print(f"Sending {len(order_statuses)} order update tasks with status {new_status}")
+    lease_tokens = mark_orders_status_updating(dynamo, order_statuses, lease_owner)
+
+    leased = [
+        order_status
+        for order_status in order_statuses
+        if lease_tokens.get(order_status["id"]) is not None
+    ]
+    messages = [
+        build_order_update_message(
+            order_status["customerId"],
+            order_status["id"],
+            order_status["orderStatus"],
+            new_status,
+            field_updates,
+            lease_tokens[order_status["id"]],
+        )
+        for order_status in leased
+    ]
+    message_ids = send_sqs_message_batch(
+        sqs, EnvironmentVariables.ORDER_UPDATE_QUEUE_URL.value, messages
+    )
+
+    results = {order_status["id"]: None for order_status in order_statuses}
+    for order_status, message_id in zip(leased, message_ids):
+        results[order_status["id"]] = message_id
+    return results
+
+
+def send_order_update_task(
+    dynamo,
+    customer_id,
+    order_id,
+    old_status,
+    new_status,
+    field_updates,
+    lease_owner,
+    sqs=None,
+):
+    if sqs is None:
+        sqs = boto3.client("sqs")
+
     print(
         f"Sending order status update task for customer {customer_id}'s order {order_id} with status {new_status}"
     )
 
-    if not mark_order_status_updating(dynamo, order_id, old_status):
+    lease_token = mark_order_status_updating(dynamo, order_id, old_status, lease_owner)
+    if lease_token is None:
         return None
+
+    message_body = build_order_update_message(
+        customer_id, order_id, old_status, new_status, field_updates, lease_token
+    )
+
     return send_sqs_message(
         sqs, EnvironmentVariables.ORDER_UPDATE_QUEUE_URL.value, message_body
     )
+
+
+def build_product_rating_aggregate_update(product_id, previous_rating, new_rating):
+    return build_product_rating_aggregates_update(
+        product_id, [(previous_rating, new_rating)]
+    )
+
+
+def build_product_rating_aggregates_update(product_id, rating_changes):
+    # Net out every (previous, new) change so one update covers a whole batch
+    histogram_deltas = {}
+    count_delta = 0
+    sum_delta = 0
+    for previous_rating, new_rating in rating_changes:
+        if previous_rating == new_rating:
+            continue
+
+        histogram_deltas[new_rating] = histogram_deltas.get(new_rating, 0) + 1
+        sum_delta += new_rating
+        if previous_rating is None:
+            count_delta += 1
+        else:
+            histogram_deltas[previous_rating] = (
+                histogram_deltas.get(previous_rating, 0) - 1
+            )
+            sum_delta -= previous_rating
+
+    update_expressions = []
+    expression_names = {}
+    expression_values = {}
+
+    for rating, delta in sorted(histogram_deltas.items()):
+        if delta != 0:
+            expression_names[f"#H{rating}"] = f"{RATING_HISTOGRAM_PREFIX}{rating}"
+            expression_values[f":h{rating}"] = {"N": str(delta)}
+            update_expressions.append(f"#H{rating} :h{rating}")
+
+    if count_delta != 0:
+        expression_values[":count_delta"] = {"N": str(count_delta)}
+        update_expressions.append("ratingCount :count_delta")
+
+    if sum_delta != 0:
+        expression_values[":sum_delta"] = {"N": str(sum_delta)}
+        update_expressions.append("ratingSum :sum_delta")
+
+    if len(update_expressions) == 0:
+        return None
+
+    update = {
+        "Key": {
+            "productId": {
+                "S": product_id,
+            },
+        },
+        "TableName": EnvironmentVariables.PRODUCT_RATINGS_TABLE.value,
+        "UpdateExpression": f"ADD {', '.join(update_expressions)}",
+        "ExpressionAttributeValues": expression_values,
+    }
+    if len(expression_names) > 0:
+        update["ExpressionAttributeNames"] = expression_names
+    return update
+
+
+def get_product_rating_aggregates(dynamo, product_ids):
+    keys = [{"productId": {"S": product_id}} for product_id in set(product_ids)]
+    raw_aggregates = batch_get_items(
+        dynamo, EnvironmentVariables.PRODUCT_RATINGS_TABLE.value, keys
+    )
+
+    aggregates = {}
+    for raw_aggregate in raw_aggregates:
+        aggregate = deserialize_dynamo_object(raw_aggregate)
+        rating_count = int(aggregate.get("ratingCount", 0))
+        rating_sum = aggregate.get("ratingSum", Decimal(0))
+        aggregates[aggregate["productId"]] = {
+            "ratingCount": rating_count,
+            "averageRating": (
+                round(Decimal(rating_sum) / rating_count, 2)
+                if rating_count > 0
+                else None
+            ),
+        }
+    return aggregates
+
+
+def get_schedule_queue(order):
+    order_status = order.get("orderStatus")
+    if order_status == OrderStatus.RECEIVED.value and "shopId" not in order:
+        return SCHEDULE_QUEUE_SHOP
+    elif order_status == OrderStatus.MADE.value and "delivererId" not in order:
+        return SCHEDULE_QUEUE_DELIVERY
+    else:
+        return None
+
+
+def get_zip_area(location):
+    if not location or "zip" not in location:
+        return None
+
+    area = str(location["zip"]).strip()[:SCHEDULE_AREA_LENGTH]
+    if len(area) == SCHEDULE_AREA_LENGTH and area.isdigit():
+        return area
+    return None
+
+
+def get_nearby_areas(area, radius):
+    center = int(area)
+    first = max(0, center - radius)
+    last = min(10**SCHEDULE_AREA_LENGTH - 1, center + radius)
+    return [str(nearby).zfill(SCHEDULE_AREA_LENGTH) for nearby in range(first, last + 1)]
+
+
+def get_schedule_area(order, queue):
+    # Shops prepare near the customer, deliverers pick up where the order was prepared
+    if queue == SCHEDULE_QUEUE_DELIVERY and "preparedLocation" in order:
+        return get_zip_area(order["preparedLocation"])
+    return get_zip_area(order.get("deliveryLocation"))
+
+
+def build_schedule_bucket(queue, day):
+    return f"{queue}#{day}"
+
+
+def build_area_schedule_bucket(queue, area, day):
+    return f"{queue}#{area}#{day}"
+
+
+def apply_schedule_bucket(order):
+    queue = get_schedule_queue(order)
+    if queue is None or "deliveryTime" not in order:
+        order.pop("scheduleBucket", None)
+        order.pop("areaBucket", None)
+        return order
+
+    # Delivery times are stored as ISO-8601, so the first 10 characters are the day
+    day = order["deliveryTime"][:10]
+    order["scheduleBucket"] = build_schedule_bucket(queue, day)
+
+    area = get_schedule_area(order, queue)
+    if area is None:
+        order.pop("areaBucket", None)
+    else:
+        order["areaBucket"] = build_area_schedule_bucket(queue, area, day)
+    return order
+
+
+def query_schedule_bucket(dynamo, index_name, key_name, bucket, start, end, limit, fields):
+    projection_expression, expression_names = build_projection_expression(fields)
+    query_args = {
+        "TableName": EnvironmentVariables.ORDERS_TABLE.value,
+        "IndexName": index_name,
+        "KeyConditionExpression": "#BUCKET = :bucket AND deliveryTime BETWEEN :start AND :end",
+        "ProjectionExpression": projection_expression,
+        "ExpressionAttributeNames": {
+            **expression_names,
+            "#BUCKET": key_name,
+        },
+        "ExpressionAttributeValues": {
+            ":bucket": {
+                "S": bucket,
+            },
+            ":start": {
+                "S": start,
+            },
+            ":end": {
+                "S": end,
+            },
+        },
+    }
+
+    items = []
+    while len(items) < limit:
+        query_args["Limit"] = limit - len(items)
+        response = dynamo.query(**query_args)
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            break
+        query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return items
+
+
+def query_scheduled_orders(dynamo, queue, window, limit, fields, areas=None):
+    now = datetime.now(timezone.utc)
+    window_end = now + window
+
+    start_time = now.strftime(SCHEDULE_TIME_FORMAT)
+    end_time = f"{window_end.strftime(SCHEDULE_TIME_FORMAT)}Z"
+
+    # Results from several areas are merged by delivery time, so it must be read
+    if "deliveryTime" not in fields:
+        fields = fields + ["deliveryTime"]
+
+    orders = []
+    day = now.date()
+    while day <= window_end.date() and len(orders) < limit:
+        if areas is None:
+            index_name = ORDERS_SCHEDULE_INDEX
+            key_name = "scheduleBucket"
+            buckets = [build_schedule_bucket(queue, day.isoformat())]
+        else:
+            index_name = ORDERS_AREA_SCHEDULE_INDEX
+            key_name = "areaBucket"
+            buckets = [
+                build_area_schedule_bucket(queue, area, day.isoformat())
+                for area in areas
+            ]
+
+        remaining = limit - len(orders)
+        day_orders = []
+        for bucket in buckets:
+            day_orders.extend(
+                query_schedule_bucket(
+                    dynamo,
+                    index_name,
+                    key_name,
+                    bucket,
+                    start_time,
+                    end_time,
+                    remaining,
+                    fields,
+                )
+            )
+
+        day_orders.sort(key=lambda item: item["deliveryTime"]["S"])
+        orders.extend(day_orders[:remaining])
+        day += timedelta(days=1)
+
+    return orders
+
+
+def build_earnings_owner_key(owner_type, owner_id):
+    return f"{owner_type}#{owner_id}"
+
+
+def get_earnings_day(timestamp_millis):
+    return datetime.fromtimestamp(timestamp_millis / 1000, timezone.utc).strftime(
+        EARNINGS_DAY_FORMAT
+    )
+
+
+def build_earnings_rollup_update(owner_type, owner_id, day, order):
+    return {
+        "Key": {
+            "ownerKey": {
+                "S": build_earnings_owner_key(owner_type, owner_id),
+            },
+            "day": {
+                "S": day,
+            },
+        },
+        "TableName": EnvironmentVariables.EARNINGS_TABLE.value,
+        "UpdateExpression": "ADD orderCount :one, commissionCents :commission, deliveryFeeCents :delivery_fee",
+        "ExpressionAttributeValues": {
+            ":one": {
+                "N": "1",
+            },
+            ":commission": {
+                "N": str(to_cents(order.get("commission", 0))),
+            },
+            ":delivery_fee": {
+                "N": str(to_cents(order.get("deliveryFee", 0))),
+            },
+        },
+    }
+
+
+def build_earnings_rollup_updates(order, day):
+    updates = []
+    for owner_type, owner_field in (
+        (EARNINGS_OWNER_SHOP, "shopId"),
+        (EARNINGS_OWNER_DELIVERER, "delivererId"),
+    ):
+        if owner_field in order:
+            updates.append(
+                build_earnings_rollup_update(
+                    owner_type, order[owner_field], day, order
+                )
+            )
+    return updates
+
+
+def _parse_earnings_day(event, name, default_value):
+    value = get_query_parameter(event, name, None)
+    if value is None:
+        return default_value
+
+    try:
+        return datetime.strptime(value, EARNINGS_DAY_FORMAT).date()
+    except ValueError:
+        raise ValueError(f"{name} must be a date formatted as YYYY-MM-DD")
+
+
+def get_earnings_date_range(event):
+    today = datetime.now(timezone.utc).date()
+    last_day = _parse_earnings_day(event, "to", today)
+    first_day = _parse_earnings_day(
+        event, "from", last_day - timedelta(days=EARNINGS_DEFAULT_RANGE_DAYS - 1)
+    )
+
+    if first_day > last_day:
+        raise ValueError("from must not be after to")
+    if (last_day - first_day).days >= EARNINGS_MAX_RANGE_DAYS:
+        raise ValueError(f"Date range must not exceed {EARNINGS_MAX_RANGE_DAYS} days")
+    return first_day, last_day
+
+
+def get_earnings(dynamo, owner_type, owner_id, first_day, last_day):
+    raw_rollups = query_all_items(
+        dynamo,
+        {
+            "TableName": EnvironmentVariables.EARNINGS_TABLE.value,
+            "KeyConditionExpression": "ownerKey = :owner_key AND #DAY BETWEEN :first_day AND :last_day",
+            "ExpressionAttributeNames": {
+                "#DAY": "day",
+            },
+            "ExpressionAttributeValues": {
+                ":owner_key": {
+                    "S": build_earnings_owner_key(owner_type, owner_id),
+                },
+                ":first_day": {
+                    "S": first_day.strftime(EARNINGS_DAY_FORMAT),
+                },
+                ":last_day": {
+                    "S": last_day.strftime(EARNINGS_DAY_FORMAT),
+                },
+            },
+        },
+    )
+
+    days = []
+    total_count = 0
+    total_cents = {field: 0 for field in EARNINGS_SUM_FIELDS}
+    for raw_rollup in raw_rollups:
+        rollup = deserialize_dynamo_object(raw_rollup)
+        order_count = int(rollup.get("orderCount", 0))
+        day = {
+            "day": rollup["day"],
+            "orderCount": order_count,
+        }
+        total_count += order_count
+        for cents_field, field in EARNINGS_SUM_FIELDS.items():
+            cents = int(rollup.get(cents_field, 0))
+            day[field] = from_cents(cents)
+            total_cents[cents_field] += cents
+        days.append(day)
+
+    totals = {"orderCount": total_count}
+    for cents_field, field in EARNINGS_SUM_FIELDS.items():
+        totals[field] = from_cents(total_cents[cents_field])
+
+    return {
+        "from": first_day.strftime(EARNINGS_DAY_FORMAT),
+        "to": last_day.strftime(EARNINGS_DAY_FORMAT),
+        "days": days,
+        "totals": totals,
+    }
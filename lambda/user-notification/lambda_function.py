@@ -1,73 +1,209 @@
 import json
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
 
 import boto3
+from botocore.config import Config
 from project_utility import (
+    OrderStatus,
+    PermanentError,
+    TransientError,
     UserNotificationTypes,
     createUiUrl,
     get_user_info,
+    handle_record_error,
+    has_time_for,
     send_email,
 )
 
 # Clients
-ses = boto3.client("ses")
+# Bounded so a send started in time also finishes in time
+ses = boto3.client(
+    "ses",
+    config=Config(
+        connect_timeout=1,
+        read_timeout=2,
+        retries={"total_max_attempts": 2, "mode": "standard"},
+    ),
+)
 api_gateway = boto3.client("apigateway")
+dynamo = boto3.client("dynamodb")
+sqs = boto3.client("sqs")
+
+# Constants
+ORDER_STATUS_RANKS = {status.value: rank for rank, status in enumerate(OrderStatus)}
+USER_INFO_CACHE_TTL_SECONDS = 300
+MAX_WORKERS = 8
+# Longest a send can take with the SES client's timeouts and attempts
+SES_SEND_COST_MILLIS = 2 * (1 + 2) * 1000
+
+STATUS_EMAIL_SUBJECT = Template("Order $order_id Update")
+STATUS_EMAIL_BODY = Template(
+    'Hi, order $order_id has a new status: $pretty_status! For more details, <a href="$ui_url">view order details</a>.'
+)
+
+# Cache of user ID -> (expiration, user info), kept across warm invocations
+user_info_cache = {}
+
 
+def get_cached_user_infos(user_ids):
+    now = time.monotonic()
+    user_infos = {}
+    missing_user_ids = []
 
-def email_user_new_status(user_id, order_id, new_status):
-    user_info = get_user_info(user_id, api_gateway)
-    if not user_info:
-        raise ValueError(f"Cannot find user {user_id}")
+    for user_id in set(user_ids):
+        cached = user_info_cache.get(user_id)
+        if cached is not None and cached[0] > now:
+            user_infos[user_id] = cached[1]
+        else:
+            missing_user_ids.append(user_id)
 
+    if len(missing_user_ids) > 0:
+        print(f"Looking up {len(missing_user_ids)} user(s)...")
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            looked_up = executor.map(
+                lambda user_id: get_user_info(user_id, api_gateway), missing_user_ids
+            )
+            for user_id, user_info in zip(missing_user_ids, looked_up):
+                if user_info:
+                    user_info_cache[user_id] = (
+                        now + USER_INFO_CACHE_TTL_SECONDS,
+                        user_info,
+                    )
+                user_infos[user_id] = user_info
+
+    return user_infos
+
+
+def email_user_new_status(user_info, order_id, new_status):
     email = user_info["email"]
     pretty_status = " ".join(map(lambda s: s.capitalize(), new_status.split("_")))
     ui_url = createUiUrl(f"order?id={order_id}")
 
-    message = f'Hi, order {order_id} has a new status: {pretty_status}! For more details, <a href="{ui_url}">view order details</a>.'
+    subject = STATUS_EMAIL_SUBJECT.substitute(order_id=order_id)
+    message = STATUS_EMAIL_BODY.substitute(
+        order_id=order_id, pretty_status=pretty_status, ui_url=ui_url
+    )
 
     print(f"Sending message to {email}...", message)
-    send_email(ses, email, f"Order {order_id} Update", message)
+    send_email(ses, email, subject, message)
 
 
-def process_message(record):
+def parse_message(record):
     message_id = record["messageId"]
     message_body = json.loads(record["body"])
 
-    print(f"Processing message {message_id}...")
+    print(f"Parsing message {message_id}...")
 
     message_type = message_body["type"] if "type" in message_body else None
-    if message_type == UserNotificationTypes.ORDER_STATUS_UPDATE.type_code:
-        customer_id = message_body["customerId"]
-        order_id = message_body["orderId"]
-        new_status = message_body["orderStatus"]
-        email_user_new_status(customer_id, order_id, new_status)
-    else:
+    if message_type != UserNotificationTypes.ORDER_STATUS_UPDATE.type_code:
         print(f"Unknown message type: {message_type}")
-        raise ValueError("Unknown message type")
+        raise PermanentError("Unknown message type")
 
-    print(f"Processed message {message_id}")
+    try:
+        return {
+            "messageId": message_id,
+            "customerId": message_body["customerId"],
+            "orderId": message_body["orderId"],
+            "orderStatus": message_body["orderStatus"],
+            "sentTimestamp": int(record.get("attributes", {}).get("SentTimestamp", 0)),
+        }
+    except KeyError as e:
+        raise PermanentError(f"Message {message_id} is missing {e}")
+
+
+def is_newer_status_update(message, current):
+    message_rank = ORDER_STATUS_RANKS.get(message["orderStatus"], -1)
+    current_rank = ORDER_STATUS_RANKS.get(current["orderStatus"], -1)
+    if message_rank != current_rank:
+        return message_rank > current_rank
+    return message["sentTimestamp"] >= current["sentTimestamp"]
+
+
+def coalesce_status_updates(records):
+    latest_updates = {}
+    errors = []
+
+    for record in records:
+        try:
+            message = parse_message(record)
+        except Exception as e:
+            print(f"Error parsing record {record['messageId']}", repr(e))
+            errors.append((record, e))
+            continue
+
+        order_id = message["orderId"]
+        current = latest_updates.get(order_id)
+        if current is None or is_newer_status_update(message, current):
+            if current is not None:
+                print(
+                    f"Message {current['messageId']} superseded by {message['messageId']}"
+                )
+            latest_updates[order_id] = message
+        else:
+            print(f"Message {message['messageId']} superseded by {current['messageId']}")
+
+    return list(latest_updates.values()), errors
+
+
+def process_records(records, context=None):
+    updates, errors = coalesce_status_updates(records)
+    records_by_id = {record["messageId"]: record for record in records}
+    failed_message_ids = []
+    print(f"Coalesced {len(records)} record(s) into {len(updates)} email(s)")
+
+    user_infos = get_cached_user_infos([update["customerId"] for update in updates])
+
+    def send_update(update):
+        # Checked once a worker picks the send up, queued sends may start late
+        if not has_time_for(context, SES_SEND_COST_MILLIS):
+            return False
+        user_info = user_infos.get(update["customerId"])
+        if not user_info:
+            # Lookups that hit an API error look the same as missing users
+            raise TransientError(f"Cannot find user {update['customerId']}")
+        email_user_new_status(user_info, update["orderId"], update["orderStatus"])
+        return True
+
+    # Every started send finishes before the deadline, so waiting for all is safe
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [(update, executor.submit(send_update, update)) for update in updates]
+
+    for update, future in futures:
+        try:
+            if not future.result():
+                # Unsent emails are retried with their message
+                print(f"Ran out of time for record {update['messageId']}")
+                failed_message_ids.append(update["messageId"])
+                continue
+            print(f"Processed message {update['messageId']}")
+        except Exception as e:
+            error_string = traceback.format_exc()
+            print(error_string)
+
+            print(f"Error processing record {update['messageId']}", repr(e))
+            errors.append((records_by_id[update["messageId"]], e))
+
+    for record, error in errors:
+        if handle_record_error(record, error, dynamo, sqs):
+            failed_message_ids.append(record["messageId"])
+    return failed_message_ids
 
 
 def lambda_handler(event, context):
     print(f"Received event: {event}")
     print(f"Context: {context}")
 
-    batch_item_failures = []
     response = {}
 
     try:
         if event:
-            for record in event["Records"]:
-                try:
-                    process_message(record)
-                except Exception as e:
-                    error_string = traceback.format_exc()
-                    print(error_string)
-                    
-                    print(f"Error processing record {record['messageId']}", repr(e))
-                    batch_item_failures.append({"itemIdentifier": record["messageId"]})
-
-            response["batchItemFailures"] = batch_item_failures
+            failed_message_ids = process_records(event["Records"], context)
+            response["batchItemFailures"] = [
+                {"itemIdentifier": message_id} for message_id in failed_message_ids
+            ]
     except Exception as e:
         error_string = traceback.format_exc()
         print(error_string)